@@ -31,6 +31,7 @@ dev_require = [
     "attrs>=19.2",
 ]
 docs_require = ["sphinx", "sphinx-autobuild", "sphinx-rtd-theme", "sphinx-click"]
+sample_require = ["scipy>=1.7"]
 
 setup(
     name="experi",
@@ -38,7 +39,7 @@ setup(
     python_requires=">=3.6",
     setup_requires=[],
     install_requires=install_require,
-    extras_require={"dev": dev_require, "docs": docs_require},
+    extras_require={"dev": dev_require, "docs": docs_require, "sample": sample_require},
     packages=find_packages("src"),
     package_dir={"": "src"},
     include_package_data=True,
@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""A cache of the outputs of commands shared between experiments.
+
+The outputs of a command are the file (or directory) given by ``creates``, which are
+stored in the cache under a key made from the digest of the command along with the
+contents of the ``requires`` input. When the same command is run again with the same
+input, possibly from a different experiment, the output is restored from the cache
+rather than running the command. Only commands with a ``creates`` value are cached.
+
+The outputs are copied into the cache, so the cache never shares a file with the
+output of a command which ran. They are restored using a hard link when the cache is on
+the same filesystem, falling back to a copy otherwise. Since the restored files are
+shared with the cache, they are made read only, and the links of a restored output are
+broken before running its command again, so a command can't modify the cache by
+writing to its output in place.
+
+Each entry of the cache is a directory, with the modification time updated whenever
+the entry is used. When the size of the cache is bounded, the least recently used
+entries are removed once the cache becomes larger than the bound.
+
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from .commands import Command
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# Incomplete entries are written to this subdirectory of the cache
+TMP_DIR = "tmp"
+# The name of the output within the directory of an entry
+OUTPUT = "output"
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value: str) -> int:
+    """Convert a size like 10G into a number of bytes."""
+    value = str(value).strip().upper().rstrip("B")
+    suffix = value[-1:] if value[-1:] in _SIZE_SUFFIXES else ""
+    try:
+        number = float(value[: len(value) - len(suffix)])
+    except ValueError:
+        raise ValueError(f"Unable to parse the size '{value}'")
+    return int(number * _SIZE_SUFFIXES[suffix])
+
+
+def _hash_path(hasher, path: Path) -> None:
+    """Update hasher with the contents of a file, or the files within a directory."""
+    if path.is_dir():
+        for child in sorted(path.iterdir()):
+            hasher.update(child.name.encode())
+            _hash_path(hasher, child)
+        return
+    with path.open("rb") as src:
+        for block in iter(lambda: src.read(2 ** 20), b""):
+            hasher.update(block)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Hard links can't cross filesystems
+        shutil.copy2(src, dst)
+
+
+def _clone(src: Path, dst: Path) -> None:
+    if src.is_dir():
+        shutil.copytree(str(src), str(dst), copy_function=_link_or_copy)
+    else:
+        _link_or_copy(str(src), str(dst))
+
+
+def _copy(src: Path, dst: Path) -> None:
+    if src.is_dir():
+        shutil.copytree(str(src), str(dst))
+    else:
+        shutil.copy2(str(src), str(dst))
+
+
+def _unlink_file(path: str) -> None:
+    """Replace a file which has other hard links with a writable copy."""
+    stat_result = os.lstat(path)
+    if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_nlink < 2:
+        return
+    tmp_path = f"{path}.experi-{os.getpid()}"
+    shutil.copyfile(path, tmp_path)
+    os.chmod(tmp_path, stat.S_IMODE(stat_result.st_mode) | stat.S_IWUSR)
+    os.replace(tmp_path, path)
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def _make_read_only(path: Path) -> None:
+    write = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, _, files in os.walk(str(path)):
+        for fname in files:
+            file_path = os.path.join(root, fname)
+            os.chmod(file_path, os.stat(file_path).st_mode & ~write)
+    if path.is_file():
+        os.chmod(str(path), path.stat().st_mode & ~write)
+
+
+def _size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(str(path)):
+        for fname in files:
+            total += os.lstat(os.path.join(root, fname)).st_size
+    return total
+
+
+class Cache:
+    """A directory containing the outputs of commands.
+
+    Args:
+        directory: The directory of the cache, which is created when it doesn't exist.
+        max_size: The maximum size of the cache in bytes, with no limit when None.
+
+    """
+
+    def __init__(self, directory: PathLike, max_size: Optional[int] = None) -> None:
+        self.directory = Path(directory)
+        self.max_size = max_size
+        (self.directory / TMP_DIR).mkdir(parents=True, exist_ok=True)
+
+    def key(self, command: Command, directory: PathLike) -> Optional[str]:
+        """The key of the outputs of a command run in directory.
+
+        Returns: The key, or None when the command can't be cached, either because it
+            has no outputs or its input doesn't exist.
+
+        """
+        if not command.creates:
+            return None
+        hasher = hashlib.sha1(str(command).encode())
+        if command.requires:
+            requires = Path(directory) / command.requires
+            if not requires.exists():
+                return None
+            _hash_path(hasher, requires)
+        return hasher.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def restore(self, key: str, command: Command, directory: PathLike) -> bool:
+        """Restore the outputs of a command from the cache.
+
+        Returns: Whether the outputs were in the cache.
+
+        """
+        entry = self._entry(key)
+        if not (entry / OUTPUT).exists():
+            return False
+        creates = Path(directory) / command.creates
+        creates.parent.mkdir(parents=True, exist_ok=True)
+        _remove(creates)
+        _clone(entry / OUTPUT, creates)
+        # Mark the entry as recently used
+        os.utime(str(entry))
+        logger.debug("Restored %s from the cache", creates)
+        return True
+
+    def store(self, key: str, command: Command, directory: PathLike) -> None:
+        """Store the outputs of a command which has completed successfully."""
+        creates = Path(directory) / command.creates
+        entry = self._entry(key)
+        if not creates.exists() or entry.exists():
+            return
+        # Build the entry outside the cache so it only appears once complete
+        tmp_entry = self.directory / TMP_DIR / f"{key}-{os.getpid()}"
+        _remove(tmp_entry)
+        tmp_entry.mkdir(parents=True)
+        # A copy, so running the command again can't modify the entry
+        _copy(creates, tmp_entry / OUTPUT)
+        _make_read_only(tmp_entry / OUTPUT)
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            os.rename(str(tmp_entry), str(entry))
+        except OSError:
+            # Another process stored the same outputs first
+            _remove(tmp_entry)
+            return
+        logger.debug("Stored %s in the cache", creates)
+        if self.max_size is not None:
+            self.gc(self.max_size)
+
+    def detach(self, command: Command, directory: PathLike) -> None:
+        """Break the hard links between the outputs of a command and the cache.
+
+        This is required before running a command which could write to an output
+        restored from the cache, which would otherwise modify the entry in place.
+
+        """
+        creates = Path(directory) / command.creates
+        if creates.is_dir() and not creates.is_symlink():
+            for root, _, files in os.walk(str(creates)):
+                for fname in files:
+                    _unlink_file(os.path.join(root, fname))
+        elif creates.exists():
+            _unlink_file(str(creates))
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        """The last time each entry was used, along with the size and path."""
+        entries = []
+        for prefix in self.directory.iterdir():
+            if prefix.name == TMP_DIR or not prefix.is_dir():
+                continue
+            for entry in prefix.iterdir():
+                entries.append((entry.stat().st_mtime, _size(entry), entry))
+        return entries
+
+    def gc(self, max_size: Optional[int] = None, tmp_age: float = 86400) -> int:
+        """Remove the least recently used entries until the cache fits in max_size.
+
+        Incomplete entries older than tmp_age seconds are also removed, which are left
+        behind when a process is killed while storing outputs.
+
+        Returns: The number of bytes removed.
+
+        """
+        removed = 0
+        for tmp_entry in (self.directory / TMP_DIR).iterdir():
+            if tmp_entry.stat().st_mtime < time.time() - tmp_age:
+                removed += _size(tmp_entry)
+                _remove(tmp_entry)
+
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return removed
+
+        entries = sorted(self.entries(), key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= max_size:
+                break
+            logger.debug("Removing %s from the cache", entry.name)
+            _remove(entry)
+            total -= size
+            removed += size
+        return removed
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Commands which call a python function rather than running in a shell.
+
+A command of the form ``python: module:function`` calls the function with the values of
+the variables which are parameters of the function as keyword arguments. Running a
+python script as a shell command starts a new interpreter and imports every module for
+each command, which can take longer than the work of the command. Instead the function
+is called in a pool of worker processes, each importing the module once and then calling
+the function for many commands.
+
+When the worker processes are started using a fork server, the modules are imported in
+the server before the workers are forked, so every worker starts with the modules
+already imported.
+
+Each command can also be run in a shell as ``experi call module:function KWARGS``,
+which is how the command is run in the array job of a scheduler.
+
+"""
+
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shlex
+import socket
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .commands import Command
+from .metrics import json_default
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# The directory a worker process has been prepared to run commands in
+_WORKER_DIRECTORY: Optional[str] = None
+
+
+def parse_function(function: str) -> Tuple[str, str]:
+    """Split a function specification module:function into the module and name."""
+    module, sep, name = str(function).strip().partition(":")
+    if not (module and sep and name):
+        raise ValueError(
+            f"The function '{function}' needs to be in the form module:function"
+        )
+    return module, name
+
+
+def load_function(function: str, directory: PathLike = None) -> Callable:
+    """Import the function from module:function.
+
+    When a directory is given it is searched for the module before the rest of the
+    python path, which is the directory containing the experiment.
+
+    """
+    module, name = parse_function(function)
+    if directory is not None and str(directory) not in sys.path:
+        sys.path.insert(0, str(directory))
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError) as err:
+        raise ValueError(f"Unable to import the function '{function}': {err}")
+
+
+def function_arguments(
+    function: str, variables: Iterable[str], directory: PathLike = None
+) -> Set[str]:
+    """The variables which are passed to a function as keyword arguments.
+
+    These are the variables which are parameters of the function, or every variable
+    when the function accepts arbitrary keyword arguments.
+
+    """
+    variables = set(variables)
+    parameters = inspect.signature(load_function(function, directory)).parameters
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        return variables
+    return variables & set(parameters)
+
+
+class PythonCommand(Command):
+    """A command calling a python function with the variables as keyword arguments.
+
+    The command string is the equivalent shell command using ``experi call``, so the
+    command is identified, deduplicated and recorded in the same way as a shell command.
+
+    Args:
+        function: The function to call in the form module:function.
+        variables: The values of the variables.
+        creates: The file created by the function.
+        requires: The file required by the function.
+        idempotent: Whether calling the function multiple times has the same result as
+            calling it once.
+        arguments: The variables passed to the function as keyword arguments, which
+            is all the variables when None.
+
+    """
+
+    def __init__(
+        self,
+        function: str,
+        variables: Dict[str, Any] = None,
+        creates: str = "",
+        requires: str = "",
+        idempotent: bool = False,
+        arguments: Iterable[str] = None,
+    ) -> None:
+        self.module, self.name = parse_function(function)
+        self.function = f"{self.module}:{self.name}"
+        # The template is the function, which is the same for every command
+        super().__init__(
+            f"experi call {self.function}", variables, creates, requires, idempotent
+        )
+        self.arguments = None if arguments is None else set(arguments)
+
+    @property
+    def kwargs(self) -> Dict[str, Any]:
+        """The keyword arguments the function is called with."""
+        if self.arguments is None:
+            return dict(self.variables)
+        return {
+            key: value for key, value in self.variables.items() if key in self.arguments
+        }
+
+    @property
+    def cmd(self) -> List[str]:
+        kwargs = json.dumps(self.kwargs, default=json_default, sort_keys=True)
+        return [f"experi call {self.function} {shlex.quote(kwargs)}"]
+
+    @cmd.setter
+    def cmd(self, value) -> None:
+        Command.cmd.fset(self, value)  # type: ignore
+
+
+def call_function(
+    function: str, kwargs: Dict[str, Any], directory: PathLike = None
+) -> Dict[str, Any]:
+    """Call a function recording the resources used, like :func:`~.metrics.run_command`.
+
+    An exception raised by the function is logged and results in an exit code of 1,
+    with the code of a call to :func:`sys.exit` also being the exit code. The cpu time
+    is the time used by the calling process during the call, while the memory is the
+    largest used by the process so far.
+
+    Returns: The resources used by the call, including the exit code.
+
+    """
+    print(f"{function}(**{kwargs})", flush=True)
+    usage = {
+        "exit_code": 0,
+        "start_time": time.time(),
+        "wall_time": 0.0,
+        "user_time": 0.0,
+        "sys_time": 0.0,
+        "max_rss": 0,
+        "host": socket.gethostname(),
+    }
+    start = time.perf_counter()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        load_function(function, directory)(**kwargs)
+    except SystemExit as err:
+        if isinstance(err.code, int):
+            usage["exit_code"] = err.code
+        elif err.code is not None:
+            usage["exit_code"] = 1
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Calling %s failed", function)
+        usage["exit_code"] = 1
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    usage["wall_time"] = time.perf_counter() - start
+    usage["user_time"] = after.ru_utime - before.ru_utime
+    usage["sys_time"] = after.ru_stime - before.ru_stime
+    usage["max_rss"] = after.ru_maxrss
+    return usage
+
+
+def _call_in_worker(
+    function: str, kwargs: Dict[str, Any], directory: str, delay: float = 0.0
+) -> Dict[str, Any]:
+    """Call a function in a worker process, which runs in the directory."""
+    global _WORKER_DIRECTORY  # pylint: disable=global-statement
+    if _WORKER_DIRECTORY != directory:
+        os.chdir(directory)
+        _WORKER_DIRECTORY = directory
+    if delay > 0:
+        time.sleep(delay)
+    return call_function(function, kwargs, directory)
+
+
+class FunctionPool:
+    """A pool of worker processes calling the functions of python commands.
+
+    Args:
+        processes: The number of worker processes.
+        directory: The directory in which the functions are called, which is searched
+            for the modules of the functions.
+        modules: The modules imported before starting the worker processes.
+
+    """
+
+    def __init__(
+        self, processes: int, directory: PathLike, modules: Iterable[str] = ()
+    ) -> None:
+        self.directory = str(Path(directory).resolve())
+        kwargs: Dict[str, Any] = {}
+        if (
+            sys.version_info >= (3, 7)
+            and "forkserver" in multiprocessing.get_all_start_methods()
+        ):
+            # The fork server imports the modules once, with the workers forked from it
+            context = multiprocessing.get_context("forkserver")
+            if self.directory not in sys.path:
+                sys.path.insert(0, self.directory)
+            context.set_forkserver_preload(sorted(set(modules)))
+            kwargs["mp_context"] = context
+        self._pool = ProcessPoolExecutor(max_workers=processes, **kwargs)
+
+    def submit(self, command: PythonCommand, delay: float = 0.0):
+        """Call the function of a command, returning a future of the resources used.
+
+        The call starts once delay seconds have passed.
+
+        """
+        return self._pool.submit(
+            _call_in_worker, command.function, command.kwargs, self.directory, delay
+        )
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self) -> "FunctionPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
@@ -8,14 +8,102 @@
 
 """Command class."""
 
+import hashlib
 import logging
+import math
+import os
+import re
+import shlex
 from pathlib import Path
 from string import Formatter
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# The walltime requested by a job which doesn't specify one
+DEFAULT_WALLTIME = "1:00"
+
+
+def parse_walltime(walltime: str) -> float:
+    """The number of seconds of a walltime like [days-][[hours:]minutes:]seconds.
+
+    A walltime without a colon is ambiguous, being seconds in PBS and minutes in SLURM,
+    so it raises a ValueError along with any other value which can't be parsed.
+
+    """
+    value = str(walltime).strip()
+    days = 0
+    if "-" in value:
+        day_str, value = value.split("-", 1)
+        # With days the remaining fields start with the hours
+        value += ":00" * (2 - value.count(":"))
+    elif ":" not in value:
+        raise ValueError(f"The walltime '{walltime}' needs to be in the form hh:mm:ss")
+    else:
+        day_str = "0"
+    try:
+        days = int(day_str)
+        seconds = 0.0
+        for field in value.split(":"):
+            seconds = 60 * seconds + float(field)
+    except ValueError:
+        raise ValueError(f"Unable to parse the walltime '{walltime}'")
+    return 86400 * days + seconds
+
+
+def format_walltime(seconds: float) -> str:
+    """Format a walltime request, rounding up to a whole number of minutes."""
+    minutes = max(1, math.ceil(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:00"
+
+
+def digest(command: str) -> str:
+    """A hash of a command string which is stable between python processes."""
+    return hashlib.sha1(command.encode()).hexdigest()
+
+
+def template_variables(template: str) -> Set[str]:
+    """The names of the variables used in a format string.
+
+    This includes the variables used within a format specification like
+    ``{value:.{precision}f}``, with only the name of the variable returned for fields
+    which access an attribute or index like ``{value[0]}``.
+
+    """
+    variables = set()
+    for _, field, spec, _ in Formatter().parse(template):
+        if field:
+            variables.add(re.split(r"[.\[]", field, maxsplit=1)[0])
+        if spec:
+            variables |= template_variables(spec)
+    return variables
+
+
+def referenced_variables(
+    cmd: Union[List[str], str], creates: str = "", requires: str = ""
+) -> Set[str]:
+    """All the variables used to render a command along with creates and requires."""
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    variables: Set[str] = set()
+    for template in list(cmd) + [creates, requires]:
+        variables |= template_variables(template)
+    # These are substituted from the command rather than the variables
+    return variables - {"creates", "requires"}
+
 
 class Command:
     """A command to be run for an experiment."""
@@ -24,6 +112,7 @@ class Command:
     variables: Dict[str, Any]
     _creates: str = ""
     _requires: str = ""
+    idempotent: bool = False
     __formatter = Formatter()
 
     def __init__(
@@ -32,6 +121,7 @@ class Command:
         variables: Dict[str, Any] = None,
         creates: str = "",
         requires: str = "",
+        idempotent: bool = False,
     ) -> None:
         if isinstance(cmd, str):
             self.cmd = [cmd]
@@ -53,6 +143,8 @@ class Command:
 
         self._creates = creates
         self._requires = requires
+        # Running the command multiple times has the same result as running it once
+        self.idempotent = idempotent
 
     def get_variables(self) -> Set[str]:
         """Find all the variables specified in a format string.
@@ -64,7 +156,6 @@ class Command:
         variables = set()
         for cmd in self._cmd:
             for var in self.__formatter.parse(cmd):
-                logger.debug("Checking variable: %s", var)
                 # creates and requires are special class values
                 if var[1] is not None and var[1] not in ["creates", "requires"]:
                     variables.add(var[1])
@@ -97,6 +188,19 @@ class Command:
     def __iter__(self):
         yield from self.cmd
 
+    def digest(self) -> str:
+        """A hash of the command which is stable between python processes."""
+        return digest("\0".join(self.cmd))
+
+    def template_digest(self) -> str:
+        """A hash of the command before the variables are substituted.
+
+        This is shared by all the commands generated from the same template, which
+        identifies commands with runtimes depending on the same variables.
+
+        """
+        return digest(" && ".join(self._cmd).strip())
+
     def __str__(self) -> str:
         return " && ".join(self.cmd).strip()
 
@@ -109,31 +213,201 @@ class Command:
         return hash(tuple(self.cmd))
 
 
+class FusedCommand(Command):
+    """The commands of consecutive stages run one after the other as a single command.
+
+    Each stage requires the output created by the previous stage, so the fused command
+    requires the input of the first stage and creates the output of the last. The
+    variables are those of all the stages.
+
+    """
+
+    def __init__(self, stages: List[Command]) -> None:
+        self.stages: List[Command] = []
+        for stage in stages:
+            if isinstance(stage, FusedCommand):
+                self.stages += stage.stages
+            else:
+                self.stages.append(stage)
+        variables: Dict[str, Any] = {}
+        for stage in self.stages:
+            variables.update(stage.variables)
+        super().__init__(
+            [], variables, idempotent=all(stage.idempotent for stage in self.stages)
+        )
+
+    @property
+    def creates(self) -> str:
+        return self.stages[-1].creates
+
+    @property
+    def requires(self) -> str:
+        return self.stages[0].requires
+
+    @property
+    def cmd(self) -> List[str]:
+        return [cmd for stage in self.stages for cmd in stage.cmd]
+
+    @cmd.setter
+    def cmd(self, value) -> None:
+        Command.cmd.fset(self, value)  # type: ignore
+
+    def template_digest(self) -> str:
+        return digest(" | ".join(stage.template_digest() for stage in self.stages))
+
+
 class Job:
-    """A task to perform within a simulation."""
+    """A task to perform within a simulation.
+
+    When a shard is specified as a tuple ``(index, num_shards)``, only the commands
+    within that shard are part of the job. The commands are partitioned either into
+    contiguous blocks (``shard_by="block"``) or using a stable hash of each command
+    (``shard_by="hash"``), so each shard is the same for every invocation.
+
+    When a sort_key is given, the commands are ordered by the key after they have been
+    sharded, allowing the commands predicted to take the longest to start first.
+
+    At most max_concurrent commands of the job run at the same time when it is set,
+    with each command waiting a random time of up to jitter seconds before starting.
+    This spreads the load on a shared filesystem when starting many commands.
+
+    """
 
     commands: List[Command]
     shell: str = "bash"
     scheduler_options: Optional[Dict[str, Any]] = None
     use_dependencies: bool = False
     directory: Optional[Path] = None
+    shard: Optional[Tuple[int, int]] = None
+    shard_by: str = "block"
+    sort_key: Optional[Callable[[Command], Any]] = None
+    max_concurrent: Optional[int] = None
+    jitter: float = 0.0
 
     def __init__(
-        self, commands, scheduler_options=None, directory=None, use_dependencies=False
+        self,
+        commands,
+        scheduler_options=None,
+        directory=None,
+        use_dependencies=False,
+        shard=None,
+        shard_by="block",
+        sort_key=None,
+        max_concurrent=None,
+        jitter=0.0,
     ) -> None:
         if use_dependencies and directory is None:
             raise ValueError("Directory must be set when overwrite is False.")
+        if shard_by not in ["block", "hash"]:
+            raise ValueError(
+                f"Sharding by '{shard_by}' is not supported. "
+                "Possible values are ['block', 'hash']"
+            )
 
         self.commands = commands
         self.scheduler_options = scheduler_options
         self.directory = directory
         self.use_dependencies = use_dependencies
+        self.shard = shard
+        self.shard_by = shard_by
+        self.sort_key = sort_key
+        if max_concurrent is not None and int(max_concurrent) < 1:
+            raise ValueError(
+                f"The max_concurrent must be a positive integer, got {max_concurrent}"
+            )
+        self.max_concurrent = None if max_concurrent is None else int(max_concurrent)
+        if float(jitter) < 0:
+            raise ValueError(f"The jitter can't be negative, got {jitter}")
+        self.jitter = float(jitter)
+        # The commands in the order they run, along with the settings they depend on
+        self._order: Optional[Tuple[Tuple[Any, ...], List[Command]]] = None
+
+    def with_commands(
+        self,
+        commands: List[Command],
+        scheduler_options: Dict[str, Any] = None,
+        shard: Tuple[int, int] = None,
+    ) -> "Job":
+        """A job with the same settings containing different commands.
 
-    def __iter__(self):
+        The commands are usually taken from iterating over the job, so they have
+        already been sharded and the new job isn't sharded again. When the commands
+        are taken from the unsharded commands of the job, the shard is passed on.
+
+        """
+        if scheduler_options is None:
+            scheduler_options = self.scheduler_options
+        return Job(
+            commands,
+            scheduler_options,
+            self.directory,
+            self.use_dependencies,
+            shard,
+            self.shard_by,
+            self.sort_key,
+            self.max_concurrent,
+            self.jitter,
+        )
+
+    def _shard_commands(self) -> Iterator[Command]:
+        if self.shard is None:
+            yield from self.commands
+            return
+
+        index, num_shards = self.shard
+        if self.shard_by == "block":
+            num_commands = len(self.commands)
+            start = index * num_commands // num_shards
+            stop = (index + 1) * num_commands // num_shards
+            yield from self.commands[start:stop]
+        else:
+            for command in self.commands:
+                if int(command.digest(), 16) % num_shards == index:
+                    yield command
+
+    def _ordered_commands(self) -> List[Command]:
+        """The commands of the shard in the order they run.
+
+        A job is iterated over many times, so the sharded and sorted commands are only
+        computed once, unless the commands or the settings ordering them change.
+
+        """
+        if self.shard is None and self.sort_key is None:
+            return self.commands
+        settings = (
+            id(self.commands),
+            len(self.commands),
+            self.shard,
+            self.shard_by,
+            self.sort_key,
+        )
+        if self._order is None or self._order[0] != settings:
+            commands = self._shard_commands()
+            if self.sort_key is not None:
+                # The sort is stable so commands with the same key retain their order
+                commands = iter(sorted(commands, key=self.sort_key))
+            self._order = (settings, list(commands))
+        return self._order[1]
+
+    def iter_complete(self) -> Iterator[Tuple[Command, bool]]:
+        """Each command of the job along with whether its output already exists.
+
+        A command is only complete when using dependencies, with the commands which are
+        complete being skipped when iterating over the job.
+
+        """
         if self.use_dependencies and self.directory is None:
             raise ValueError("Directory must be set when overwrite is False.")
-        for command in self.commands:
-            if self.use_dependencies and (self.directory / command.creates).is_file():
+        for command in self._ordered_commands():
+            complete = (
+                self.use_dependencies
+                and (self.directory / command.creates).is_file()  # type: ignore
+            )
+            yield command, complete
+
+    def __iter__(self):
+        for command, complete in self.iter_complete():
+            if complete:
                 # This file already exists, we don't need to create it again
                 continue
             yield command
@@ -145,10 +419,120 @@ class Job:
         """Return a representation as a bash array.
 
         This creates a string formatted as a bash array containing all the commands in the job.
+        Each command is quoted so it is a single element of the array, which is
+        passed to the shell unchanged.
 
         """
         return_string = "( \\\n"
         for command in self:
-            return_string += '"' + str(command) + '" \\\n'
+            return_string += shlex.quote(str(command)) + " \\\n"
         return_string += ")"
         return return_string
+
+
+def _fuse_commands(
+    first: List[Command], second: List[Command]
+) -> Optional[List[Command]]:
+    """Pair each command with the command requiring its output.
+
+    Returns: The fused commands in the order of the first commands, or None when the
+        commands don't map one to one.
+
+    """
+    if len(first) != len(second):
+        return None
+    creates: Dict[str, Command] = {}
+    for command in first:
+        if not command.creates:
+            return None
+        output = os.path.normpath(command.creates)
+        if output in creates:
+            return None
+        creates[output] = command
+    pairs: Dict[Command, Command] = {}
+    for command in second:
+        source = None
+        if command.requires:
+            source = creates.get(os.path.normpath(command.requires))
+        if source is None or source in pairs:
+            return None
+        pairs[source] = command
+    return [FusedCommand([command, pairs[command]]) for command in first]
+
+
+def _fused_options(first: Job, second: Job) -> Optional[Dict[str, Any]]:
+    """The scheduler options of the first job with the walltime of both jobs.
+
+    Returns: The options, or None when the jobs have any other options which differ,
+        or a walltime can't be parsed.
+
+    """
+    options = dict(first.scheduler_options or {})
+    other = second.scheduler_options or {}
+    different = sorted(
+        key
+        for key in set(options) | set(other)
+        if key != "walltime" and options.get(key) != other.get(key)
+    )
+    if different:
+        logger.info("Not fusing jobs with different options %s", different)
+        return None
+    walltimes = [
+        (job.scheduler_options or {}).get("walltime", DEFAULT_WALLTIME)
+        for job in [first, second]
+    ]
+    try:
+        seconds = sum(parse_walltime(walltime) for walltime in walltimes)
+    except ValueError as err:
+        logger.warning("Not fusing jobs: %s", err)
+        return None
+    options["walltime"] = format_walltime(seconds)
+    return options
+
+
+def fuse_jobs(jobs: Iterable[Job]) -> Iterator[Job]:
+    """Fuse consecutive jobs where the commands of each stage map one to one.
+
+    When every command of a job requires the output created by a different command of
+    the previous job, the two jobs are fused into a single job, with each command
+    running the pair of commands one after the other, see :class:`FusedCommand`. This
+    means each pair runs in the same element of an array job, waiting in the queue
+    once rather than for each stage. Any number of consecutive jobs can be fused.
+
+    The walltime of the fused job is the sum of the walltimes of the stages, with a
+    stage which doesn't specify a walltime using the default. Jobs with a walltime
+    which can't be parsed, or with any other scheduler options which differ, are never
+    fused. A staged job is also never fused with the previous job when the output of
+    the previous job is required by any other job, since the output of a stage within
+    a fused command isn't copied back from the stage directory.
+
+    """
+    jobs = list(jobs)
+    # The number of jobs requiring each file
+    required: Dict[str, int] = {}
+    for job in jobs:
+        for path in {os.path.normpath(c.requires) for c in job.commands if c.requires}:
+            required[path] = required.get(path, 0) + 1
+    previous: Optional[Job] = None
+    for job in jobs:
+        if previous is not None:
+            fused = _fuse_commands(previous.commands, job.commands)
+            if fused is not None and (job.scheduler_options or {}).get("stage"):
+                # The job being fused is one of the jobs requiring each output
+                if any(
+                    required.get(os.path.normpath(command.creates), 0) > 1
+                    for command in previous.commands
+                ):
+                    logger.info("Not fusing staged job with outputs required elsewhere")
+                    fused = None
+            options = None
+            if fused is not None:
+                options = _fused_options(previous, job)
+            if fused is None or options is None:
+                yield previous
+            else:
+                logger.info("Fusing job of %d commands with the previous", len(fused))
+                job = previous.with_commands(fused, options, shard=previous.shard)
+        previous = job
+    if previous is not None:
+        yield previous
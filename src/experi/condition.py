@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Conditions on the values of variables used by the ``where`` key.
+
+A condition is a python expression using the names of variables, like
+``temperature > 0.5 * pressure and crystal != "liquid"``. Only a small subset of python
+is supported; arithmetic, comparisons, boolean logic, membership of a literal list and
+a few mathematical functions. The expression is parsed once and evaluated by walking the
+syntax tree, so no arbitrary code is executed.
+
+Every operation is performed using numpy, so the same condition can be evaluated either
+for a single combination of values, or for arrays of values in a single pass.
+
+"""
+
+import ast
+import operator
+import sys
+from typing import Any, Callable, Dict, List, Set, Union
+
+import numpy as np
+
+if sys.version_info >= (3, 8):
+    _CONSTANTS: tuple = (ast.Constant,)
+else:
+    # Older versions of python have a separate node for each type of literal
+    _CONSTANTS = (ast.Num, ast.Str, ast.NameConstant)
+
+
+def _constant_value(node: ast.AST) -> Any:
+    if sys.version_info >= (3, 8):
+        return node.value  # type: ignore
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Str):
+        return node.s
+    return node.value
+
+
+_BINARY_OPERATORS: Dict[type, Callable] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_UNARY_OPERATORS: Dict[type, Callable] = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: np.logical_not,
+}
+
+_COMPARISONS: Dict[type, Callable] = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+_FUNCTIONS: Dict[str, Callable] = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "min": np.minimum,
+    "max": np.maximum,
+}
+
+
+class Condition:
+    """A condition on the values of variables.
+
+    Args:
+        expression: The python expression of the condition.
+
+    Raises:
+        ValueError: When the expression isn't valid or uses unsupported syntax.
+
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        try:
+            self._tree = ast.parse(str(expression).strip(), mode="eval").body
+        except SyntaxError:
+            raise ValueError(f"The condition '{expression}' is not a valid expression")
+        self.variables: Set[str] = set()
+        self._check(self._tree)
+
+    def _check(self, node: ast.AST) -> None:
+        """Ensure only supported syntax is used, collecting the names of variables."""
+        if isinstance(node, ast.Name):
+            self.variables.add(node.id)
+        elif isinstance(node, _CONSTANTS):
+            value = _constant_value(node)
+            if not isinstance(value, (int, float, str, bool)):
+                raise ValueError(f"The value {value!r} is not supported in a condition")
+        elif isinstance(node, ast.BoolOp):
+            for value in node.values:
+                self._check(value)
+        elif isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            self._check(node.operand)
+        elif isinstance(node, ast.Compare):
+            self._check(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    if not isinstance(comparator, (ast.List, ast.Tuple, ast.Set)):
+                        raise ValueError(
+                            f"Membership in '{self.expression}' needs a literal list"
+                        )
+                    for item in comparator.elts:
+                        self._check(item)
+                elif type(op) in _COMPARISONS:
+                    self._check(comparator)
+                else:
+                    raise ValueError(
+                        f"The comparison in '{self.expression}' is not supported"
+                    )
+        elif (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in _FUNCTIONS
+            and not node.keywords
+        ):
+            for arg in node.args:
+                self._check(arg)
+        else:
+            raise ValueError(
+                f"The expression '{ast.dump(node)}' is not supported in a condition. "
+                f"Functions which can be used are {sorted(_FUNCTIONS)}"
+            )
+
+    def evaluate(self, values: Dict[str, Any]) -> Any:
+        """Evaluate the condition for the values of the variables.
+
+        The values can be either scalars or numpy arrays of the same length, returning
+        a boolean or an array of booleans.
+
+        """
+        missing = self.variables - set(values.keys())
+        if missing:
+            raise ValueError(
+                f"The condition '{self.expression}' uses undefined variables {missing}"
+            )
+        return self._evaluate(self._tree, values)
+
+    def __call__(self, values: Dict[str, Any]) -> bool:
+        return bool(self.evaluate(values))
+
+    def _evaluate(self, node: ast.AST, values: Dict[str, Any]) -> Any:
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        if isinstance(node, _CONSTANTS):
+            return _constant_value(node)
+        if isinstance(node, ast.BoolOp):
+            function = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = self._evaluate(node.values[0], values)
+            for value in node.values[1:]:
+                result = function(result, self._evaluate(value, values))
+            return result
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPERATORS[type(node.op)](
+                self._evaluate(node.left, values), self._evaluate(node.right, values)
+            )
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, values))
+        if isinstance(node, ast.Compare):
+            return self._compare(node, values)
+        if isinstance(node, ast.Call):
+            assert isinstance(node.func, ast.Name)
+            args = [self._evaluate(arg, values) for arg in node.args]
+            return _FUNCTIONS[node.func.id](*args)
+        raise ValueError(f"Unable to evaluate '{self.expression}'")
+
+    def _compare(self, node: ast.Compare, values: Dict[str, Any]) -> Any:
+        # A chained comparison like a < b < c is (a < b) and (b < c)
+        result: Any = True
+        left = self._evaluate(node.left, values)
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                assert isinstance(comparator, (ast.List, ast.Tuple, ast.Set))
+                items = [self._evaluate(item, values) for item in comparator.elts]
+                current: Any = np.isin(left, items)
+                if isinstance(op, ast.NotIn):
+                    current = np.logical_not(current)
+                right = items
+            else:
+                right = self._evaluate(comparator, values)
+                current = _COMPARISONS[type(op)](left, right)
+            result = np.logical_and(result, current)
+            left = right
+        return result
+
+
+def parse_conditions(where: Union[str, List[str]]) -> List[Condition]:
+    """Parse the value of a where key, which is either a condition or a list."""
+    if isinstance(where, list):
+        return [Condition(expression) for expression in where]
+    return [Condition(where)]
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Remove duplicates from very large sequences using bounded memory.
+
+The digest of each item is kept in memory until there are more than a threshold of
+them, after which the digests are moved to a temporary SQLite database on disk. SQLite
+only keeps a small cache of the database in memory, so the memory used is bounded
+regardless of the number of items, while the order of the first occurrence of each item
+is retained.
+
+"""
+
+import hashlib
+import logging
+import sqlite3
+from typing import Callable, Iterable, Iterator, Optional, Set, TypeVar
+
+from .commands import Command
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+T = TypeVar("T")
+
+# The number of digests kept in memory before moving them to disk
+MAX_KEYS = 2 ** 20
+
+
+class SeenSet:
+    """A set of keys which is moved to disk once it becomes large.
+
+    Only the SHA-1 digest of each key is stored, which is 20 bytes no matter the length
+    of the key.
+
+    Args:
+        max_keys: The number of keys stored in memory before moving them to disk.
+
+    """
+
+    def __init__(self, max_keys: int = MAX_KEYS) -> None:
+        self.max_keys = max_keys
+        self._seen: Set[bytes] = set()
+        self._db: Optional[sqlite3.Connection] = None
+        self._count = 0
+
+    @property
+    def on_disk(self) -> bool:
+        return self._db is not None
+
+    def _spill(self) -> None:
+        logger.debug("Moving %d keys to disk", len(self._seen))
+        # An empty filename is a temporary database on disk, removed once closed
+        self._db = sqlite3.connect("")
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._db.executemany("INSERT INTO seen VALUES (?)", ((d,) for d in self._seen))
+        self._seen = set()
+
+    def add(self, key: bytes) -> bool:
+        """Add a key to the set, returning whether it is new."""
+        digest = hashlib.sha1(key).digest()
+        if self._db is None:
+            if digest in self._seen:
+                return False
+            self._seen.add(digest)
+            if len(self._seen) > self.max_keys:
+                self._spill()
+        else:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO seen VALUES (?)", (digest,)
+            )
+            if cursor.rowcount == 0:
+                return False
+        self._count += 1
+        return True
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._seen = set()
+
+    def __enter__(self) -> "SeenSet":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def unique(
+    items: Iterable[T], key: Callable[[T], bytes], max_keys: int = MAX_KEYS
+) -> Iterator[T]:
+    """Yield the first occurrence of each item, comparing the key of each item."""
+    with SeenSet(max_keys) as seen:
+        for item in items:
+            if seen.add(key(item)):
+                yield item
+
+
+def command_key(command: Command) -> bytes:
+    """A key which is the same for commands which are equal."""
+    return "\0".join(command.cmd).encode()
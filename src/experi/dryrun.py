@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Summarise the jobs of an experiment without running them.
+
+Printing every command of a very large experiment is slow and too much output to be
+useful, so a summary of each job is created instead. This includes the number of
+commands, how many are skipped because their output exists, a sample of the commands
+and an estimate of the size of the scheduler file. The size is calculated from the
+length of the commands rather than creating the file, with each job only being iterated
+over once.
+
+"""
+
+import logging
+from typing import IO, Iterable, Iterator, List
+
+from .commands import Job
+from .scheduler import create_scheduler_file
+from .store import store_size
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+# The number of characters surrounding each command in the bash array of a job
+_ARRAY_OVERHEAD = len('"" \\\n')
+
+# The number of lines written to the output at a time
+CHUNK_SIZE = 2 ** 14
+
+
+def format_size(num_bytes: float) -> str:
+    """Format a number of bytes in human readable units like 1.2 MB."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024 or unit == "GB":
+            break
+        num_bytes /= 1024
+    if unit == "B":
+        return f"{num_bytes:.0f} {unit}"
+    return f"{num_bytes:.1f} {unit}"
+
+
+class JobSummary:
+    """The commands a job would run, along with the size of its scheduler file.
+
+    Args:
+        job: The job to summarise.
+        index: The position of the job within the experiment.
+        scheduler: The scheduler the job would be run with.
+        command_store: Whether the commands would be written to a command store.
+        num_samples: The number of commands to keep as examples.
+
+    """
+
+    def __init__(
+        self,
+        job: Job,
+        index: int,
+        scheduler: str = "shell",
+        command_store: bool = False,
+        num_samples: int = 3,
+    ) -> None:
+        self.index = index
+        self.scheduler = scheduler
+        self.command_store = command_store
+        self.num_commands = 0
+        self.num_complete = 0
+        self.samples: List[str] = []
+        self.command_bytes = 0
+
+        for command, complete in job.iter_complete():
+            if complete:
+                self.num_complete += 1
+                continue
+            self.num_commands += 1
+            command_str = str(command)
+            self.command_bytes += len(command_str.encode())
+            if len(self.samples) < num_samples:
+                self.samples.append(command_str)
+
+        self.script_size = 0
+        self.store_size = 0
+        if scheduler != "shell":
+            # The scheduler file without any commands, which are accounted for below
+            empty = job.with_commands([])
+            self.script_size = len(create_scheduler_file(scheduler, empty).encode())
+            if command_store:
+                self.store_size = store_size(self.num_commands, self.command_bytes)
+            else:
+                self.script_size += (
+                    self.command_bytes + _ARRAY_OVERHEAD * self.num_commands
+                )
+
+    def __str__(self) -> str:
+        lines = [f"Job {self.index}: {self.num_commands} commands"]
+        if self.num_complete:
+            lines[0] += f", {self.num_complete} skipped as complete"
+        if self.scheduler != "shell":
+            lines.append(f"  {self.scheduler} file: ~{format_size(self.script_size)}")
+            if self.command_store:
+                lines[-1] += f", command store: ~{format_size(self.store_size)}"
+        lines += [f"    {sample}" for sample in self.samples]
+        remaining = self.num_commands - len(self.samples)
+        if remaining > 0:
+            lines.append(f"    ... and {remaining} more")
+        return "\n".join(lines)
+
+
+def summarise_jobs(
+    jobs: Iterable[Job],
+    scheduler: str = "shell",
+    command_store: bool = False,
+    num_samples: int = 3,
+) -> Iterator[JobSummary]:
+    """Summarise each job of an experiment, see :class:`JobSummary`."""
+    for index, job in enumerate(jobs):
+        yield JobSummary(job, index, scheduler, command_store, num_samples)
+
+
+def format_summaries(summaries: Iterable[JobSummary]) -> str:
+    """Format the summaries of jobs, along with the total for the experiment."""
+    lines = []
+    num_commands = num_complete = 0
+    for summary in summaries:
+        lines.append(str(summary))
+        num_commands += summary.num_commands
+        num_complete += summary.num_complete
+    total = f"Total: {len(lines)} jobs, {num_commands} commands"
+    if num_complete:
+        total += f", {num_complete} skipped as complete"
+    lines.append(total)
+    return "\n".join(lines)
+
+
+def write_lines(
+    lines: Iterable[str], dst: IO[str], chunk_size: int = CHUNK_SIZE
+) -> int:
+    """Write lines to dst in chunks, returning the number of lines written.
+
+    Joining the lines into chunks avoids the overhead of a write, and a flush, for every
+    line, which dominates when printing very many commands.
+
+    """
+    num_lines = 0
+    chunk: List[str] = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            dst.write("\n".join(chunk) + "\n")
+            num_lines += len(chunk)
+            chunk = []
+    if chunk:
+        dst.write("\n".join(chunk) + "\n")
+        num_lines += len(chunk)
+    dst.flush()
+    return num_lines
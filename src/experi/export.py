@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Export the combinations of variables or the rendered commands to a file.
+
+The rows are written in chunks, each converted to the output format in a single
+operation, so the memory used is independent of the number of rows. The supported
+formats are
+
+- ``csv``, with a header of the column names,
+- ``jsonl``, a JSON object on each line, and
+- ``npy``, a numpy structured array with a field for each column.
+
+The rows are only generated once, since rendering the commands of an experiment is
+the slowest part of an export. For the ``csv`` and ``npy`` formats the columns, along
+with the type of each column for ``npy``, are only known once all the rows have been
+seen, so the values of the rows are written to a temporary file until the header of
+the output can be written.
+
+"""
+
+import csv
+import json
+import logging
+import pickle
+import tempfile
+from itertools import islice, zip_longest
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from .metrics import json_default
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+Rows = Callable[[], Iterator[Dict[str, Any]]]
+# The python types in each column, along with the longest string of each type
+ColumnTypes = Dict[str, Dict[type, int]]
+
+FORMATS = ["csv", "jsonl", "npy"]
+
+# The size of the buffer of the output file
+BUFFER_SIZE = 2 ** 20
+
+
+def infer_format(filename: PathLike) -> str:
+    """The format of a file from the extension."""
+    suffix = Path(filename).suffix.lstrip(".").lower()
+    if suffix == "json":
+        suffix = "jsonl"
+    if suffix not in FORMATS:
+        raise ValueError(
+            f"Unable to determine the format of '{filename}'. "
+            f"Possible extensions are {FORMATS}"
+        )
+    return suffix
+
+
+def get_columns(rows: Iterable[Dict[str, Any]]) -> List[str]:
+    """All the keys of the rows in the order they first occur."""
+    columns: Dict[str, None] = {}
+    _update_columns(columns, rows)
+    return list(columns)
+
+
+def _update_columns(columns: Dict[str, None], rows: Iterable[Dict[str, Any]]) -> None:
+    for row in rows:
+        if len(row) != len(columns) or any(key not in columns for key in row):
+            columns.update(dict.fromkeys(row))
+
+
+def _chunks(rows: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict]]:
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _spill(
+    rows: Rows, size: int, spill: IO[bytes]
+) -> Tuple[List[str], ColumnTypes, int]:
+    """Write the values of the rows to a temporary file in a single pass.
+
+    The values of each chunk are pickled in the order of the columns found so far, so
+    a row is shorter than the final columns when a column is first found after it.
+
+    Returns: The columns, the types of the values in each column and the number of rows.
+
+    """
+    columns: Dict[str, None] = {}
+    column_types: ColumnTypes = {}
+    num_rows = 0
+    for chunk in _chunks(rows(), size):
+        _update_columns(columns, chunk)
+        if num_rows > 0:
+            # The column is missing from all the rows already written
+            for col in columns:
+                column_types.setdefault(col, {float: 1})
+        _update_types(column_types, chunk, columns)
+        values = [tuple(row.get(col) for col in columns) for row in chunk]
+        pickle.dump(values, spill, protocol=pickle.HIGHEST_PROTOCOL)
+        num_rows += len(chunk)
+    return list(columns), column_types, num_rows
+
+
+def _unspill(spill: IO[bytes], columns: List[str]) -> Iterator[List[Tuple]]:
+    """The chunks of values written by :func:`_spill`, with a value for every column."""
+    spill.seek(0)
+    while True:
+        try:
+            values = pickle.load(spill)
+        except EOFError:
+            return
+        yield [tuple(v for _, v in zip_longest(columns, row)) for row in values]
+
+
+def _write_csv(rows: Rows, filename: PathLike, size: int) -> int:
+    with tempfile.TemporaryFile() as spill:
+        columns, _, num_rows = _spill(rows, size, spill)
+        with open(str(filename), "w", newline="", buffering=BUFFER_SIZE) as dst:
+            writer = csv.writer(dst)
+            writer.writerow(columns)
+            for values in _unspill(spill, columns):
+                writer.writerows(values)
+    return num_rows
+
+
+def _write_jsonl(rows: Rows, filename: PathLike, size: int) -> int:
+    num_rows = 0
+    with open(str(filename), "w", buffering=BUFFER_SIZE) as dst:
+        for chunk in _chunks(rows(), size):
+            dst.write(
+                "".join(json.dumps(row, default=json_default) + "\n" for row in chunk)
+            )
+            num_rows += len(chunk)
+    return num_rows
+
+
+def _column_type(values: Dict[type, int]) -> str:
+    """The numpy type of a column from the python types of the values in it."""
+    types = set(values)
+    if types <= {bool}:
+        return "?"
+    if types <= {int}:
+        return "i8"
+    if types <= {int, float}:
+        return "f8"
+    # A string long enough for every value
+    return f"U{max(values.values())}"
+
+
+def _update_types(
+    column_types: ColumnTypes, rows: Iterable[Dict[str, Any]], columns: Iterable[str]
+) -> None:
+    for row in rows:
+        for col in columns:
+            value = row.get(col)
+            if value is not None and hasattr(value, "item"):
+                value = value.item()
+            types = column_types.setdefault(col, {})
+            kind = type(value)
+            if value is None:
+                kind = float
+            elif kind not in (bool, int, float):
+                kind = str
+            types[kind] = max(types.get(kind, 1), len(str(value)))
+
+
+def infer_dtype(rows: Iterable[Dict[str, Any]], columns: List[str]) -> np.dtype:
+    """A structured dtype which can represent all the values of each column.
+
+    Columns containing only integers, floats or booleans are numeric, with any other
+    column being a string of the length of the longest value. A missing value in an
+    integer column makes it a float column with the missing value being NaN.
+
+    """
+    column_types: ColumnTypes = {col: {} for col in columns}
+    _update_types(column_types, rows, columns)
+    return _dtype(column_types, columns)
+
+
+def _dtype(column_types: ColumnTypes, columns: List[str]) -> np.dtype:
+    return np.dtype([(col, _column_type(column_types[col])) for col in columns])
+
+
+def _write_npy(rows: Rows, filename: PathLike, size: int) -> int:
+    with tempfile.TemporaryFile() as spill:
+        columns, column_types, num_rows = _spill(rows, size, spill)
+        dtype = _dtype(column_types, columns)
+        missing = [np.nan if dtype[col].kind == "f" else "" for col in columns]
+        header = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (num_rows,),
+        }
+        with open(str(filename), "wb", buffering=BUFFER_SIZE) as dst:
+            try:
+                np.lib.format.write_array_header_1_0(dst, header)
+            except ValueError:
+                # The header of version 1.0 is limited to 64KiB
+                np.lib.format.write_array_header_2_0(dst, header)
+            for values in _unspill(spill, columns):
+                array = np.array(
+                    [
+                        tuple(m if v is None else v for m, v in zip(missing, row))
+                        for row in values
+                    ],
+                    dtype=dtype,
+                )
+                dst.write(array.tobytes())
+    return num_rows
+
+
+def write_rows(
+    rows: Rows, filename: PathLike, fmt: str = None, chunk_size: int = 2 ** 16
+) -> int:
+    """Write rows to a file, returning the number of rows written.
+
+    Args:
+        rows: A function returning an iterator over the rows, which is called once.
+        filename: The file to write the rows to.
+        fmt: The format of the file, which is inferred from the extension when None.
+        chunk_size: The number of rows converted and written at a time.
+
+    """
+    if fmt is None:
+        fmt = infer_format(filename)
+    if fmt not in FORMATS:
+        raise ValueError(f"The format '{fmt}' is not supported, use one of {FORMATS}")
+
+    if fmt == "jsonl":
+        num_rows = _write_jsonl(rows, filename, chunk_size)
+    elif fmt == "csv":
+        num_rows = _write_csv(rows, filename, chunk_size)
+    else:
+        num_rows = _write_npy(rows, filename, chunk_size)
+    logger.debug("Wrote %d rows to %s", num_rows, filename)
+    return num_rows
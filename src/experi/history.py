@@ -0,0 +1,197 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Predict the runtime of commands from the records of previous runs.
+
+The records are those written to a metrics file (see :mod:`experi.metrics`). A command
+which has run before is predicted to take the mean wall time of the successful runs.
+For a command which hasn't run before, the runtime is predicted from the other commands
+generated from the same template, using a main effects model of the logarithm of the
+wall time. The effect of each variable is the mean deviation of the commands with each
+value from the mean over all commands, with a linear fit of the effects used for
+numeric values which haven't been seen. The memory used by a command is predicted in
+the same way.
+
+Ordering the commands of a job from the longest predicted runtime to the shortest, the
+longest processing time first rule, reduces the time for all the commands to complete
+when they are run in parallel. The predictions are also used to request resources from
+a scheduler, see :func:`experi.scheduler.split_by_resources`.
+
+"""
+
+import json
+import logging
+import math
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple, Union, cast
+
+import numpy as np
+
+from .commands import Command, digest
+from .metrics import json_default, read_records
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# The resources which are predicted from the records
+RESOURCES = ("wall_time", "max_rss")
+
+# The minimum value of a resource, preventing the logarithm of very short commands
+# dominating the model.
+MIN_VALUE = 1e-3
+
+
+def _normalise(value: Any) -> Hashable:
+    """Convert the value of a variable to a form which can be compared with records."""
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True, default=json_default)
+    return value
+
+
+def _is_numeric(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _VariableEffect:
+    """The effect of the value of a single variable on the log of a resource."""
+
+    def __init__(self, samples: List[Tuple[Hashable, float]]) -> None:
+        residuals: Dict[Hashable, List[float]] = {}
+        for value, residual in samples:
+            residuals.setdefault(value, []).append(residual)
+        self.by_value = {
+            value: sum(values) / len(values) for value, values in residuals.items()
+        }
+
+        self.fit: Optional[np.ndarray] = None
+        numeric = [value for value in self.by_value if _is_numeric(value)]
+        if len(numeric) == len(self.by_value) and len(numeric) > 1:
+            self.fit = np.polyfit(
+                [cast(float, value) for value in numeric],
+                [self.by_value[value] for value in numeric],
+                deg=1,
+            )
+
+    def predict(self, value: Hashable) -> float:
+        if value in self.by_value:
+            return self.by_value[value]
+        if self.fit is not None and _is_numeric(value):
+            return float(np.polyval(self.fit, cast(float, value)))
+        # Nothing is known about this value
+        return 0.0
+
+
+class _TemplateModel:
+    """A main effects model of the log of a resource used by a template's commands."""
+
+    def __init__(self, samples: List[Tuple[Dict[str, Hashable], float]]) -> None:
+        log_values = [math.log(max(value, MIN_VALUE)) for _, value in samples]
+        self.mean = sum(log_values) / len(log_values)
+
+        residuals: Dict[str, List[Tuple[Hashable, float]]] = {}
+        for (variables, _), log_value in zip(samples, log_values):
+            for name, value in variables.items():
+                residuals.setdefault(name, []).append((value, log_value - self.mean))
+        self.effects = {
+            name: _VariableEffect(values) for name, values in residuals.items()
+        }
+
+    def predict(self, variables: Dict[str, Hashable]) -> float:
+        log_value = self.mean
+        for name, value in variables.items():
+            effect = self.effects.get(name)
+            if effect is not None:
+                log_value += effect.predict(value)
+        return math.exp(log_value)
+
+
+class RuntimeModel:
+    """Predict the resources used by commands from the records of previous runs.
+
+    The resources which can be predicted are the wall time in seconds and the maximum
+    resident set size (``max_rss``) in kilobytes. Only the records of commands which
+    completed successfully are used, since a command which failed may not have run to
+    completion.
+
+    """
+
+    def __init__(self, records: Iterable[Dict[str, Any]]) -> None:
+        usage: Dict[str, Dict[str, List[float]]] = {key: {} for key in RESOURCES}
+        samples: Dict[str, Dict[str, List[Tuple[Dict[str, Hashable], float]]]] = {
+            key: {} for key in RESOURCES
+        }
+        for record in records:
+            if record.get("exit_code") != 0:
+                continue
+            variables = {
+                name: _normalise(value)
+                for name, value in record.get("variables", {}).items()
+            }
+            for resource in RESOURCES:
+                if record.get(resource) is None:
+                    continue
+                value = record[resource]
+                usage[resource].setdefault(record["hash"], []).append(value)
+                if record.get("template"):
+                    samples[resource].setdefault(record["template"], []).append(
+                        (variables, value)
+                    )
+
+        self.means = {
+            resource: {key: sum(values) / len(values) for key, values in by.items()}
+            for resource, by in usage.items()
+        }
+        self.templates = {
+            resource: {key: _TemplateModel(values) for key, values in by.items()}
+            for resource, by in samples.items()
+        }
+
+    @classmethod
+    def from_file(cls, metrics_file: PathLike) -> "RuntimeModel":
+        """Create a model from a metrics file, which may not exist yet."""
+        if not Path(metrics_file).is_file():
+            logger.info("No runtime history in %s", metrics_file)
+            return cls([])
+        return cls(read_records(metrics_file))
+
+    def predict(self, command: Command, resource: str = "wall_time") -> Optional[float]:
+        """The predicted use of a resource by a command.
+
+        Returns: The prediction, or None when there is no history for the command.
+
+        """
+        if resource not in RESOURCES:
+            raise ValueError(
+                f"The resource '{resource}' can't be predicted. "
+                f"Possible values are {list(RESOURCES)}"
+            )
+        # The records are identified by the hash of the command string
+        value = self.means[resource].get(digest(str(command)))
+        if value is not None:
+            return value
+        model = self.templates[resource].get(command.template_digest())
+        if model is None:
+            return None
+        return model.predict(
+            {name: _normalise(value) for name, value in command.variables.items()}
+        )
+
+    def sort_key(self, command: Command) -> float:
+        """A key sorting commands from the longest predicted runtime to the shortest.
+
+        Commands without a prediction sort first, since they could take any time.
+
+        """
+        wall_time = self.predict(command)
+        if wall_time is None:
+            return -math.inf
+        return -wall_time
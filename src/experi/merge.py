@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Merge the jobs of multiple experiments so they are submitted together.
+
+Each experiment is a sequence of jobs, with each job starting once the previous job
+completes. The experiments are merged position by position, so the first jobs of every
+experiment are combined, then the second jobs and so on. Every job still starts after
+all the jobs before it in its own experiment, although it can now also wait for the
+jobs of the other experiments at the same position.
+
+Only jobs with the same scheduler options, apart from the name, are combined into a
+single job, with the jobs at the same position with different options kept as
+separate jobs running one after the other. When recording metrics the commands of an
+array job are recorded with a single template, so jobs from different templates are
+also kept separate. The commands are deduplicated across all
+the experiments, keeping the first occurrence of each command so it runs before any
+job which could depend on it.
+
+"""
+
+import json
+import logging
+from itertools import zip_longest
+from typing import Dict, Iterable, Iterator, List
+
+from .commands import Command, Job
+from .dedup import MAX_KEYS, SeenSet, command_key
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+def merge_key(job: Job, by_template: bool = False) -> str:
+    """A key which is the same for jobs which can be combined into a single job.
+
+    When by_template is True, only jobs with commands from the same templates have
+    the same key.
+
+    """
+    options = {
+        key: value
+        for key, value in (job.scheduler_options or {}).items()
+        if key != "name"
+    }
+    templates: List[str] = []
+    if by_template:
+        templates = sorted({command.template_digest() for command in job.commands})
+    return json.dumps(
+        [options, job.use_dependencies, job.max_concurrent, job.jitter, templates],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def merge_experiments(
+    experiments: Iterable[Iterable[Job]],
+    max_keys: int = MAX_KEYS,
+    by_template: bool = False,
+) -> Iterator[Job]:
+    """Combine the jobs of multiple experiments, removing duplicate commands.
+
+    Args:
+        experiments: The jobs of each experiment.
+        max_keys: The number of commands kept in memory when removing the duplicates,
+            see :class:`~.dedup.SeenSet`.
+        by_template: Whether to only combine jobs with commands from the same
+            templates, which is required when recording metrics.
+
+    Returns: The combined jobs, with any job left empty by removing duplicates dropped.
+
+    """
+    with SeenSet(max_keys) as seen:
+        for position, jobs in enumerate(zip_longest(*experiments)):
+            groups: Dict[str, List[Job]] = {}
+            for job in jobs:
+                if job is not None:
+                    groups.setdefault(merge_key(job, by_template), []).append(job)
+
+            for group in groups.values():
+                commands: List[Command] = []
+                num_commands = 0
+                for job in group:
+                    num_commands += len(job.commands)
+                    commands += [c for c in job.commands if seen.add(command_key(c))]
+                logger.debug(
+                    "Merged %d jobs at position %d with %d of %d commands unique",
+                    len(group),
+                    position,
+                    len(commands),
+                    num_commands,
+                )
+                if commands:
+                    yield group[0].with_commands(commands, shard=group[0].shard)
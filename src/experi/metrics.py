@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Record the resources used by each command.
+
+Each command is run as a child process which is waited on using :func:`os.wait4`,
+providing the resource usage of the command along with any processes it waited on.
+The usage is appended as a single line of JSON to a metrics file, keyed by the digest of
+the command and the values of the variables, so the resources can be summarised for
+different values of the variables.
+
+"""
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from .commands import digest
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+
+def _exit_code(status: int) -> int:
+    """Convert the status from a wait call to an exit code like subprocess."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_command(
+    cmds: List[str],
+    shell: str = "bash",
+    directory: PathLike = None,
+    started: Optional[Callable[[subprocess.Popen], None]] = None,
+    new_session: bool = False,
+    echo: bool = True,
+) -> Dict[str, Any]:
+    """Run each component of a command in a shell recording the resources used.
+
+    The components are run in order, stopping at the first which fails.
+
+    Args:
+        cmds: The components of the command.
+        shell: The shell in which to run each component.
+        directory: The directory in which to run the command.
+        started: A function called with the process of each component once started.
+        new_session: Run each component in a new session, so it along with any
+            children can be killed as a process group.
+        echo: Print each component before running it.
+
+    Returns: The resources used by the command, including the exit code.
+
+    """
+    usage: Dict[str, Any] = {
+        "exit_code": 0,
+        "start_time": time.time(),
+        "wall_time": 0.0,
+        "user_time": 0.0,
+        "sys_time": 0.0,
+        "max_rss": 0,
+        "host": socket.gethostname(),
+    }
+    start = time.perf_counter()
+    for cmd in cmds:
+        logger.info(cmd)
+        if echo:
+            print(f"{shell} -c '{cmd}'", flush=True)
+        process = subprocess.Popen(
+            [shell, "-c", f"{cmd}"],
+            cwd=None if directory is None else str(directory),
+            start_new_session=new_session,
+        )
+        if started is not None:
+            started(process)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = _exit_code(status)
+
+        usage["user_time"] += rusage.ru_utime
+        usage["sys_time"] += rusage.ru_stime
+        # The maximum resident set size in kilobytes
+        usage["max_rss"] = max(usage["max_rss"], rusage.ru_maxrss)
+        usage["exit_code"] = process.returncode
+        if process.returncode != 0:
+            break
+    usage["wall_time"] = time.perf_counter() - start
+    return usage
+
+
+def json_default(value: Any) -> Any:
+    """Convert values which the json module can't serialise."""
+    # Numpy values are converted to the equivalent python type
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def create_record(
+    command: str,
+    variables: Dict[str, Any],
+    usage: Dict[str, Any],
+    template: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Combine the resources used by a command with the values identifying it.
+
+    The hash is the digest of the command string, which is all that is known when
+    recording a command run by the scheduler. The template is the digest of the command
+    before the variables were substituted, see
+    :meth:`~.commands.Command.template_digest`, which is only included when known.
+
+    """
+    record: Dict[str, Any] = OrderedDict(hash=digest(command))
+    if template is not None:
+        record["template"] = template
+    record["command"] = command
+    record["variables"] = variables
+    record.update(usage)
+    return record
+
+
+def write_record(metrics_file: PathLike, record: Dict[str, Any]) -> None:
+    """Append a record to the metrics file.
+
+    Each record is written with a single call to write on a file opened for appending,
+    so records from concurrent processes aren't interleaved.
+
+    """
+    line = json.dumps(record, default=json_default) + "\n"
+    with open(str(metrics_file), "a") as dst:
+        dst.write(line)
+
+
+def read_records(metrics_file: PathLike) -> Iterator[Dict[str, Any]]:
+    """Read each of the records from a metrics file."""
+    with open(str(metrics_file)) as src:
+        for line in src:
+            if line.strip():
+                yield json.loads(line)
+
+
+def summarise(records: Iterator[Dict[str, Any]], by: List[str]) -> List[Dict[str, Any]]:
+    """Summarise the runtime of commands grouped by the values of variables.
+
+    Args:
+        records: The records from a metrics file.
+        by: The variables to group the records by. When empty all the records are a
+            single group.
+
+    Returns: A row for each group, ordered by the values of the variables.
+
+    """
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for record in records:
+        key = tuple(record["variables"].get(var) for var in by)
+        groups.setdefault(key, []).append(record)
+
+    summary = []
+    for key in sorted(groups, key=lambda k: [(v is None, str(type(v)), v) for v in k]):
+        group = groups[key]
+        wall_times = [record["wall_time"] for record in group]
+        row: Dict[str, Any] = OrderedDict(zip(by, key))
+        row["count"] = len(group)
+        row["failed"] = sum(record["exit_code"] != 0 for record in group)
+        row["mean_wall_time"] = sum(wall_times) / len(group)
+        row["max_wall_time"] = max(wall_times)
+        row["mean_cpu_time"] = sum(
+            record["user_time"] + record["sys_time"] for record in group
+        ) / len(group)
+        row["max_rss"] = max(record["max_rss"] for record in group)
+        summary.append(row)
+    return summary
+
+
+def format_table(rows: List[Dict[str, Any]]) -> str:
+    """Format a list of rows as a plain text table."""
+    if not rows:
+        return ""
+
+    def _format(value: Any) -> str:
+        if isinstance(value, float):
+            return f"{value:.3f}"
+        return str(value)
+
+    columns = list(rows[0].keys())
+    cells = [columns] + [[_format(row[col]) for col in columns] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(row, widths))
+        for row in cells
+    )
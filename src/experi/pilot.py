@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Run the commands of a job from a queue on a shared filesystem.
+
+Rather than submitting an array job with an element for every command, the commands of
+a job are written to a queue directory and a small number of long running workers are
+submitted. Each worker claims the next batch of commands by renaming it from the
+``pending`` directory, which is atomic on a POSIX filesystem so each batch is only
+claimed by a single worker, running commands until the queue is empty.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from .callables import PythonCommand, call_function
+from .commands import Job
+from .metrics import create_record, json_default, run_command, write_record
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def create_queue(job: Job, queue_dir: Path, batch_size: int = 1) -> int:
+    """Write the commands of a job to a queue directory.
+
+    Any existing queue in the directory is removed before the new queue is created.
+
+    Args:
+        job: The job containing the commands to queue.
+        queue_dir: The directory in which to create the queue.
+        batch_size: The number of commands a worker claims at a time.
+
+    Returns: The number of batches in the queue.
+
+    """
+    if batch_size < 1:
+        raise ValueError(f"The batch size needs to be at least 1, got {batch_size}")
+
+    queue_dir = Path(queue_dir)
+    if queue_dir.exists():
+        shutil.rmtree(str(queue_dir))
+    for state in [PENDING, RUNNING, DONE, FAILED]:
+        (queue_dir / state).mkdir(parents=True)
+
+    commands = []
+    for command in job:
+        entry: Dict[str, Any] = {
+            "cmd": command.cmd,
+            "variables": command.variables,
+            "template": command.template_digest(),
+        }
+        if isinstance(command, PythonCommand):
+            entry["python"] = {"function": command.function, "kwargs": command.kwargs}
+        commands.append(entry)
+    num_batches = 0
+    for start in range(0, len(commands), batch_size):
+        fname = f"{num_batches:06d}.json"
+        # Write outside the pending directory so a batch is only visible once complete
+        tmp_file = queue_dir / fname
+        tmp_file.write_text(
+            json.dumps(commands[start : start + batch_size], default=json_default)
+        )
+        os.rename(str(tmp_file), str(queue_dir / PENDING / fname))
+        num_batches += 1
+
+    logger.debug("Created queue %s with %d batches", queue_dir, num_batches)
+    return num_batches
+
+
+def claim_batch(
+    queue_dir: Path, worker: str, pending: List[str] = None
+) -> Optional[Path]:
+    """Claim the next batch of commands in the queue.
+
+    Listing a large pending directory is slow, so rather than listing it for every
+    claim, the names of the pending batches can be kept between claims in pending,
+    which is in reverse order so the next name is at the end. The names are tried in
+    order, with the directory only listed again once they have all been tried.
+
+    Returns: The path of the claimed batch, or None when the queue is empty.
+
+    """
+    queue_dir = Path(queue_dir)
+    if pending is None:
+        pending = []
+    listed = False
+    while True:
+        if not pending:
+            if listed:
+                return None
+            pending.extend(sorted(os.listdir(str(queue_dir / PENDING)), reverse=True))
+            listed = True
+            continue
+        fname = pending.pop()
+        claimed = queue_dir / RUNNING / f"{Path(fname).stem}.{worker}.json"
+        try:
+            os.rename(str(queue_dir / PENDING / fname), str(claimed))
+        except FileNotFoundError:
+            # Another worker has claimed this batch
+            continue
+        return claimed
+
+
+def run_batch(
+    commands: List[Dict[str, Any]],
+    shell: str = "bash",
+    metrics_file: Optional[PathLike] = None,
+) -> int:
+    """Run each of the commands in a batch.
+
+    Every command in the batch is run, even when a previous command fails, matching the
+    behaviour of an array job. Commands calling a python function are called within the
+    worker, so the module of the function is only imported once by each worker.
+
+    Returns: The number of commands which failed.
+
+    """
+    failed = 0
+    for command in commands:
+        if command.get("python") is not None:
+            python = command["python"]
+            usage = call_function(python["function"], python["kwargs"], Path.cwd())
+        else:
+            usage = run_command(command["cmd"], shell)
+        if metrics_file is not None:
+            record = create_record(
+                " && ".join(command["cmd"]).strip(),
+                command["variables"],
+                usage,
+                command.get("template"),
+            )
+            write_record(metrics_file, record)
+        if usage["exit_code"] != 0:
+            logger.error("Command failed: %s", command["cmd"])
+            failed += 1
+    return failed
+
+
+def run_worker(
+    queue_dir: Path,
+    shell: str = "bash",
+    worker: str = None,
+    metrics_file: Optional[PathLike] = None,
+    max_batches: int = None,
+) -> int:
+    """Run batches of commands from the queue until it is empty.
+
+    Once a batch has run it is moved into the ``done`` directory, or the ``failed``
+    directory when one of the commands fails.
+
+    Args:
+        queue_dir: The directory containing the queue.
+        shell: The shell in which to run each command.
+        worker: An identifier for the worker, which defaults to the hostname and pid.
+        metrics_file: A file to append the resources used by each command.
+        max_batches: The number of batches run before stopping, with no limit when
+            None.
+
+    Returns: The number of commands which failed.
+
+    """
+    queue_dir = Path(queue_dir)
+    if worker is None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+
+    failed = 0
+    num_batches = 0
+    pending: List[str] = []
+    while max_batches is None or num_batches < max_batches:
+        batch = claim_batch(queue_dir, worker, pending)
+        if batch is None:
+            break
+        logger.debug("Worker %s claimed %s", worker, batch.name)
+        batch_failed = run_batch(json.loads(batch.read_text()), shell, metrics_file)
+
+        if batch_failed:
+            os.rename(str(batch), str(queue_dir / FAILED / batch.name))
+        else:
+            os.rename(str(batch), str(queue_dir / DONE / batch.name))
+        failed += batch_failed
+        num_batches += 1
+
+    return failed
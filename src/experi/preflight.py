@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Check the requires input of every command exists before running any of them.
+
+A command with a missing input will fail, although when submitted to a scheduler this
+only happens after waiting in the queue and starting on a node. Instead the inputs are
+checked before any job is submitted, with a command being able to run when its input
+
+- already exists,
+- is created by a command in an earlier job, which always runs first.
+
+The existence of every input is found by listing each directory containing an input a
+single time, rather than checking each file separately, which is much faster on a
+parallel filesystem.
+
+A command which requires an input created by a command in the same or a later job can't
+run until the other job completes, so it is either skipped or deferred to a new job
+following the job creating the input. A command requiring the output of a deferred
+command is deferred again, to a job following the deferred job. Commands with an
+input which doesn't exist and isn't created by any command are always skipped.
+
+"""
+
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from .commands import Command, Job
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+MODES = ["skip", "defer"]
+
+# The number of missing inputs listed in the report
+NUM_REPORTED = 5
+
+# The job a command runs after, along with the number of deferred jobs it follows
+Slot = Tuple[int, int]
+
+
+def find_existing(paths: Iterable[str], directory: PathLike = ".") -> Set[str]:
+    """The paths, relative to directory, which exist.
+
+    Each directory containing one of the paths is listed once.
+
+    """
+    by_parent: Dict[str, Set[str]] = {}
+    for path in paths:
+        parent, name = os.path.split(os.path.normpath(path))
+        by_parent.setdefault(parent, set()).add(name)
+
+    existing: Set[str] = set()
+    for parent, names in by_parent.items():
+        try:
+            with os.scandir(os.path.join(str(directory), parent)) as entries:
+                found = names & {entry.name for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        existing |= {os.path.join(parent, name) for name in found}
+    return existing
+
+
+def _requires(command: Command) -> str:
+    requires = command.requires
+    return os.path.normpath(requires) if requires else ""
+
+
+def _command_slots(
+    jobs: List[Job], existing: Set[str], mode: str
+) -> Dict[Tuple[int, int], Optional[Slot]]:
+    """The slot each command runs in, keyed by the job and position of the command.
+
+    The slot of a command is after the earliest slot creating its input, so a command
+    requiring the output of a deferred command is also deferred. Commands which can't
+    run have a slot of None, including the commands within a cycle of requirements.
+
+    """
+    creators: Dict[str, List[Tuple[int, int]]] = {}
+    for index, job in enumerate(jobs):
+        for position, command in enumerate(job.commands):
+            if command.creates:
+                key = os.path.normpath(command.creates)
+                creators.setdefault(key, []).append((index, position))
+
+    slots: Dict[Tuple[int, int], Optional[Slot]] = {}
+    visiting: Set[Tuple[int, int]] = set()
+    starts = [(i, p) for i, job in enumerate(jobs) for p in range(len(job.commands))]
+    for start in starts:
+        # The slots of the creators of an input are found before the slot requiring it,
+        # using a stack rather than recursion since a chain of commands can be long.
+        stack = [start]
+        while stack:
+            current = stack[-1]
+            if current in slots:
+                stack.pop()
+                continue
+            index, position = current
+            requires = _requires(jobs[index].commands[position])
+            if not requires or requires in existing:
+                slots[current] = (index, 0)
+                stack.pop()
+                continue
+            visiting.add(current)
+            # A creator already being visited requires this command, forming a cycle
+            pending = [
+                creator
+                for creator in creators.get(requires, [])
+                if creator not in slots and creator not in visiting
+            ]
+            if pending:
+                stack.extend(pending)
+                continue
+            created = (slots.get(creator) for creator in creators.get(requires, []))
+            earliest = min((s for s in created if s is not None), default=None)
+            slot: Optional[Slot] = None
+            if earliest is not None and earliest < (index, 0):
+                slot = (index, 0)
+            elif earliest is not None and mode == "defer":
+                slot = (earliest[0], earliest[1] + 1)
+            slots[current] = slot
+            visiting.discard(current)
+            stack.pop()
+    return slots
+
+
+def check_requires(
+    jobs: Iterable[Job], directory: PathLike = ".", mode: str = "skip"
+) -> Iterator[Job]:
+    """Remove the commands of jobs which can't run because their input is missing.
+
+    Args:
+        jobs: The jobs of the experiment.
+        directory: The directory the commands are run in.
+        mode: Either skip the commands with an input created by the same or a later
+            job, or defer them to a new job after the job creating the input.
+
+    Returns: The jobs with only the commands which can run, with any empty job removed.
+        A deferred command keeps the scheduler options of its own job.
+
+    """
+    if mode not in MODES:
+        raise ValueError(f"The mode '{mode}' is not supported, use one of {MODES}")
+    jobs = list(jobs)
+
+    existing = find_existing(
+        {_requires(c) for job in jobs for c in job.commands if c.requires}, directory
+    )
+    slots = _command_slots(jobs, existing, mode)
+
+    missing: List[str] = []
+    # The commands of each job in each slot, with the slots run in order
+    placed: Dict[Slot, Dict[int, List[Command]]] = {}
+    for index, job in enumerate(jobs):
+        for position, command in enumerate(job.commands):
+            slot = slots[(index, position)]
+            if slot is None:
+                missing.append(_requires(command))
+            else:
+                placed.setdefault(slot, {}).setdefault(index, []).append(command)
+
+    for slot in sorted(placed):
+        for index, commands in placed[slot].items():
+            job = jobs[index]
+            if slot[1] > 0:
+                logger.info(
+                    "Deferring %d commands of job %d until job %d completes",
+                    len(commands),
+                    index,
+                    slot[0],
+                )
+            yield job.with_commands(commands, shard=job.shard)
+
+    if missing:
+        logger.warning(
+            "Skipping %d commands with missing requires files, including %s",
+            len(missing),
+            ", ".join(missing[:NUM_REPORTED]),
+        )
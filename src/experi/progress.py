@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Display the progress of the commands in a job running in the shell.
+
+On a terminal the progress is a single status line which is refreshed in place, while
+for other streams like a log file a line is written periodically. The display is only
+updated once the refresh interval has passed, so the overhead of tracking the progress
+is a comparison of times for each command.
+
+"""
+
+import sys
+import time
+from collections import deque
+from typing import Deque, Optional, TextIO
+
+
+def _format_time(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Progress:
+    """Track and display the progress of the commands in a job.
+
+    Args:
+        name: The name of the job displayed in the status.
+        total: The total number of commands in the job.
+        stream: Where to write the status, defaulting to stderr.
+        interval: The minimum time in seconds between updates of the status, which
+            defaults to 0.1s on a terminal, and 10s otherwise.
+        window: The number of completed commands in the moving average of durations.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        total: int,
+        stream: TextIO = None,
+        interval: Optional[float] = None,
+        window: int = 100,
+    ) -> None:
+        self.name = name
+        self.total = total
+        self.stream = stream if stream is not None else sys.stderr
+        self.is_tty = self.stream.isatty()
+        if interval is None:
+            interval = 0.1 if self.is_tty else 10.0
+        self.interval = interval
+
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self.durations: Deque[float] = deque(maxlen=window)
+        self.start_time = time.perf_counter()
+        self._last_update = -float("inf")
+
+    @property
+    def completed(self) -> int:
+        return self.done + self.failed
+
+    def rate(self) -> float:
+        """The number of commands completed per second."""
+        elapsed = time.perf_counter() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.completed / elapsed
+
+    def eta(self) -> Optional[float]:
+        """The estimated time in seconds until all the commands have completed.
+
+        This uses the moving average of the durations of the completed commands,
+        assuming the commands continue to run with the current concurrency.
+
+        """
+        if not self.durations:
+            return None
+        mean_duration = sum(self.durations) / len(self.durations)
+        remaining = self.total - self.completed
+        return remaining * mean_duration / max(self.running, 1)
+
+    def status(self) -> str:
+        eta = self.eta()
+        return (
+            f"{self.name}: {self.completed}/{self.total} "
+            f"(done {self.done}, running {self.running}, failed {self.failed}) "
+            f"{self.rate():.1f} cmd/s ETA {'-' if eta is None else _format_time(eta)}"
+        )
+
+    def start(self) -> None:
+        """Record a command starting to run."""
+        self.running += 1
+        self.update()
+
+    def finish(self, duration: float, failed: bool = False) -> None:
+        """Record a command finishing after running for duration seconds."""
+        self.running -= 1
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+        self.durations.append(duration)
+        self.update()
+
+    def update(self, force: bool = False) -> None:
+        """Write the status when the refresh interval has passed."""
+        now = time.perf_counter()
+        if not force and now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        if self.is_tty:
+            # Return to the start of the line and clear it before writing
+            self.stream.write("\r\033[K" + self.status())
+        else:
+            self.stream.write(self.status() + "\n")
+        self.stream.flush()
+
+    def close(self) -> None:
+        """Write the final status."""
+        self.update(force=True)
+        if self.is_tty:
+            self.stream.write("\n")
+            self.stream.flush()
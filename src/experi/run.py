@@ -8,22 +8,79 @@
 
 """Run an experiment varying a number of variables."""
 
+import hashlib
+import json
 import logging
 import os
+import random
 import shutil
+import signal
 import subprocess
 import sys
+import time
+from bisect import insort
 from collections import ChainMap
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import partial
 from itertools import chain, product, repeat
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 import click
 import numpy as np
 import yaml
 
-from .commands import Command, Job
-from .scheduler import create_scheduler_file
+from .cache import Cache, parse_size
+from .callables import FunctionPool, PythonCommand, call_function, function_arguments
+from .commands import Command, Job, fuse_jobs, referenced_variables
+from .condition import Condition, parse_conditions
+from .dedup import MAX_KEYS, SeenSet, command_key, unique
+from .dryrun import format_summaries, summarise_jobs, write_lines
+from .export import FORMATS, write_rows
+from .history import RuntimeModel
+from .merge import merge_experiments
+from .metrics import (
+    create_record,
+    format_table,
+    read_records,
+    run_command,
+    summarise,
+    write_record,
+)
+from .pilot import create_queue, run_worker
+from .preflight import MODES as CHECK_MODES, check_requires
+from .progress import Progress
+from .scheduler import (
+    bundle_job,
+    create_command_store,
+    create_pilot_file,
+    create_scheduler_file,
+    options_variables,
+    split_by_resources,
+    split_by_templates,
+    stage_directory,
+)
+from .store import read_command
+from .trace import MAIN_LANE, add_span, span, start_trace, stop_trace
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
@@ -171,6 +228,260 @@ def iterator_cycle(variables: VarType, parent: str) -> Iterable[VarMatrix]:
         )
 
 
+def _sample_unit_cube(method: str, num: int, dims: int, seed=None) -> np.ndarray:
+    """Sample points in the half open unit hypercube [0, 1)^dims."""
+    if method == "random":
+        return np.random.default_rng(seed).random((num, dims))
+
+    if method == "lhs":
+        rng = np.random.default_rng(seed)
+        # Each dimension is split into num strata with a single point in each
+        strata = np.stack([rng.permutation(num) for _ in range(dims)], axis=1)
+        return (strata + rng.random((num, dims))) / num
+
+    if method == "sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError(
+                "The sobol sampling method requires scipy to be installed."
+            )
+        return qmc.Sobol(dims, scramble=True, seed=seed).random(num)
+
+    raise ValueError(
+        f"The sample method '{method}' was not recognised. "
+        "Possible values are ['random', 'lhs', 'sobol']"
+    )
+
+
+def iterator_sample(variables: VarType, parent: str = None) -> Iterable[VarMatrix]:
+    """Draw a number of combinations from the values of a set of variables.
+
+    Rather than generating every combination of the variables, this draws ``n``
+    combinations using the sampling ``method``, which is one of ``random``, ``lhs``
+    (latin hypercube) or ``sobol``. Each variable is a scalar, a list of values or a
+    range, with each sampled point mapped onto the values of every variable. Only the
+    values of each variable are created, the full product is never enumerated. The
+    combinations are reproducible when a ``seed`` is specified.
+
+    Args:
+        variables: The sampling options along with the variables to sample from.
+        parent: Unused
+
+    """
+    if not isinstance(variables, dict):
+        raise ValueError(
+            "The sample operator only takes a dict as arguments, "
+            f"got {variables} of type {type(variables)}"
+        )
+    if not variables.get("n"):
+        raise ValueError("n is a required keyword for the sample iterator.")
+
+    num = int(variables["n"])
+    method = str(variables.get("method", "random"))
+    seed = variables.get("seed")
+
+    columns: Dict[str, List[YamlValue]] = {}
+    for key, value in variables.items():
+        if key in ["n", "method", "seed"]:
+            continue
+        values = _column_values(key, value)
+        if values is None:
+            raise ValueError(
+                "The sample operator only supports scalars, lists and ranges, "
+                f"got {value} for {key}"
+            )
+        if not values:
+            raise ValueError(f"There are no values of {key} to sample from.")
+        columns[key] = values
+
+    points = _sample_unit_cube(method, num, len(columns), seed)
+    indices = []
+    for dim, values in enumerate(columns.values()):
+        index = np.floor(points[:, dim] * len(values)).astype(int)
+        indices.append(np.minimum(index, len(values) - 1).tolist())
+
+    keys = list(columns.keys())
+    yield [{key: columns[key][i] for key, i in zip(keys, row)} for row in zip(*indices)]
+
+
+_SPECIAL_KEYS: Dict[str, Callable[[VarType, Any], Iterable[VarMatrix]]] = {
+    "zip": iterator_zip,
+    "product": iterator_product,
+    "arange": iterator_arange,
+    "chain": iterator_chain,
+    "append": iterator_chain,
+    "cycle": iterator_cycle,
+    "repeat": iterator_cycle,
+    "sample": iterator_sample,
+}
+
+
+def _column_values(key: str, value: VarType) -> Optional[List[YamlValue]]:
+    """The values of a variable when they can be expanded as a single column.
+
+    A variable can be handled as a column when it is a scalar, a list of scalars or an
+    ``arange`` iterator. For any other structure None is returned, indicating the
+    generic recursive processing is required.
+
+    """
+    if isinstance(value, list):
+        if any(isinstance(item, (list, dict)) for item in value):
+            return None
+        return value
+    if isinstance(value, dict):
+        if list(value.keys()) != ["arange"]:
+            return None
+        return [
+            item[key]
+            for batch in iterator_arange(value["arange"], key)
+            for item in batch
+        ]
+    return [value]
+
+
+def _as_array(column: np.ndarray) -> np.ndarray:
+    """Convert a column of numbers to a numeric array for evaluating conditions."""
+    values = column.tolist()
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return np.array(values)
+    return column
+
+
+def _filtered_indices(
+    keys: List[str], columns: List[np.ndarray], conditions: List[Condition]
+) -> np.ndarray:
+    """The indices into each column of the combinations satisfying the conditions.
+
+    The combinations are built up a column at a time, with each condition applied to
+    the partial combinations as soon as all the variables it uses are present, so the
+    combinations which fail are removed before the following columns are added.
+
+    """
+    arrays = [_as_array(column) for column in columns]
+    indices = np.zeros((1, 0), dtype=np.intp)
+    pending = list(conditions)
+    for num_keys, column in enumerate(columns, start=1):
+        num_rows, num_values = len(indices), len(column)
+        # Add the next column in the same order as itertools.product
+        indices = np.concatenate(
+            [
+                np.repeat(indices, num_values, axis=0),
+                np.tile(np.arange(num_values), num_rows)[:, np.newaxis],
+            ],
+            axis=1,
+        )
+        bound = set(keys[:num_keys])
+        ready = [condition for condition in pending if condition.variables <= bound]
+        pending = [condition for condition in pending if condition not in ready]
+        if not ready or not len(indices):
+            continue
+        values = {
+            key: array[indices[:, i]]
+            for i, (key, array) in enumerate(zip(keys[:num_keys], arrays))
+        }
+        mask = np.ones(len(indices), dtype=bool)
+        for condition in ready:
+            mask &= np.broadcast_to(condition.evaluate(values), mask.shape)
+        indices = indices[mask]
+
+    for condition in pending:
+        # Raises an error for the variables which are not defined
+        condition.evaluate({key: None for key in keys})
+    return indices
+
+
+def columnar_product(
+    variables: Mapping[str, VarType],
+    batch_size: int = 2 ** 16,
+    conditions: List[Condition] = None,
+) -> Optional[Iterator[Dict[str, YamlValue]]]:
+    """Generate the product of variables using numpy index arrays.
+
+    This is a fast path for the product iterator when every variable is a scalar, a
+    list of scalars or a range. Rather than recursing through generators and merging a
+    ChainMap for every combination, the indices of each combination are computed in
+    batches from the flat index into the product, using the same ordering as
+    :func:`itertools.product` where the last variable changes fastest.
+
+    When there are conditions, only the combinations satisfying every condition are
+    generated, with the conditions evaluated on arrays of values, see
+    :func:`_filtered_indices`.
+
+    Returns: An iterator over the combinations, or None when the variables can't be
+        expanded in this way.
+
+    """
+    if not variables or any(key in _SPECIAL_KEYS for key in variables):
+        return None
+
+    columns = []
+    for key, value in variables.items():
+        values = _column_values(key, value)
+        if values is None:
+            return None
+        # Use an object array so the original python objects are returned
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        columns.append(column)
+
+    keys = list(variables.keys())
+
+    def _generate() -> Iterator[Dict[str, YamlValue]]:
+        shape = tuple(len(column) for column in columns)
+        num_items = int(np.prod(shape))
+        for start in range(0, num_items, batch_size):
+            flat_index = np.arange(start, min(start + batch_size, num_items))
+            indices = np.unravel_index(flat_index, shape)
+            values = [column[index].tolist() for column, index in zip(columns, indices)]
+            for row in zip(*values):
+                yield dict(zip(keys, row))
+
+    def _generate_filtered() -> Iterator[Dict[str, YamlValue]]:
+        assert conditions
+        indices = _filtered_indices(keys, columns, conditions)
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start : start + batch_size]
+            values = [column[batch[:, i]].tolist() for i, column in enumerate(columns)]
+            for row in zip(*values):
+                yield dict(zip(keys, row))
+
+    if conditions:
+        return _generate_filtered()
+    return _generate()
+
+
+def filtered_product(
+    key_vars: List[VarMatrix], conditions: List[Condition]
+) -> Iterator[Dict[str, YamlValue]]:
+    """The combinations of the product of key_vars satisfying all the conditions.
+
+    Each condition is checked as soon as all the variables it uses are present in a
+    partial combination, so no further combinations are generated from a partial
+    combination which fails.
+
+    """
+
+    def _extend(
+        depth: int, partial: Dict[str, YamlValue], pending: List[Condition]
+    ) -> Iterator[Dict[str, YamlValue]]:
+        if depth == len(key_vars):
+            for condition in pending:
+                # Raises an error for the variables which are not defined
+                condition.evaluate(partial)
+            yield partial
+            return
+        for values in key_vars[depth]:
+            # Values from earlier variables take precedence like combine_dictionaries
+            combined = {**values, **partial}
+            ready = [c for c in pending if c.variables <= combined.keys()]
+            if all(condition(combined) for condition in ready):
+                remaining = [c for c in pending if c not in ready]
+                yield from _extend(depth + 1, combined, remaining)
+
+    yield from _extend(0, {}, list(conditions))
+
+
 def variable_matrix(
     variables: VarType, parent: str = None, iterator: str = "product"
 ) -> Iterable[Dict[str, YamlValue]]:
@@ -178,24 +489,33 @@ def variable_matrix(
 
     This function performs recursive processing of the input variables, creating an
     iterator which has all the combinations of variables specified in the input.
+    Where a product only contains scalar values and ranges, the combinations are
+    instead generated using :func:`columnar_product`.
+
+    A mapping of variables can contain the key ``where`` with a condition, or a list of
+    conditions, which every combination of the variables needs to satisfy, see
+    :class:`~.condition.Condition`.
 
     """
     _iters: Dict[str, Callable] = {"product": product, "zip": zip}
-    _special_keys: Dict[str, Callable[[VarType, Any], Iterable[VarMatrix]]] = {
-        "zip": iterator_zip,
-        "product": iterator_product,
-        "arange": iterator_arange,
-        "chain": iterator_chain,
-        "append": iterator_chain,
-        "cycle": iterator_cycle,
-        "repeat": iterator_cycle,
-    }
 
     if isinstance(variables, dict):
+        conditions: List[Condition] = []
+        if "where" in variables:
+            variables = dict(variables)
+            where = cast(Union[str, List[str]], variables.pop("where"))
+            conditions = parse_conditions(where)
+
+        if iterator == "product":
+            columns = columnar_product(variables, conditions=conditions)
+            if columns is not None:
+                yield from columns
+                return
+
         key_vars: List[List[Dict[str, YamlValue]]] = []
 
         # Handling of specialised iterators
-        for key, function in _special_keys.items():
+        for key, function in _SPECIAL_KEYS.items():
             if variables.get(key):
                 item = variables[key]
                 assert item is not None
@@ -209,10 +529,16 @@ def variable_matrix(
 
         logger.debug("key vars: %s", key_vars)
 
+        if iterator == "product" and conditions:
+            yield from filtered_product(key_vars, conditions)
+            return
+
         # Iterate through all possible products generating a dictionary
         for i in _iters[iterator](*key_vars):
             logger.debug("dicts: %s", i)
-            yield combine_dictionaries(i)
+            combined = combine_dictionaries(i)
+            if all(condition(combined) for condition in conditions):
+                yield combined
 
     # Iterate through a list of values
     elif isinstance(variables, list):
@@ -244,46 +570,229 @@ def process_jobs(
     scheduler_options: Dict[str, Any] = None,
     directory: Path = None,
     use_dependencies: bool = False,
+    shard: Tuple[int, int] = None,
+    shard_by: str = "block",
+    sort_key: Callable[[Command], Any] = None,
+    render_processes: int = 1,
 ) -> Iterator[Job]:
     assert jobs is not None
 
     logger.debug("Found %d jobs in file", len(jobs))
 
-    for job in jobs:
+    # The variables used to render the scheduler options of each command
+    extra_variables = options_variables(scheduler_options)
+    for index, job in enumerate(jobs):
         command = job.get("command")
         assert command is not None
+        with span(f"render job {index}"):
+            commands = process_command(
+                command,
+                matrix,
+                render_processes,
+                directory=directory,
+                extra_variables=extra_variables,
+            )
+        options = ChainMap(job, scheduler_options or {})
         yield Job(
-            process_command(command, matrix),
+            commands,
             scheduler_options,
             directory,
             use_dependencies,
+            shard,
+            shard_by,
+            sort_key,
+            options.get("max_concurrent"),
+            options.get("jitter", 0.0),
         )
 
 
-def process_command(command: CommandInput, matrix: VarMatrix) -> List[Command]:
+def _projection_key(projection: Tuple[Tuple[str, Any], ...]) -> bytes:
+    return repr(projection).encode()
+
+
+def project_matrix(
+    matrix: VarMatrix, keys: Set[str], max_keys: int = MAX_KEYS
+) -> VarMatrix:
+    """The distinct projections of the rows of a matrix onto keys.
+
+    The projections are in the order each first occurs in the matrix, with the keys
+    in the same order as the rows. The projections which have been seen are moved to
+    disk once there are more than max_keys of them, see :mod:`experi.dedup`.
+
+    """
+    return list(_iter_projections(matrix, keys, max_keys))
+
+
+def _iter_projections(
+    matrix: Iterable[Dict[str, YamlValue]], keys: Set[str], max_keys: int = MAX_KEYS
+) -> Iterator[Dict[str, Any]]:
+    projections = (
+        tuple((key, value) for key, value in row.items() if key in keys)
+        for row in matrix
+    )
+    return (
+        dict(projection)
+        for projection in unique(projections, _projection_key, max_keys)
+    )
+
+
+def _render_chunk(
+    args: Tuple[Callable[..., Command], str, str, bool, VarMatrix]
+) -> List[Tuple[int, bytes]]:
+    """Render the commands for a chunk of the variable matrix.
+
+    Rather than the commands, which are slow to send between processes, this returns
+    the index within the chunk and the digest of each command which is unique within
+    the chunk.
+
+    """
+    create, creates, requires, idempotent, matrix = args
+    rows = []
+    seen: Set[bytes] = set()
+    for index, variables in enumerate(matrix):
+        key = command_key(create(variables, creates, requires, idempotent))
+        digest = hashlib.sha1(key).digest()
+        if digest not in seen:
+            seen.add(digest)
+            rows.append((index, digest))
+    return rows
+
+
+def process_command(
+    command: CommandInput,
+    matrix: VarMatrix,
+    processes: int = 1,
+    chunk_size: int = 2 ** 14,
+    max_keys: int = MAX_KEYS,
+    directory: Path = None,
+    extra_variables: Iterable[str] = (),
+) -> List[Command]:
     """Generate all combinations of commands given a variable matrix.
 
-    Processes the commands to be sequences of strings.
+    Processes the commands to be sequences of strings. Only the distinct combinations
+    of the variables referenced by the command are rendered, see
+    :func:`project_matrix`, so the variables of each command are those it uses.
+
+    When processes is more than one, the combinations are split into chunks of
+    chunk_size which are rendered in a pool of processes, each returning the index and
+    digest of the commands unique within the chunk. Merging the chunks in order keeps
+    the first occurrence of each command, giving the same commands in the same order
+    as a single process.
+
+    The commands which have been seen are moved to disk once there are more than
+    max_keys of them, bounding the memory used to remove the duplicates.
+
+    A command with a python key calls a python function, see :mod:`experi.callables`,
+    with the variables which are parameters of the function as keyword arguments.
+    The module of the function is imported from the directory of the experiment.
+
+    The extra_variables are kept in the variables of each command even though the
+    command doesn't use them, like the variables of templated scheduler options.
+
+    """
+    if processes <= 1:
+        return list(
+            iter_commands(command, matrix, max_keys, directory, extra_variables)
+        )
+
+    create, creates, requires, idempotent, keys = _command_factory(
+        command, matrix, directory
+    )
+    projections = project_matrix(matrix, keys | set(extra_variables), max_keys)
+    if len(projections) > chunk_size:
+        starts = range(0, len(projections), chunk_size)
+        chunks = (
+            (create, creates, requires, idempotent, projections[i : i + chunk_size])
+            for i in starts
+        )
+        commands = []
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            # The rendered chunks are returned in the order they were submitted
+            rendered = zip(starts, pool.map(_render_chunk, chunks))
+            with SeenSet(max_keys) as seen:
+                for start, rows in rendered:
+                    for index, digest in rows:
+                        if seen.add(digest):
+                            variables = projections[start + index]
+                            commands.append(
+                                create(variables, creates, requires, idempotent)
+                            )
+        return commands
+
+    command_list = (
+        create(variables, creates, requires, idempotent) for variables in projections
+    )
+    return list(unique(command_list, command_key, max_keys))
+
+
+def iter_commands(
+    command: CommandInput,
+    matrix: Iterable[Dict[str, YamlValue]],
+    max_keys: int = MAX_KEYS,
+    directory: Path = None,
+    extra_variables: Iterable[str] = (),
+) -> Iterator[Command]:
+    """Generate the distinct commands of a variable matrix one at a time.
+
+    This renders the same commands in the same order as :func:`process_command`,
+    with each command only rendered once it is needed, so the commands are never all
+    held in memory. The matrix can also be generated as it is needed, although for a
+    command calling a python function it is iterated over twice, first to find the
+    names of the variables, so it needs to generate the combinations on each iteration.
+
+    """
+    create, creates, requires, idempotent, keys = _command_factory(
+        command, matrix, directory
+    )
+    projections = _iter_projections(matrix, keys | set(extra_variables), max_keys)
+    command_list = (
+        create(variables, creates, requires, idempotent) for variables in projections
+    )
+    return unique(command_list, command_key, max_keys)
+
+
+def _command_factory(
+    command: CommandInput,
+    matrix: Iterable[Dict[str, YamlValue]],
+    directory: Path = None,
+) -> Tuple[Callable[..., Command], str, str, bool, Set[str]]:
+    """The function creating a command from its variables, along with its arguments.
+
+    Returns: The function, the creates, requires and idempotent arguments of it, and
+        the variables referenced by the command.
 
     """
     assert command is not None
-    if isinstance(command, str):
-        command_list = [Command(command, variables=variables) for variables in matrix]
-    elif isinstance(command, list):
-        command_list = [Command(command, variables=variables) for variables in matrix]
+    cmd: Union[str, List[str]] = []
+    function = None
+    if isinstance(command, (str, list)):
+        cmd = command
+        creates, requires, idempotent = "", "", False
     else:
-        if command.get("command") is not None:
-            cmd = command.get("command")
+        if command.get("python") is not None:
+            function = str(command.get("python"))
+        elif command.get("command") is not None:
+            cmd = cast(Union[str, List[str]], command.get("command"))
         else:
-            cmd = command.get("cmd")
+            cmd = cast(Union[str, List[str]], command.get("cmd"))
         creates = str(command.get("creates", ""))
         requires = str(command.get("requires", ""))
-
+        idempotent = bool(command.get("idempotent", False))
+
+    if function is not None:
+        variables: Set[str] = set()
+        for row in matrix:
+            variables.update(row)
+        arguments = function_arguments(function, variables, directory)
+        keys = arguments | referenced_variables([], creates, requires)
+        create: Callable[..., Command] = partial(
+            PythonCommand, function, arguments=arguments
+        )
+    else:
         assert isinstance(cmd, (list, str))
-        command_list = [
-            Command(cmd, variables, creates, requires) for variables in matrix
-        ]
-    return uniqueify(command_list)
+        keys = referenced_variables(cmd, creates, requires)
+        create = partial(Command, cmd)
+    return create, creates, requires, idempotent, keys
 
 
 def read_file(filename: PathLike = "experiment.yml") -> Dict[str, Any]:
@@ -295,21 +804,91 @@ def read_file(filename: PathLike = "experiment.yml") -> Dict[str, Any]:
     return structure
 
 
-def process_structure(
-    structure: Dict[str, Any],
-    scheduler: str = "shell",
-    directory: Path = None,
-    use_dependencies: bool = False,
-) -> Iterator[Job]:
+def _input_variables(structure: Dict[str, Any]) -> Dict[str, YamlValue]:
     input_variables = structure.get("variables")
     if input_variables is None:
         raise KeyError('The key "variables" was not found in the input file.')
     assert isinstance(input_variables, Dict)
+    return input_variables
+
+
+class _VariableMatrix:
+    """The combinations of the variables, generated again on each iteration.
+
+    This is used in place of the list of combinations from :func:`process_variables`
+    where the combinations are only iterated over, so they are never all in memory.
+
+    """
+
+    def __init__(self, variables: Dict[str, YamlValue]) -> None:
+        self.variables = variables
+
+    def __iter__(self) -> Iterator[Dict[str, YamlValue]]:
+        return iter(variable_matrix(self.variables))
+
+
+def process_variables(structure: Dict[str, Any]) -> VarMatrix:
+    """Expand the variables of an experiment into every combination."""
+    input_variables = _input_variables(structure)
 
     # create variable matrix
-    variables = list(variable_matrix(input_variables))
+    with span("expand variables"):
+        variables = list(variable_matrix(input_variables))
     assert variables
+    return variables
+
+
+def process_structure(
+    structure: Dict[str, Any],
+    scheduler: str = "shell",
+    directory: Path = None,
+    use_dependencies: bool = False,
+    shard: Tuple[int, int] = None,
+    shard_by: str = "block",
+    sort_key: Callable[[Command], Any] = None,
+    render_processes: int = 1,
+) -> Iterator[Job]:
+    variables = process_variables(structure)
+    jobs_dict, scheduler_options = _parse_structure(structure, scheduler)
+    yield from process_jobs(
+        jobs_dict,
+        variables,
+        scheduler_options,
+        directory,
+        use_dependencies,
+        shard,
+        shard_by,
+        sort_key,
+        render_processes,
+    )
+
+
+def iter_structure_commands(
+    structure: Dict[str, Any], directory: Path = None
+) -> Iterator[Tuple[int, Command]]:
+    """Generate the index of the job along with each command of an experiment.
+
+    The commands are rendered one at a time with :func:`iter_commands`, rather than
+    creating every command of a job at once like :func:`process_structure`, with the
+    combinations of the variables also generated as they are needed.
+
+    """
+    variables = _VariableMatrix(_input_variables(structure))
+    jobs_dict, scheduler_options = _parse_structure(structure)
+    extra_variables = options_variables(scheduler_options)
+    for index, job in enumerate(jobs_dict):
+        command = job.get("command")
+        assert command is not None
+        for rendered in iter_commands(
+            command, variables, directory=directory, extra_variables=extra_variables
+        ):
+            yield index, rendered
 
+
+def _parse_structure(
+    structure: Dict[str, Any], scheduler: str = "shell"
+) -> Tuple[List[Dict], Dict[str, YamlValue]]:
+    """The jobs and the scheduler options of an experiment."""
     # Check for scheduler options
     scheduler_options: Dict[str, YamlValue] = {}
     if structure.get("scheduler"):
@@ -336,10 +915,7 @@ def process_structure(
             jobs_dict = [{"command": cmd} for cmd in input_command]
         else:
             jobs_dict = [{"command": input_command}]
-
-    yield from process_jobs(
-        jobs_dict, variables, scheduler_options, directory, use_dependencies
-    )
+    return jobs_dict, scheduler_options
 
 
 def run_jobs(
@@ -347,19 +923,302 @@ def run_jobs(
     scheduler: str = "shell",
     directory=Path.cwd(),
     dry_run: bool = False,
+    basename: str = "experi",
+    pilot_workers: int = 0,
+    pilot_batch: int = 1,
+    metrics_file: Optional[str] = None,
+    processes: int = 1,
+    progress: bool = False,
+    runtime_model: Optional[RuntimeModel] = None,
+    safety_factor: float = 1.5,
+    cache: Optional[Cache] = None,
+    command_store: bool = False,
+    python_bundle: int = 1,
 ) -> None:
     if scheduler == "shell":
-        run_bash_jobs(jobs, directory, dry_run=dry_run)
+        if pilot_workers > 0:
+            logger.warning("Pilot workers are only used when submitting to a scheduler")
+        if python_bundle > 1:
+            logger.warning("Python commands are only bundled with a scheduler")
+        if command_store:
+            logger.warning("Command stores are only used with a scheduler")
+        if runtime_model is not None:
+            logger.warning("Resources are only requested from a scheduler")
+        run_bash_jobs(
+            jobs,
+            directory,
+            dry_run=dry_run,
+            metrics_file=metrics_file,
+            processes=processes,
+            progress=progress,
+            cache=cache,
+        )
     elif scheduler in ["pbs", "slurm"]:
-        run_scheduler_jobs(scheduler, jobs, directory, dry_run=dry_run)
+        run_scheduler_jobs(
+            scheduler,
+            jobs,
+            directory,
+            basename=basename,
+            dry_run=dry_run,
+            pilot_workers=pilot_workers,
+            pilot_batch=pilot_batch,
+            metrics_file=metrics_file,
+            runtime_model=runtime_model,
+            safety_factor=safety_factor,
+            cache=cache,
+            command_store=command_store,
+            python_bundle=python_bundle,
+        )
     else:
         raise ValueError(
             f"Scheduler '{scheduler}'was not recognised. Possible values are ['shell', 'pbs', 'slurm']"
         )
 
 
+def _after_delay(delay: float, function: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call a function once delay seconds have passed."""
+    if delay > 0:
+        time.sleep(delay)
+    return function(*args, **kwargs)
+
+
+class _Execution:
+    """A single execution of a command within the shell executor.
+
+    A command can have multiple executions when it is speculatively run again, with all
+    the executions sharing the same list of copies.
+
+    """
+
+    def __init__(self, command: Command, lane: int) -> None:
+        self.command = command
+        self.lane = lane
+        self.start = time.time()
+        self.process: Optional[subprocess.Popen] = None
+        self.cancelled = False
+        self.done = False
+        self.copies = [self]
+
+    def started(self, process: subprocess.Popen) -> None:
+        self.process = process
+        # The execution may have been cancelled between components of a command
+        if self.cancelled:
+            self._kill()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.process is not None:
+            self._kill()
+
+    def _kill(self) -> None:
+        assert self.process is not None
+        try:
+            # The command is the leader of a new session, so kill any children as well
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def run_bash_job(
+    job: Job,
+    directory: PathLike = Path.cwd(),
+    metrics_file: Optional[PathLike] = None,
+    processes: int = 1,
+    progress: bool = False,
+    name: str = "Job",
+    speculation: float = 3.0,
+    min_samples: int = 3,
+    cache: Optional[Cache] = None,
+) -> bool:
+    """Run all the commands of a single job in the shell.
+
+    Up to processes commands are run at the same time, with every command running
+    even when one of them fails. When progress is True the number of commands which
+    are complete, running and failed is displayed, see :class:`~.progress.Progress`.
+
+    Once there are no commands waiting to start, an idempotent command which has been
+    running for longer than speculation times the median duration of the completed
+    commands is started again on an idle process. The first of the copies to complete
+    successfully is kept, killing the other. This requires at least min_samples
+    commands to have completed.
+
+    When a cache is given, the outputs of a command found in the cache are restored
+    rather than running the command, with the outputs of the commands which run stored
+    in the cache, see :mod:`experi.cache`.
+
+    Commands calling a python function are run in a pool of worker processes, which
+    import the modules of the functions once, see :mod:`experi.callables`. These
+    commands are never run speculatively since a call can't be killed.
+
+    The max_concurrent of the job limits the number of processes, with the first command
+    on each process waiting a random time of up to the jitter of the job before it
+    starts. The later commands are already staggered by the first ones.
+
+    Returns: Whether all the commands completed successfully.
+
+    """
+    commands = list(job)
+    if job.max_concurrent is not None:
+        processes = min(processes, job.max_concurrent)
+    modules = {c.module for c in commands if isinstance(c, PythonCommand)}
+    function_pool = None
+    if modules:
+        function_pool = FunctionPool(processes, directory, modules)
+    status = Progress(name, len(commands)) if progress else None
+
+    failed = False
+    # The sorted durations of successfully completed commands
+    durations: List[float] = []
+    # Each running command is assigned a lane which is recorded in the trace
+    running: Dict[Future, _Execution] = {}
+    free_lanes = list(range(processes, 0, -1))
+    # The keys in the cache of the commands which are running
+    cache_keys: Dict[Command, str] = {}
+
+    # The number of executions which have been submitted
+    submitted = 0
+
+    def _submit(pool: ThreadPoolExecutor, execution: _Execution) -> None:
+        nonlocal submitted
+        delay = 0.0
+        if job.jitter > 0 and submitted < processes:
+            delay = random.uniform(0, job.jitter)
+        submitted += 1
+        # The command only starts once the delay has passed
+        execution.start += delay
+        if isinstance(execution.command, PythonCommand):
+            assert function_pool is not None
+            future = function_pool.submit(execution.command, delay)
+        else:
+            future = pool.submit(
+                _after_delay,
+                delay,
+                run_command,
+                execution.command.cmd,
+                job.shell,
+                directory,
+                started=execution.started,
+                new_session=execution.command.idempotent,
+                # The commands would be interleaved with the display of the progress
+                echo=not progress,
+            )
+        running[future] = execution
+
+    def _speculate(pool: ThreadPoolExecutor) -> Optional[float]:
+        """Start copies of stragglers, returning the time until the next straggler."""
+        if len(durations) < min_samples:
+            return None
+        threshold = speculation * durations[len(durations) // 2]
+        now = time.time()
+        next_check = None
+        for execution in list(running.values()):
+            if not execution.command.idempotent or len(execution.copies) > 1:
+                continue
+            if isinstance(execution.command, PythonCommand):
+                continue
+            remaining = execution.start + threshold - now
+            if remaining > 0:
+                next_check = min(remaining, next_check or remaining)
+            elif len(running) < processes:
+                logger.info("Speculatively running: %s", execution.command)
+                copy = _Execution(execution.command, free_lanes.pop())
+                copy.copies = execution.copies
+                copy.copies.append(copy)
+                _submit(pool, copy)
+        return next_check
+
+    try:
+        with ThreadPoolExecutor(max_workers=processes) as pool:
+            for command in commands + [None]:
+                if command is not None and cache is not None:
+                    key = cache.key(command, directory)
+                    if key is not None and cache.restore(key, command, directory):
+                        logger.info("Restored from cache: %s", command)
+                        if status is not None:
+                            status.start()
+                            status.finish(0.0)
+                        continue
+                    if key is not None:
+                        cache_keys[command] = key
+                        # The output could have been restored from the cache previously
+                        cache.detach(command, directory)
+
+                # Wait for a free process, or for all commands to complete at the end
+                while running and (len(running) >= processes or command is None):
+                    timeout = None if status is None else status.interval
+                    if command is None:
+                        next_check = _speculate(pool)
+                        if next_check is not None:
+                            timeout = min(next_check, timeout or next_check)
+                    complete, _ = wait(running, timeout, FIRST_COMPLETED)
+                    for future in complete:
+                        usage = future.result()
+                        execution = running.pop(future)
+                        execution.done = True
+                        free_lanes.append(execution.lane)
+                        free_lanes.sort(reverse=True)
+
+                        record = create_record(
+                            str(execution.command),
+                            execution.command.variables,
+                            usage,
+                            execution.command.template_digest(),
+                        )
+                        add_span(
+                            record["command"],
+                            record["start_time"],
+                            record["start_time"] + record["wall_time"],
+                            lane=execution.lane,
+                            category="cancelled" if execution.cancelled else "command",
+                            args={
+                                "exit_code": record["exit_code"],
+                                "variables": record["variables"],
+                            },
+                        )
+                        if execution.cancelled:
+                            continue
+                        others = [c for c in execution.copies if not c.done]
+                        if record["exit_code"] != 0 and others:
+                            # Another copy of the command is still running
+                            continue
+                        for other in others:
+                            other.cancel()
+
+                        if metrics_file is not None:
+                            write_record(Path(directory) / metrics_file, record)
+                        key = cache_keys.pop(execution.command, None)
+                        if record["exit_code"] != 0:
+                            failed = True
+                            logger.error("Command failed: %s", execution.command)
+                        else:
+                            insort(durations, record["wall_time"])
+                            if cache is not None and key is not None:
+                                cache.store(key, execution.command, directory)
+                        if status is not None:
+                            status.finish(record["wall_time"], record["exit_code"] != 0)
+                    if status is not None:
+                        status.update()
+
+                if command is not None:
+                    _submit(pool, _Execution(command, free_lanes.pop()))
+                    if status is not None:
+                        status.start()
+    finally:
+        if function_pool is not None:
+            function_pool.shutdown()
+        if status is not None:
+            status.close()
+    return not failed
+
+
 def run_bash_jobs(
-    jobs: Iterator[Job], directory: PathLike = Path.cwd(), dry_run: bool = False
+    jobs: Iterator[Job],
+    directory: PathLike = Path.cwd(),
+    dry_run: bool = False,
+    metrics_file: Optional[PathLike] = None,
+    processes: int = 1,
+    progress: bool = False,
+    cache: Optional[Cache] = None,
 ) -> None:
     """Submit commands to the bash shell.
 
@@ -368,38 +1227,68 @@ def run_bash_jobs(
     combinations of variables in the variable matrix, however if any one of
     those commands fails then the next command will not run.
 
+    When a metrics_file is given the resources used by each command are appended to
+    the file, see :mod:`experi.metrics`. The commands within a job can be run in
+    parallel using processes, with each job starting once all the commands in the
+    previous job are complete. When a cache is given, the outputs of commands which
+    have run before are restored from the cache.
+
     """
     logger.debug("Running commands in bash shell")
     # iterate through command groups
-    for job in jobs:
+    for index, job in enumerate(jobs):
         # Check shell exists
         if shutil.which(job.shell) is None:
             raise ProcessLookupError(f"The shell '{job.shell}' was not found.")
 
-        failed = False
-        for command in job:
-            for cmd in command:
-                logger.info(cmd)
-                print(f"{job.shell} -c '{cmd}'", flush=True)
-                if not dry_run:
-                    result = subprocess.run(
-                        [job.shell, "-c", f"{cmd}"], cwd=str(directory)
-                    )
-                    if result.returncode != 0:
-                        failed = True
-                        logger.error("Command failed: %s", command)
-                        break
-        if failed:
+        if dry_run:
+            write_lines(
+                (f"{job.shell} -c '{cmd}'" for command in job for cmd in command),
+                sys.stdout,
+            )
+            continue
+
+        with span(f"run job {index}", lane=MAIN_LANE):
+            success = run_bash_job(
+                job,
+                directory,
+                metrics_file,
+                processes,
+                progress,
+                name=f"Job {index}",
+                cache=cache,
+            )
+        if not success:
             logger.error("A command failed, not continuing further.")
             return
 
 
+def _restore_cached(job: Job, cache: Cache, directory: Path) -> Job:
+    """Restore the outputs of commands from the cache, returning the other commands."""
+    commands = []
+    for command in job:
+        key = cache.key(command, directory)
+        if key is not None and cache.restore(key, command, directory):
+            logger.info("Restored from cache: %s", command)
+            continue
+        commands.append(command)
+    return job.with_commands(commands)
+
+
 def run_scheduler_jobs(
     scheduler: str,
     jobs: Iterator[Job],
     directory: PathLike = Path.cwd(),
     basename: str = "experi",
     dry_run: bool = False,
+    pilot_workers: int = 0,
+    pilot_batch: int = 1,
+    metrics_file: Optional[str] = None,
+    runtime_model: Optional[RuntimeModel] = None,
+    safety_factor: float = 1.5,
+    cache: Optional[Cache] = None,
+    command_store: bool = False,
+    python_bundle: int = 1,
 ) -> None:
     """Submit a series of commands to a batch scheduler.
 
@@ -411,6 +1300,40 @@ def run_scheduler_jobs(
     script `-W depend=afterok:<prev_jobid>` is added. This allows for all the components
     of the experiment to be conducted in a single script.
 
+    When pilot_workers is set, the commands of each job are instead written to a queue
+    directory <basename>_<index>.queue, with the scheduler file running an array of
+    pilot_workers workers which each claim pilot_batch commands at a time from the
+    queue (see :mod:`experi.pilot`).
+
+    When a metrics_file is given, the resources used by each command are appended to
+    the file, which is relative to the directory the jobs are submitted from.
+
+    When a runtime_model is given, the walltime and memory requested for each job are
+    the resources predicted for the commands multiplied by the safety_factor. The
+    commands of a job with very different runtimes are split into separate parts
+    <basename>_<index>-<part>, see :func:`~.scheduler.split_by_resources`, with the
+    next job depending on all the parts.
+
+    Scheduler options which are templates of the variables, like ``mem: "{memory}gb"``,
+    are rendered for each command, with the commands of a job requesting different
+    resources similarly split into parts, see :func:`~.scheduler.split_by_templates`.
+
+    When a cache is given, the outputs of commands in the cache are restored and the
+    commands are not submitted. The outputs of the submitted commands are not stored
+    in the cache, which only happens when commands run in the shell.
+
+    When command_store is set, the commands of each job are written to a binary file
+    <basename>_<index>.commands which each element of the array job reads its command
+    from in constant time, rather than the scheduler file containing all the commands
+    (see :mod:`experi.store`). With a metrics_file, the variables of each command are
+    similarly written to <basename>_<index>.variables.
+
+    When python_bundle is more than one, a job with commands calling python functions
+    is written to a queue like a pilot job, with each element of the array job running
+    a bundle of python_bundle commands in a single process. This only imports the
+    modules of the functions once for the bundle, with the walltime of the job
+    multiplied by python_bundle (see :func:`~.scheduler.bundle_job`).
+
     Note: Having this function submit jobs requires that the command `qsub` exists,
     implying that a job scheduler is installed.
 
@@ -438,28 +1361,103 @@ def run_scheduler_jobs(
     directory = Path(directory)
 
     # remove existing files
-    for fname in directory.glob(basename + f"*.{scheduler}"):
+    for fname in directory.glob(basename + f"_[0-9][0-9]*.{scheduler}"):
         print("Removing {}".format(fname))
         os.remove(str(fname))
+    for queue_dir in directory.glob(basename + "_[0-9][0-9]*.queue"):
+        print("Removing {}".format(queue_dir))
+        shutil.rmtree(str(queue_dir))
+    for suffix in ["commands", "variables", "requires", "creates"]:
+        for fname in directory.glob(basename + f"_[0-9][0-9]*.{suffix}"):
+            print("Removing {}".format(fname))
+            os.remove(str(fname))
 
     # Write new files and generate commands
     prev_jobids: List[str] = []
     for index, job in enumerate(jobs):
-        # Generate scheduler file
-        content = create_scheduler_file(scheduler, job)
-        logger.debug("File contents:\n%s", content)
-        # Write file to disk
-        fname = Path(directory / "{}_{:02d}.{}".format(basename, index, scheduler))
-        with fname.open("w") as dst:
-            dst.write(content)
-
-        if submit_job or dry_run:
+        if cache is not None and not dry_run:
+            job = _restore_cached(job, cache, directory)
+        parts = split_by_templates(job)
+        if runtime_model is not None:
+            parts = [
+                resources
+                for part in parts
+                for resources in split_by_resources(
+                    scheduler, part, runtime_model, safety_factor
+                )
+            ]
+
+        job_ids: List[str] = []
+        for part_index, part in enumerate(parts):
+            label = str(index) if len(parts) == 1 else f"{index}-{part_index}"
+            name = "{}_{:02d}".format(basename, index)
+            if len(parts) > 1:
+                name += f"-{part_index}"
+
+            # Generate scheduler file
+            with span(f"create scheduler file {label}"):
+                if pilot_workers > 0:
+                    queue = f"{name}.queue"
+                    num_batches = create_queue(part, directory / queue, pilot_batch)
+                    num_workers = max(1, min(pilot_workers, num_batches))
+                    if part.max_concurrent is not None:
+                        num_workers = min(num_workers, part.max_concurrent)
+                    content = create_pilot_file(
+                        scheduler, part, queue, num_workers, metrics_file
+                    )
+                elif python_bundle > 1 and any(
+                    isinstance(command, PythonCommand) for command in part
+                ):
+                    queue = f"{name}.queue"
+                    num_batches = create_queue(part, directory / queue, python_bundle)
+                    content = create_pilot_file(
+                        scheduler,
+                        bundle_job(part, python_bundle),
+                        queue,
+                        num_batches,
+                        metrics_file,
+                        max_batches=1,
+                    )
+                elif command_store:
+                    commands = f"{name}.commands"
+                    variables = requires = creates = None
+                    if metrics_file is not None:
+                        variables = f"{name}.variables"
+                    if stage_directory(part) is not None:
+                        requires = f"{name}.requires"
+                        creates = f"{name}.creates"
+                    create_command_store(
+                        part,
+                        directory / commands,
+                        None if variables is None else directory / variables,
+                        None if requires is None else directory / requires,
+                        None if creates is None else directory / creates,
+                    )
+                    content = create_scheduler_file(
+                        scheduler,
+                        part,
+                        metrics_file,
+                        commands,
+                        variables,
+                        requires,
+                        creates,
+                    )
+                else:
+                    content = create_scheduler_file(scheduler, part, metrics_file)
+                logger.debug("File contents:\n%s", content)
+                # Write file to disk
+                fname = Path(directory / f"{name}.{scheduler}")
+                with fname.open("w") as dst:
+                    dst.write(content)
+
+            if not (submit_job or dry_run):
+                continue
             # Construct command
             submit_cmd = [submit_executable]
 
             if prev_jobids:
-                # Continue to append all previous jobs to submit_cmd so subsequent jobs die along
-                # with the first.
+                # Continue to append all previous jobs to submit_cmd so subsequent jobs
+                # die along with the first.
                 afterok = f"afterok:{':'.join(prev_jobids)}"
                 if scheduler == "pbs":
                     submit_cmd += ["-W", f"depend={afterok}"]
@@ -469,17 +1467,21 @@ def run_scheduler_jobs(
             # actually run the command
             logger.info(str(submit_cmd))
             try:
+                submit_start = time.time()
                 if dry_run:
                     print(f"{submit_cmd} {fname.name}")
-                    prev_jobids.append("dry_run")
+                    job_ids.append("dry_run")
                 else:
                     cmd_res = subprocess.check_output(
                         submit_cmd + [fname.name], cwd=str(directory)
                     )
-                    prev_jobids.append(cmd_res.decode().strip())
+                    job_ids.append(cmd_res.decode().strip())
+                add_span(f"submit job {label}", submit_start, time.time())
             except subprocess.CalledProcessError:
                 logger.error("Submitting job to the queue failed.")
-                break
+                return
+        # The parts of a job run independently, with the next job depending on all
+        prev_jobids += job_ids
 
 
 def determine_scheduler(
@@ -520,32 +1522,154 @@ def _set_verbosity(ctx, param, value):
         logging.basicConfig(level=logging.DEBUG)
 
 
+def _parse_shard(ctx, param, value) -> Optional[Tuple[int, int]]:
+    if value is None:
+        return None
+    try:
+        index, num_shards = (int(i) for i in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("The shard needs to be in the form INDEX/TOTAL.")
+    if not 0 <= index < num_shards:
+        raise click.BadParameter(
+            "The shard index needs to be between 0 and one less than the total."
+        )
+    return index, num_shards
+
+
+def _parse_size(ctx, param, value) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+
 def launch(
-    input_file="experiment.yml", use_dependencies=False, dry_run=False, scheduler=None
+    input_file="experiment.yml",
+    use_dependencies=False,
+    dry_run=False,
+    scheduler=None,
+    shard=None,
+    shard_by="block",
+    pilot_workers=0,
+    pilot_batch=1,
+    metrics_file=None,
+    processes=1,
+    progress=False,
+    trace_file=None,
+    longest_first=False,
+    predict_resources=False,
+    safety_factor=1.5,
+    cache_dir=None,
+    cache_size=None,
+    render_processes=1,
+    command_store=False,
+    plan_summary=False,
+    fuse=False,
+    requires_check=None,
+    python_bundle=1,
 ) -> None:
     # This function provides an API to access experi's functionality from within
     # python scripts, as an alternative to the command-line interface
 
-    # Process and run commands
-    input_file = Path(input_file)
-    structure = read_file(input_file)
-    scheduler = determine_scheduler(scheduler, structure)
-    jobs = process_structure(
-        structure, scheduler, Path(input_file.parent), use_dependencies
-    )
-    run_jobs(jobs, scheduler, input_file.parent, dry_run)
-
-
-@click.command()
+    if longest_first and metrics_file is None:
+        raise ValueError("Ordering longest first requires a metrics file of runtimes")
+    if predict_resources and metrics_file is None:
+        raise ValueError("Predicting resources requires a metrics file of runtimes")
+
+    if trace_file is not None:
+        start_trace()
+
+    if isinstance(input_file, (str, Path)):
+        input_file = [input_file]
+    # The experiments in each directory are merged, since they run in the directory
+    experiments: Dict[Path, List[Path]] = {}
+    for filename in input_file:
+        experiments.setdefault(Path(filename).parent, []).append(Path(filename))
+
+    try:
+        for directory, input_files in experiments.items():
+            # Process and run commands
+            structures = [read_file(filename) for filename in input_files]
+            schedulers = {determine_scheduler(scheduler, s) for s in structures}
+            if len(schedulers) > 1:
+                raise ValueError(
+                    f"The experiments use the schedulers {sorted(schedulers)}, "
+                    "choose one using --scheduler"
+                )
+            (job_scheduler,) = schedulers
+            model = None
+            if longest_first or predict_resources:
+                model = RuntimeModel.from_file(directory / metrics_file)
+            sort_key = model.sort_key if longest_first and model is not None else None
+            cache = None if cache_dir is None else Cache(cache_dir, cache_size)
+            experiment_jobs = []
+            for structure in structures:
+                jobs = process_structure(
+                    structure,
+                    job_scheduler,
+                    directory,
+                    use_dependencies,
+                    shard,
+                    shard_by,
+                    sort_key,
+                    render_processes,
+                )
+                if fuse:
+                    jobs = fuse_jobs(jobs)
+                experiment_jobs.append(jobs)
+            if len(experiment_jobs) > 1:
+                # The experiments are submitted together, see experi.merge
+                jobs = merge_experiments(
+                    experiment_jobs, by_template=metrics_file is not None
+                )
+            if requires_check is not None:
+                jobs = check_requires(jobs, directory, requires_check)
+            if plan_summary:
+                print(
+                    format_summaries(summarise_jobs(jobs, job_scheduler, command_store))
+                )
+                continue
+            basename = "experi"
+            if shard is not None:
+                # Each shard has separate scheduler files so they don't overwrite
+                # each other
+                basename = "experi-{}of{}".format(*shard)
+            run_jobs(
+                jobs,
+                job_scheduler,
+                directory,
+                dry_run,
+                basename,
+                pilot_workers,
+                pilot_batch,
+                metrics_file,
+                processes,
+                progress,
+                model if predict_resources else None,
+                safety_factor,
+                cache,
+                command_store,
+                python_bundle,
+            )
+    finally:
+        if trace_file is not None:
+            stop_trace(trace_file)
+
+
+@click.group(invoke_without_command=True)
 @click.version_option()
 @click.option(
     "-f",
     "--input-file",
-    type=click.Path(exists=True, dir_okay=False),
-    default="experiment.yml",
+    type=click.Path(dir_okay=False),
+    multiple=True,
+    default=["experiment.yml"],
     help="""Path to a YAML file containing experiment data. Note that the experiment
     will be run from the directory in which the file exists, not the directory the
-    script was run from.""",
+    script was run from. This can be given multiple times, with the jobs of the
+    experiments in the same directory merged so they are submitted together.""",
 )
 @click.option(
     "-s",
@@ -566,6 +1690,152 @@ def launch(
     default=False,
     help="Don't run commands or submit jobs, just show the commands that would be run.",
 )
+@click.option(
+    "--plan-summary",
+    is_flag=True,
+    default=False,
+    help="""Don't run commands or submit jobs, showing a summary of each job rather
+    than every command. This is much faster than --dry-run for very large
+    experiments.""",
+)
+@click.option(
+    "--shard",
+    callback=_parse_shard,
+    default=None,
+    metavar="INDEX/TOTAL",
+    help="""Only run the commands in a single shard of each job, where INDEX is
+    numbered from 0. This allows an experiment to be split between multiple
+    invocations.""",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(["block", "hash"]),
+    default="block",
+    help="""Partition the commands into contiguous blocks or by the hash of each
+    command.""",
+)
+@click.option(
+    "--pilot",
+    "pilot_workers",
+    type=click.IntRange(min=0),
+    default=0,
+    help="""Submit this number of pilot workers for each job, which run the commands
+    from a queue rather than having an array element for each command.""",
+)
+@click.option(
+    "--pilot-batch",
+    type=click.IntRange(min=1),
+    default=1,
+    help="The number of commands a pilot worker claims from the queue at a time.",
+)
+@click.option(
+    "--python-bundle",
+    type=click.IntRange(min=1),
+    default=1,
+    help="""The number of python commands run by each element of an array job, which
+    imports the modules of the functions once for all of them. The walltime of the
+    job is multiplied by this number.""",
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="""Append the wall time, cpu time, memory use and exit code of each command to
+    this file, relative to the directory of the experiment.""",
+)
+@click.option(
+    "-j",
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="The number of commands to run at the same time with the shell scheduler.",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="""Display the number of commands completed, the rate of completion and the
+    estimated time remaining when running with the shell scheduler.""",
+)
+@click.option(
+    "--trace",
+    "trace_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="""Write a timeline of the experiment to this file in the Chrome Trace Event
+    format, which can be viewed in chrome://tracing or https://ui.perfetto.dev.""",
+)
+@click.option(
+    "--longest-first",
+    is_flag=True,
+    default=False,
+    help="""Order the commands of each job from the longest predicted runtime to the
+    shortest, using the runtimes of previous runs recorded in the --metrics file.""",
+)
+@click.option(
+    "--predict-resources",
+    is_flag=True,
+    default=False,
+    help="""Request the walltime and memory for each job predicted from the previous
+    runs recorded in the --metrics file, splitting the commands of a job with very
+    different runtimes into separate submissions.""",
+)
+@click.option(
+    "--safety-factor",
+    type=click.FloatRange(min=1),
+    default=1.5,
+    help="The multiple of the predicted resources requested with --predict-resources.",
+)
+@click.option(
+    "--cache",
+    "cache_dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="""Restore the outputs of commands which have run before from this directory,
+    storing the outputs of commands which run. Only commands with a creates value are
+    cached, keyed by the command and the contents of the requires value.""",
+)
+@click.option(
+    "--cache-size",
+    callback=_parse_size,
+    default=None,
+    metavar="SIZE",
+    help="""The maximum size of the cache, like 10G, removing the least recently used
+    outputs when it is larger.""",
+)
+@click.option(
+    "--render-processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="""The number of processes used to render the commands of each job, which
+    reduces the time taken to generate very large numbers of commands.""",
+)
+@click.option(
+    "--check-requires",
+    "requires_check",
+    type=click.Choice(CHECK_MODES),
+    default=None,
+    help="""Check the requires file of every command exists, or is created by an
+    earlier job, before running any commands. Commands with a missing file are
+    skipped, with defer instead running a command after the job creating its file.""",
+)
+@click.option(
+    "--fuse",
+    is_flag=True,
+    default=False,
+    help="""Fuse consecutive jobs where each command requires the output of a different
+    command in the previous job, running each chain of commands one after the other
+    in a single element of an array job.""",
+)
+@click.option(
+    "--command-store",
+    is_flag=True,
+    default=False,
+    help="""Write the commands of each job to a binary file from which each element of
+    the array job reads its command, rather than including every command in the
+    scheduler file. This keeps the scheduler files small for very large jobs.""",
+)
 @click.option(
     "-v",
     "--verbose",
@@ -574,5 +1844,233 @@ def launch(
     count=True,
     help="Increase the verbosity of logging events.",
 )
-def main(input_file, use_dependencies, dry_run, scheduler) -> None:
-    launch(input_file, use_dependencies, dry_run, scheduler)
+@click.pass_context
+def main(
+    ctx,
+    input_file,
+    use_dependencies,
+    dry_run,
+    plan_summary,
+    scheduler,
+    shard,
+    shard_by,
+    pilot_workers,
+    pilot_batch,
+    metrics_file,
+    processes,
+    progress,
+    trace_file,
+    longest_first,
+    predict_resources,
+    safety_factor,
+    cache_dir,
+    cache_size,
+    render_processes,
+    fuse,
+    command_store,
+    requires_check,
+    python_bundle,
+) -> None:
+    # Subcommands don't require an input file
+    if ctx.invoked_subcommand is not None:
+        return
+    for filename in input_file:
+        if not Path(filename).is_file():
+            raise click.BadParameter(
+                f"File '{filename}' does not exist.",
+                param_hint="'-f' / '--input-file'",
+            )
+    for flag, name in [
+        (longest_first, "--longest-first"),
+        (predict_resources, "--predict-resources"),
+    ]:
+        if flag and metrics_file is None:
+            raise click.BadParameter(
+                "The runtimes are read from the file given by --metrics.",
+                param_hint=f"'{name}'",
+            )
+    launch(
+        list(input_file),
+        use_dependencies,
+        dry_run,
+        scheduler,
+        shard,
+        shard_by,
+        pilot_workers,
+        pilot_batch,
+        metrics_file,
+        processes,
+        progress,
+        trace_file,
+        longest_first,
+        predict_resources,
+        safety_factor,
+        cache_dir,
+        cache_size,
+        render_processes,
+        command_store,
+        plan_summary,
+        fuse,
+        requires_check,
+        python_bundle,
+    )
+
+
+@main.command()
+@click.argument("queue", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--shell", default="bash", help="The shell with which to run the commands."
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the resources used by each command to this file.",
+)
+@click.option(
+    "--max-batches",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stop once this number of batches have run.",
+)
+def worker(queue, shell, metrics_file, max_batches) -> None:
+    """Run commands from a QUEUE created by a pilot job until it is empty."""
+    failed = run_worker(
+        Path(queue), shell, metrics_file=metrics_file, max_batches=max_batches
+    )
+    if failed:
+        logger.error("%d commands failed.", failed)
+        sys.exit(1)
+
+
+@main.command()
+@click.argument("metrics_file", type=click.Path(dir_okay=False))
+@click.argument("command")
+@click.option(
+    "--variables",
+    default="{}",
+    help="The variables of the command as a JSON object, stored with the metrics.",
+)
+@click.option(
+    "--template",
+    default=None,
+    help="The digest of the template the command was generated from.",
+)
+@click.option(
+    "--shell", default="bash", help="The shell with which to run the command."
+)
+def record(metrics_file, command, variables, template, shell) -> None:
+    """Run COMMAND appending the resources it used to METRICS_FILE."""
+    usage = run_command([command], shell)
+    write_record(
+        metrics_file, create_record(command, json.loads(variables), usage, template)
+    )
+    if usage["exit_code"] < 0:
+        # Terminated by a signal, using the exit code convention of the shell
+        sys.exit(128 - usage["exit_code"])
+    sys.exit(usage["exit_code"])
+
+
+@main.command()
+@click.argument("metrics_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--by",
+    multiple=True,
+    help="A variable to group the commands by, which can be given multiple times.",
+)
+def summary(metrics_file, by) -> None:
+    """Summarise the resources used by commands recorded in METRICS_FILE."""
+    print(format_table(summarise(read_records(metrics_file), list(by))))
+
+
+@main.command()
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option(
+    "-f",
+    "--input-file",
+    type=click.Path(exists=True, dir_okay=False),
+    default="experiment.yml",
+    help="Path to a YAML file containing experiment data.",
+)
+@click.option(
+    "--commands",
+    is_flag=True,
+    default=False,
+    help="""Export the rendered commands of each job along with their variables,
+    rather than the combinations of variables.""",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(FORMATS),
+    default=None,
+    help="The format of the output, which defaults to the extension of OUTPUT.",
+)
+def expand(output, input_file, commands, fmt) -> None:
+    """Write the combinations of variables, or the commands, to OUTPUT."""
+    structure = read_file(input_file)
+    if commands:
+
+        def rows() -> Iterator[Dict[str, Any]]:
+            directory = Path(input_file).parent
+            for index, command in iter_structure_commands(structure, directory):
+                row: Dict[str, Any] = {"job": index, "command": str(command)}
+                for key, value in command.variables.items():
+                    row.setdefault(key, value)
+                yield row
+
+    else:
+        matrix = _VariableMatrix(_input_variables(structure))
+
+        def rows() -> Iterator[Dict[str, Any]]:
+            return iter(matrix)
+
+    try:
+        num_rows = write_rows(rows, output, fmt)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="'OUTPUT'")
+    print(f"Wrote {num_rows} rows to {output}")
+
+
+@main.command()
+@click.argument("function")
+@click.argument("kwargs", default="{}")
+def call(function, kwargs) -> None:
+    """Call a python FUNCTION, module:function, with the KWARGS given as JSON."""
+    try:
+        usage = call_function(function, json.loads(kwargs), Path.cwd())
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    sys.exit(usage["exit_code"])
+
+
+@main.command("get-command")
+@click.argument("command_store", type=click.Path(exists=True, dir_okay=False))
+@click.argument("index", type=int)
+def get_command(command_store, index) -> None:
+    """Print the command at INDEX of a COMMAND_STORE written for an array job."""
+    try:
+        print(read_command(command_store, index))
+    except (IndexError, ValueError) as err:
+        raise click.BadParameter(str(err))
+
+
+@main.group("cache")
+def cache_group() -> None:
+    """Manage a cache of the outputs of commands."""
+
+
+@cache_group.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--max-size",
+    callback=_parse_size,
+    default=None,
+    metavar="SIZE",
+    help="Remove the least recently used outputs until the cache is within SIZE.",
+)
+def gc(directory, max_size) -> None:
+    """Remove outputs from the cache in DIRECTORY."""
+    removed = Cache(directory).gc(max_size)
+    print(f"Removed {removed} bytes from the cache")
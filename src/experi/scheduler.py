@@ -12,18 +12,32 @@ This will generate a .pbs file with all the information required to run a single
 from the list of commands. The variables will be generated and iterated over using the
 job array feature of pbs. """
 
+import json
 import logging
+import math
+import shlex
 from pathlib import Path
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 from copy import deepcopy
-from typing import Any, Dict, List, Union
-
-from .commands import Job
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .commands import (
+    DEFAULT_WALLTIME,
+    Command,
+    Job,
+    format_walltime,
+    parse_walltime,
+    template_variables,
+)
+from .history import RuntimeModel
+from .metrics import json_default
+from .store import write_store
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 
+PathLike = Union[str, Path]
 
 SCHEDULER_TEMPLATE = """
 cd "{workdir}"
@@ -32,7 +46,111 @@ cd "{workdir}"
 COMMAND={command_list}
 
 echo "${{COMMAND[{array_index}]}}"
-${{COMMAND[{array_index}]}}
+{run}
+"""
+
+RUN = '{shell} -c "${{COMMAND[{array_index}]}}"'
+
+METRICS_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+COMMAND={command_list}
+
+VARIABLES={variables_list}
+
+echo "${{COMMAND[{array_index}]}}"
+{run}
+"""
+
+METRICS_RUN = (
+    'experi record --variables "${{VARIABLES[{array_index}]}}" --template "{template}" '
+    '"{metrics}" "${{COMMAND[{array_index}]}}"'
+)
+
+STORE_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+COMMAND="$(experi get-command "{command_store}" {array_index})"
+
+echo "$COMMAND"
+{run}
+"""
+
+STORE_RUN = '{shell} -c "$COMMAND"'
+
+METRICS_STORE_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+COMMAND="$(experi get-command "{command_store}" {array_index})"
+
+VARIABLES="$(experi get-command "{variables_store}" {array_index})"
+
+echo "$COMMAND"
+{run}
+"""
+
+METRICS_STORE_RUN = (
+    'experi record --variables "$VARIABLES" --template "{template}" "{metrics}" '
+    '"$COMMAND"'
+)
+
+# Stagger the start of each element of an array by a random number of seconds
+JITTER_TEMPLATE = "sleep $((RANDOM % ({jitter} + 1)))\n"
+
+# Run the command in a directory on node-local storage, copying the requires file to
+# the directory beforehand and the creates file back once the command succeeds. The
+# output is copied next to its final location then renamed, so it appears atomically.
+# The directory of the creates file exists in the staging directory, as it would in
+# the working directory.
+STAGE_TEMPLATE = """{stage_paths}
+PARTIAL=""
+if [ -n "$CREATES" ]; then
+    PARTIAL="$CREATES.experi-$$"
+fi
+STAGE_DIR="$(mktemp -d "{stage}/experi.XXXXXX")" || exit 1
+trap 'rm -rf "$STAGE_DIR" ${{PARTIAL:+"$PARTIAL"}}' EXIT
+
+if [ -n "$REQUIRES" ]; then
+    mkdir -p "$STAGE_DIR/$(dirname "$REQUIRES")"
+    cp -r "$REQUIRES" "$STAGE_DIR/$REQUIRES" || exit 1
+fi
+if [ -n "$CREATES" ]; then
+    mkdir -p "$STAGE_DIR/$(dirname "$CREATES")"
+fi
+
+cd "$STAGE_DIR"
+{run}
+STATUS=$?
+cd "{workdir}"
+
+if [ $STATUS -eq 0 ] && [ -n "$CREATES" ]; then
+    mkdir -p "$(dirname "$CREATES")"
+    cp -r "$STAGE_DIR/$CREATES" "$PARTIAL" || exit 1
+    if [ -d "$CREATES" ]; then
+        rm -rf "$CREATES"
+    fi
+    mv -f "$PARTIAL" "$CREATES" || exit 1
+fi
+exit $STATUS"""
+
+STAGE_PATHS = """REQUIRES_LIST={requires_list}
+
+CREATES_LIST={creates_list}
+
+REQUIRES="${{REQUIRES_LIST[{array_index}]}}"
+CREATES="${{CREATES_LIST[{array_index}]}}\""""
+
+STAGE_STORE_PATHS = """REQUIRES="$(experi get-command "{requires_store}" {array_index})"
+CREATES="$(experi get-command "{creates_store}" {array_index})\""""
+
+PILOT_TEMPLATE = """
+cd "{workdir}"
+{setup}
+
+{jitter}experi worker {worker_options}"{queue}"
 """
 
 
@@ -48,7 +166,7 @@ class SchedulerOptions(ABC):
     def __init__(self, **kwargs) -> None:
         # Initialise data structures with default values
         self.resources = OrderedDict(select=1, ncpus=1)
-        self.time = OrderedDict(walltime="1:00")
+        self.time = OrderedDict(walltime=DEFAULT_WALLTIME)
         self.leftovers = OrderedDict()
 
         for key, value in kwargs.items():
@@ -299,15 +417,29 @@ def create_header_string(scheduler: str, **kwargs) -> str:
     raise ValueError("Scheduler needs to be one of PBS or SLURM.")
 
 
-def get_array_string(scheduler: str, num_commands: int) -> str:
+def get_array_string(
+    scheduler: str, num_commands: int, max_concurrent: Optional[int] = None
+) -> str:
+    """The lines of the header creating an array job of num_commands elements.
+
+    When max_concurrent is given, at most that many elements of the array run at the
+    same time, using the throttle of SLURM or the max_run_subjobs attribute of PBS.
+
+    """
+    throttle = max_concurrent is not None and max_concurrent < num_commands
     if scheduler.upper() == "SLURM":
         if num_commands > 1:
-            header_string = "#SBATCH -J 0-{}\n".format(num_commands - 1)
+            header_string = "#SBATCH --array=0-{}".format(num_commands - 1)
+            if throttle:
+                header_string += f"%{max_concurrent}"
+            header_string += "\n"
         else:
             header_string = "SLURM_ARRAY_TASK_ID=0\n"
     elif scheduler.upper() == "PBS":
         if num_commands > 1:
             header_string = "#PBS -J 0-{}\n".format(num_commands - 1)
+            if throttle:
+                header_string += f"#PBS -W max_run_subjobs={max_concurrent}\n"
         else:
             header_string = "PBS_ARRAY_INDEX=0\n"
     else:
@@ -315,10 +447,8 @@ def get_array_string(scheduler: str, num_commands: int) -> str:
     return header_string
 
 
-def create_scheduler_file(scheduler: str, job: Job) -> str:
-    """Substitute values into a template scheduler file."""
-    logger.debug("Create Scheduler File Function")
-
+def _create_header(scheduler: str, job: Job, num_tasks: int) -> Tuple[str, str]:
+    """Create the header of a scheduler file, returning the header and setup strings."""
     if job.scheduler_options is None:
         scheduler_options: Dict[str, Any] = {}
     else:
@@ -328,20 +458,381 @@ def create_scheduler_file(scheduler: str, job: Job) -> str:
         del scheduler_options["setup"]
     except KeyError:
         setup_string = ""
+    # The stage directory is used when creating the scheduler file
+    scheduler_options.pop("stage", None)
+    # The throttling of the array is set by the job
+    scheduler_options.pop("max_concurrent", None)
+    scheduler_options.pop("jitter", None)
     # Create header
     header_string = create_header_string(scheduler, **scheduler_options)
-    header_string += get_array_string(scheduler, len(job))
+    header_string += get_array_string(scheduler, num_tasks, job.max_concurrent)
+    return header_string, setup_string
+
+
+def format_memory(scheduler: str, kilobytes: float) -> str:
+    """Format a memory request, rounding up to a whole number of megabytes."""
+    megabytes = max(1, math.ceil(kilobytes / 1024))
+    if scheduler.upper() == "SLURM":
+        return f"{megabytes}M"
+    return f"{megabytes}mb"
+
+
+def split_by_resources(
+    scheduler: str,
+    job: Job,
+    model: RuntimeModel,
+    safety_factor: float = 1.5,
+    ratio: float = 4.0,
+) -> List[Job]:
+    """Split a job into parts requesting the resources predicted for their commands.
+
+    The commands are grouped by their predicted wall time, with each group spanning a
+    factor of ratio, so commands with very different runtimes are submitted as separate
+    array jobs. Each part requests the largest predicted wall time and memory of its
+    commands multiplied by the safety_factor. Commands without a prediction are kept
+    in a part with the resources of the original job.
+
+    Returns: The parts of the job, ordered from the longest running to the shortest.
+
+    """
+    if safety_factor < 1:
+        raise ValueError(f"The safety factor must be at least 1, got {safety_factor}")
+
+    # The predicted wall time of the commands with a prediction
+    wall_times: Dict[Command, float] = {}
+    groups: Dict[Optional[int], List[Command]] = {}
+    for command in job:
+        wall_time = model.predict(command)
+        group = None
+        if wall_time is not None:
+            wall_times[command] = wall_time
+            group = math.floor(math.log(max(wall_time, 1)) / math.log(ratio))
+        groups.setdefault(group, []).append(command)
+
+    if not groups:
+        return [job]
+
+    parts = []
+
+    def _longest_first(group: Optional[int]) -> float:
+        # Commands without a prediction could run for any time
+        return -math.inf if group is None else -group
+
+    for group in sorted(groups, key=_longest_first):
+        commands = groups[group]
+        options = dict(job.scheduler_options or {})
+        if group is not None:
+            wall_time = max(wall_times[command] for command in commands)
+            options["walltime"] = format_walltime(safety_factor * wall_time)
+
+            predicted = [model.predict(command, "max_rss") for command in commands]
+            memory = [value for value in predicted if value is not None]
+            if len(memory) == len(predicted):
+                options.pop("memory", None)
+                options["mem"] = format_memory(scheduler, safety_factor * max(memory))
+        logger.debug("Part with %d commands using %s", len(commands), options)
+        parts.append(job.with_commands(commands, options))
+    return parts
+
+
+def _option_variables(value: Any) -> Set[str]:
+    """The variables referenced by the value of a scheduler option."""
+    if not isinstance(value, str):
+        return set()
+    try:
+        return template_variables(value)
+    except ValueError:
+        # The value isn't a valid format string, so isn't a template
+        return set()
+
+
+def options_variables(scheduler_options: Optional[Dict[str, Any]]) -> Set[str]:
+    """The variables referenced by the templates of scheduler options."""
+    variables: Set[str] = set()
+    for value in (scheduler_options or {}).values():
+        variables |= _option_variables(value)
+    return variables
+
+
+def split_by_templates(job: Job) -> List[Job]:
+    """Split a job into parts with the scheduler options rendered for their commands.
+
+    A scheduler option can be a template using the variables of the commands, like
+    ``mem: "{memory}gb"``, which is rendered with the variables of each command. The
+    commands are grouped by their rendered options, with each group being a part of the
+    job, so the resources requested by each part are those required by its commands.
+    Only the options referencing a variable of the commands are rendered, which leaves
+    values like ``${HOME}`` in the setup untouched.
+
+    Returns: The parts of the job, in the order the options first occur.
+
+    """
+    names: Set[str] = set()
+    for command in job.commands:
+        names |= set(command.variables)
+    templates = {
+        key: value
+        for key, value in (job.scheduler_options or {}).items()
+        if _option_variables(value) & names
+    }
+    if not templates:
+        return [job]
+
+    groups: Dict[Tuple[Tuple[str, str], ...], List[Command]] = {}
+    for command in job:
+        try:
+            rendered = tuple(
+                (key, value.format(**command.variables))
+                for key, value in templates.items()
+            )
+        except (KeyError, IndexError, AttributeError) as err:
+            raise ValueError(
+                f"Unable to render the scheduler options for '{command}': {err}"
+            )
+        groups.setdefault(rendered, []).append(command)
+
+    parts = []
+    for rendered, group in groups.items():
+        options = dict(job.scheduler_options or {})
+        options.update(rendered)
+        logger.debug("Part with %d commands using %s", len(group), dict(rendered))
+        parts.append(job.with_commands(group, options))
+    return parts
+
+
+def _get_workdir(scheduler: str) -> str:
+    if scheduler.upper() == "SLURM":
+        return r"$SLURM_SUBMIT_DIR"
+    return r"$PBS_O_WORKDIR"
+
+
+def _variables_json(command: Command) -> str:
+    return json.dumps(command.variables, default=json_default)
+
+
+def variables_as_bash_array(job: Job) -> str:
+    """The variables of each command in a job as a bash array of JSON strings."""
+    return _bash_array(_variables_json(command) for command in job)
+
+
+def create_command_store(
+    job: Job,
+    command_store: PathLike,
+    variables_store: Optional[PathLike] = None,
+    requires_store: Optional[PathLike] = None,
+    creates_store: Optional[PathLike] = None,
+) -> int:
+    """Write the commands of a job, and optionally their variables, to command stores.
+
+    The command stores are read by the scheduler file from :func:`create_scheduler_file`
+    to find the command of each element of the array job, see :mod:`experi.store`. The
+    requires and creates files of each command are written to the requires_store and
+    creates_store, which are read when the commands are staged.
+
+    Returns: The number of commands written.
+
+    """
+    commands = list(job)
+    num_commands = write_store(command_store, (str(command) for command in commands))
+    if variables_store is not None:
+        write_store(variables_store, (_variables_json(c) for c in commands))
+    if requires_store is not None:
+        write_store(requires_store, (c.requires for c in commands))
+    if creates_store is not None:
+        write_store(creates_store, (c.creates for c in commands))
+    return num_commands
+
+
+def _bash_array(values: Iterable[str]) -> str:
+    return_string = "( \\\n"
+    for value in values:
+        return_string += shlex.quote(value) + " \\\n"
+    return_string += ")"
+    return return_string
+
+
+def stage_directory(job: Job) -> Optional[str]:
+    """The directory on node-local storage in which the commands of a job are run."""
+    if job.scheduler_options is None:
+        return None
+    return job.scheduler_options.get("stage")
+
+
+def _check_stage_paths(job: Job) -> None:
+    """Check the files copied to and from the stage directory are relative paths."""
+    for command in job:
+        for path in [command.requires, command.creates]:
+            if path and Path(path).is_absolute():
+                raise ValueError(
+                    f"Unable to stage the absolute path '{path}' of '{command}', "
+                    "use a path relative to the directory of submission."
+                )
+
+
+def _template_digest(job: Job) -> str:
+    """The template shared by the commands of a job, which are from a single command.
+
+    When the commands have different templates, the template is unknown and left
+    empty, so the commands aren't used to model the runtime of the wrong template.
+
+    """
+    digests = {command.template_digest() for command in job}
+    if len(digests) != 1:
+        if digests:
+            logger.warning("The commands of the job have different templates")
+        return ""
+    return digests.pop()
+
+
+def bundle_job(job: Job, bundle_size: int) -> Job:
+    """A job running bundle_size of the commands of a job one after the other.
+
+    The walltime of the job is multiplied by bundle_size, so each element of the array
+    has the time to run all the commands of its bundle.
+
+    Raises:
+        ValueError: When the walltime of the job is ambiguous.
+
+    """
+    options = dict(job.scheduler_options or {})
+    walltime = parse_walltime(options.get("walltime", DEFAULT_WALLTIME))
+    options["walltime"] = format_walltime(walltime * bundle_size)
+    return job.with_commands(job.commands, options, shard=job.shard)
+
+
+def create_scheduler_file(
+    scheduler: str,
+    job: Job,
+    metrics_file: str = None,
+    command_store: str = None,
+    variables_store: str = None,
+    requires_store: str = None,
+    creates_store: str = None,
+) -> str:
+    """Substitute values into a template scheduler file.
+
+    When a metrics_file is given, each command is run using ``experi record`` which
+    appends the resources used by the command to the metrics file.
+
+    When a command_store is given, each element of the array job reads its command from
+    the command store using ``experi get-command``, rather than the commands being
+    included in the scheduler file as a bash array. The command_store, along with the
+    variables_store when there is a metrics_file, are created using
+    :func:`create_command_store` and are relative to the directory of submission.
+
+    When the scheduler options of the job have a ``stage`` directory, like ``$TMPDIR``,
+    each command runs in a new directory within it, see :data:`STAGE_TEMPLATE`. Only
+    the creates output of the command is copied back to the directory of submission.
+    With a command_store, the requires and creates files of each command are read from
+    the requires_store and creates_store, also created by :func:`create_command_store`.
+    The requires and creates files need to be relative to the directory of submission.
+
+    When the job has a jitter, each element of the array sleeps for a random time of up
+    to jitter seconds before running the command.
+
+    """
+    logger.debug("Create Scheduler File Function")
+
+    header_string, setup_string = _create_header(scheduler, job, len(job))
 
     if scheduler.upper() == "SLURM":
-        workdir = r"$SLURM_SUBMIT_DIR"
         array_index = r"$SLURM_ARRAY_TASK_ID"
     elif scheduler.upper() == "PBS":
-        workdir = r"$PBS_O_WORKDIR"
         array_index = r"$PBS_ARRAY_INDEX"
 
-    return header_string + SCHEDULER_TEMPLATE.format(
+    workdir = _get_workdir(scheduler)
+    stage = stage_directory(job)
+    if stage is not None:
+        _check_stage_paths(job)
+    if stage is not None and metrics_file is not None:
+        # The command runs in the stage directory, so the metrics file needs to be
+        # relative to the directory of submission
+        if not Path(metrics_file).is_absolute():
+            metrics_file = f"{workdir}/{metrics_file}"
+
+    values = dict(
         workdir=workdir,
-        command_list=job.as_bash_array(),
         setup=setup_string,
         array_index=array_index,
+        metrics=metrics_file,
+        template=_template_digest(job) if metrics_file is not None else "",
+        shell=job.shell,
+    )
+    if command_store is not None:
+        values.update(command_store=command_store, variables_store=variables_store)
+        if metrics_file is not None:
+            if variables_store is None:
+                raise ValueError("Recording metrics requires a variables_store.")
+            template, run = METRICS_STORE_TEMPLATE, METRICS_STORE_RUN
+        else:
+            template, run = STORE_TEMPLATE, STORE_RUN
+    else:
+        values.update(command_list=job.as_bash_array())
+        if metrics_file is not None:
+            values.update(variables_list=variables_as_bash_array(job))
+            template, run = METRICS_TEMPLATE, METRICS_RUN
+        else:
+            template, run = SCHEDULER_TEMPLATE, RUN
+
+    run = run.format(**values)
+    if stage is not None:
+        if command_store is not None:
+            if requires_store is None or creates_store is None:
+                raise ValueError(
+                    "Staging the commands requires a requires_store and creates_store."
+                )
+            stage_paths = STAGE_STORE_PATHS.format(
+                requires_store=requires_store, creates_store=creates_store, **values
+            )
+        else:
+            stage_paths = STAGE_PATHS.format(
+                requires_list=_bash_array(command.requires for command in job),
+                creates_list=_bash_array(command.creates for command in job),
+                **values,
+            )
+        run = STAGE_TEMPLATE.format(
+            stage_paths=stage_paths, stage=stage, run=run, **values
+        )
+    if job.jitter > 0:
+        run = JITTER_TEMPLATE.format(jitter=math.ceil(job.jitter)) + run
+    return header_string + template.format(run=run, **values)
+
+
+def create_pilot_file(
+    scheduler: str,
+    job: Job,
+    queue: str,
+    num_workers: int,
+    metrics_file: str = None,
+    max_batches: int = None,
+) -> str:
+    """Create a scheduler file running workers which drain a queue of commands.
+
+    Each element of the array job is a worker running ``experi worker`` on the queue,
+    see :mod:`experi.pilot`, so the queue needs to be accessible from the directory
+    the job is submitted from. When max_batches is given, each worker stops once it has
+    run that number of batches.
+
+    """
+    logger.debug("Create Pilot File Function")
+    if stage_directory(job) is not None:
+        logger.warning("Pilot workers run commands without staging them")
+
+    header_string, setup_string = _create_header(scheduler, job, num_workers)
+    worker_options = ""
+    if metrics_file is not None:
+        worker_options += f'--metrics "{metrics_file}" '
+    if max_batches is not None:
+        worker_options += f"--max-batches {max_batches} "
+
+    jitter = ""
+    if job.jitter > 0:
+        jitter = JITTER_TEMPLATE.format(jitter=math.ceil(job.jitter))
+
+    return header_string + PILOT_TEMPLATE.format(
+        workdir=_get_workdir(scheduler),
+        setup=setup_string,
+        queue=queue,
+        worker_options=worker_options,
+        jitter=jitter,
     )
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""A compact binary file of commands supporting constant time lookup by index.
+
+An element of an array job only runs a single command, so rather than every element
+parsing a bash array containing all the commands of the job, the commands are written to
+a file which is memory mapped to read just the command at an index. The file contains
+
+- a magic string identifying the format,
+- the number of commands as a little endian unsigned 64 bit integer,
+- a table of one more offset than the number of commands, with the command at index i
+  being the bytes between offsets i and i + 1 of the data, and
+- the data, the UTF-8 encoded commands concatenated together.
+
+"""
+
+import logging
+import mmap
+import struct
+from pathlib import Path
+from typing import Iterable, Union
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+MAGIC = b"EXPERI\x00\x01"
+_INTEGER = struct.Struct("<Q")
+# The size of the magic string and the number of commands
+_HEADER_SIZE = len(MAGIC) + _INTEGER.size
+
+
+def store_size(num_items: int, num_bytes: int) -> int:
+    """The size of a command store of num_items strings encoded in num_bytes."""
+    return _HEADER_SIZE + (num_items + 1) * _INTEGER.size + num_bytes
+
+
+def write_store(filename: PathLike, items: Iterable[str]) -> int:
+    """Write strings to a command store, returning the number of strings written."""
+    encoded = [str(item).encode() for item in items]
+    offsets = [0] * (len(encoded) + 1)
+    for index, item in enumerate(encoded):
+        offsets[index + 1] = offsets[index] + len(item)
+    with open(str(filename), "wb") as dst:
+        dst.write(MAGIC)
+        dst.write(_INTEGER.pack(len(encoded)))
+        dst.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        dst.writelines(encoded)
+    logger.debug("Wrote %d commands to %s", len(encoded), filename)
+    return len(encoded)
+
+
+class CommandStore:
+    """A memory mapped command store, where indexing returns a single command.
+
+    Only the pages containing the offsets and the command at an index are read from
+    the file, so the time to look up a command doesn't depend on the size of the store.
+
+    Args:
+        filename: The path of a file created by :func:`write_store`.
+
+    Raises:
+        ValueError: When the file isn't a command store.
+
+    """
+
+    def __init__(self, filename: PathLike) -> None:
+        self.filename = filename
+        with open(str(filename), "rb") as src:
+            if src.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"The file '{filename}' is not a command store")
+            self._map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        (self._length,) = _INTEGER.unpack_from(self._map, len(MAGIC))
+        self._data = _HEADER_SIZE + (self._length + 1) * _INTEGER.size
+
+    def _offset(self, index: int) -> int:
+        return _INTEGER.unpack_from(self._map, _HEADER_SIZE + index * _INTEGER.size)[0]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(
+                f"The index {index} is out of range for {self._length} commands"
+            )
+        start = self._data + self._offset(index)
+        stop = self._data + self._offset(index + 1)
+        return self._map[start:stop].decode()
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __enter__(self) -> "CommandStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def read_command(filename: PathLike, index: int) -> str:
+    """The command at index of the command store in filename."""
+    with CommandStore(filename) as store:
+        return store[index]
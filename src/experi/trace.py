@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Record a timeline of an experiment in the Chrome Trace Event format.
+
+The timeline is made up of spans, with the phases of experi like expanding the
+variables and rendering the commands on the first lane, and each command run in the
+shell on the lane of the worker which ran it. The resulting file can be loaded into
+``chrome://tracing`` or https://ui.perfetto.dev to see where the time of an experiment
+is spent.
+
+Tracing is started with :func:`start_trace`, after which spans are recorded until
+:func:`stop_trace` writes the file. When there is no trace running, recording a span
+does nothing.
+
+"""
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+PathLike = Union[str, Path]
+
+# The lane on which the phases of experi are recorded
+MAIN_LANE = 0
+
+
+class Trace:
+    """A collection of spans in the Chrome Trace Event format."""
+
+    def __init__(self) -> None:
+        self.events: List[Dict[str, Any]] = []
+        self.start_time = time.time()
+        self.pid = os.getpid()
+        self.lanes: Dict[int, str] = {MAIN_LANE: "experi"}
+
+    def add_span(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        lane: int = MAIN_LANE,
+        category: str = "phase",
+        args: Dict[str, Any] = None,
+    ) -> None:
+        """Add a span which started and ended at the times from :func:`time.time`."""
+        self.lanes.setdefault(lane, f"worker {lane}")
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            # Times are in microseconds
+            "ts": (start - self.start_time) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": lane,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def to_dict(self) -> Dict[str, Any]:
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": lane,
+                "args": {"name": name},
+            }
+            for lane, name in sorted(self.lanes.items())
+        ]
+        return {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+
+    def write(self, filename: PathLike) -> None:
+        with open(str(filename), "w") as dst:
+            json.dump(self.to_dict(), dst, default=str)
+
+
+_TRACE: Optional[Trace] = None
+
+
+def start_trace() -> Trace:
+    """Start recording spans."""
+    global _TRACE
+    _TRACE = Trace()
+    return _TRACE
+
+
+def stop_trace(filename: PathLike = None) -> Optional[Trace]:
+    """Stop recording spans, writing the trace to filename when given."""
+    global _TRACE
+    trace, _TRACE = _TRACE, None
+    if trace is not None and filename is not None:
+        logger.debug("Writing trace to %s", filename)
+        trace.write(filename)
+    return trace
+
+
+def add_span(
+    name: str,
+    start: float,
+    end: float,
+    lane: int = MAIN_LANE,
+    category: str = "phase",
+    args: Dict[str, Any] = None,
+) -> None:
+    """Add a span to the running trace."""
+    if _TRACE is not None:
+        _TRACE.add_span(name, start, end, lane, category, args)
+
+
+@contextmanager
+def span(
+    name: str, lane: int = MAIN_LANE, category: str = "phase", args=None
+) -> Iterator[None]:
+    """Record the time taken by the body of the with statement as a span."""
+    if _TRACE is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.time(), lane, category, args)
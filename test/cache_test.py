@@ -0,0 +1,197 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the cache of the outputs of commands."""
+
+import os
+import time
+
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from experi.cache import Cache, parse_size
+from experi.commands import Command, Job
+from experi.run import main, run_bash_job, run_scheduler_jobs
+
+
+def counted(output, requires=""):
+    """A command creating output which counts the number of times it is run."""
+    cmd = "echo run >> count.txt && mkdir -p $(dirname {creates}) && "
+    if requires:
+        cmd += "cat {requires} > {creates} && "
+    cmd += "echo out >> {creates}"
+    return Command(cmd, creates=output, requires=requires)
+
+
+def num_runs(directory):
+    count = directory / "count.txt"
+    if not count.exists():
+        return 0
+    return len(count.read_text().split())
+
+
+@pytest.mark.parametrize(
+    "value, size", [("100", 100), ("1K", 1024), ("1.5kb", 1536), ("2G", 2 * 1024 ** 3)]
+)
+def test_parse_size(value, size):
+    assert parse_size(value) == size
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size("big")
+
+
+def test_key(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    assert cache.key(Command("echo 1"), tmp_dir) is None
+    command = counted("out.txt", "in.txt")
+    # The input doesn't exist
+    assert cache.key(command, tmp_dir) is None
+
+    (tmp_dir / "in.txt").write_text("1")
+    key = cache.key(command, tmp_dir)
+    assert key is not None
+    assert cache.key(counted("other.txt", "in.txt"), tmp_dir) != key
+    (tmp_dir / "in.txt").write_text("2")
+    assert cache.key(command, tmp_dir) != key
+
+
+def test_shared_between_experiments(tmp_dir):
+    """The output of a command is restored in a different directory."""
+    cache = Cache(tmp_dir / "cache")
+    for experiment in ["first", "second"]:
+        directory = tmp_dir / experiment
+        directory.mkdir()
+        (directory / "in.txt").write_text("input\n")
+        job = Job([counted("out/result.txt", "in.txt")])
+        assert run_bash_job(job, directory, cache=cache)
+        assert (directory / "out/result.txt").read_text() == "input\nout\n"
+
+    assert num_runs(tmp_dir / "first") == 1
+    assert num_runs(tmp_dir / "second") == 0
+
+
+def test_changed_input(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    job = Job([counted("out.txt", "in.txt")])
+    for contents in ["1", "2", "1"]:
+        (tmp_dir / "in.txt").write_text(contents)
+        assert run_bash_job(job, tmp_dir, cache=cache)
+    assert num_runs(tmp_dir) == 2
+
+
+def test_failure_not_cached(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    job = Job([Command("touch {creates} && false", creates="out.txt")])
+    assert not run_bash_job(job, tmp_dir, cache=cache)
+    assert not cache.entries()
+
+
+def test_changed_input_output(tmp_dir):
+    """Running a command again with a different input doesn't modify the cache."""
+    cache = Cache(tmp_dir / "cache")
+    job = Job([counted("out.txt", "in.txt")])
+    for contents in ["1\n", "2\n", "1\n", "3\n", "2\n", "3\n"]:
+        (tmp_dir / "in.txt").write_text(contents)
+        assert run_bash_job(job, tmp_dir, cache=cache)
+        assert (tmp_dir / "out.txt").read_text() == contents + "out\n"
+    assert num_runs(tmp_dir) == 3
+
+
+def test_read_only(tmp_dir):
+    """Writing to a restored output can't modify the cache."""
+    cache = Cache(tmp_dir / "cache")
+    job = Job([counted("out.txt")])
+    run_bash_job(job, tmp_dir, cache=cache)
+    # The output of the command isn't shared with the cache
+    assert (tmp_dir / "out.txt").stat().st_nlink == 1
+    (tmp_dir / "out.txt").unlink()
+    run_bash_job(job, tmp_dir, cache=cache)
+    assert (tmp_dir / "out.txt").stat().st_mode & 0o222 == 0
+
+
+def test_cached_directory(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    job = Job([Command("mkdir -p {creates} && touch {creates}/a", creates="out")])
+    run_bash_job(job, tmp_dir, cache=cache)
+    os.chmod(str(tmp_dir / "out"), 0o755)
+    (tmp_dir / "out" / "a").unlink()
+    (tmp_dir / "out").rmdir()
+    run_bash_job(Job([Command("false", creates="out")]), tmp_dir, cache=cache)
+    run_bash_job(job, tmp_dir, cache=cache)
+    assert (tmp_dir / "out" / "a").is_file()
+
+
+def test_lru_eviction(tmp_dir):
+    cache = Cache(tmp_dir / "cache", max_size=2500)
+    commands = [
+        Command("head -c 1000 /dev/zero > {creates}", creates=f"{i}.bin")
+        for i in range(3)
+    ]
+    for command in commands[:2]:
+        run_bash_job(Job([command]), tmp_dir, cache=cache)
+    # Using the first entry makes the second the least recently used
+    entry = cache._entry(cache.key(commands[0], tmp_dir))
+    past = time.time() - 100
+    os.utime(str(cache._entry(cache.key(commands[1], tmp_dir))), (past, past))
+    assert cache.restore(cache.key(commands[0], tmp_dir), commands[0], tmp_dir)
+
+    run_bash_job(Job([commands[2]]), tmp_dir, cache=cache)
+    remaining = {path for _, _, path in cache.entries()}
+    assert entry in remaining
+    assert len(remaining) == 2
+    assert sum(size for _, size, _ in cache.entries()) <= 2500
+
+
+def test_gc_cli(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    run_bash_job(Job([counted("out.txt")]), tmp_dir, cache=cache)
+    assert cache.entries()
+    result = CliRunner().invoke(
+        main, ["cache", "gc", str(tmp_dir / "cache"), "--max-size", "0"]
+    )
+    assert result.exit_code == 0, result.output
+    assert not cache.entries()
+
+
+def test_scheduler_skips_cached(tmp_dir):
+    cache = Cache(tmp_dir / "cache")
+    run_bash_job(Job([counted("0.txt")]), tmp_dir, cache=cache)
+    (tmp_dir / "0.txt").unlink()
+
+    jobs = [Job([counted("0.txt"), counted("1.txt")])]
+    run_scheduler_jobs("pbs", jobs, tmp_dir, cache=cache)
+    assert (tmp_dir / "0.txt").is_file()
+    content = (tmp_dir / "experi_00.pbs").read_text()
+    assert ">> 1.txt" in content
+    assert ">> 0.txt" not in content
+
+
+def test_scheduler_cache_sharded(tmp_dir):
+    """The commands of a sharded job are only sharded once when using the cache."""
+    cache = Cache(tmp_dir / "cache")
+    jobs = [Job([counted(f"{i}.txt") for i in range(8)], shard=(0, 2))]
+    run_scheduler_jobs("pbs", jobs, tmp_dir, cache=cache)
+    content = (tmp_dir / "experi_00.pbs").read_text()
+    for i in range(8):
+        assert (f">> {i}.txt" in content) == (i < 4)
+
+
+def test_cache_cli(tmp_dir):
+    experiment = {
+        "command": {"cmd": "echo {var} > {creates}", "creates": "out_{var}.txt"},
+        "variables": {"var": [1, 2]},
+    }
+    with (tmp_dir / "experiment.yml").open("w") as dst:
+        yaml.safe_dump(experiment, dst)
+    args = ["-f", str(tmp_dir / "experiment.yml"), "--cache", str(tmp_dir / "cache")]
+    result = CliRunner().invoke(main, args + ["--cache-size", "1M"])
+    assert result.exit_code == 0, result.output
+    assert len(Cache(tmp_dir / "cache").entries()) == 2
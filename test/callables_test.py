@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test commands which call python functions."""
+
+import json
+import os
+import shutil
+import subprocess
+import textwrap
+
+import pytest
+from click.testing import CliRunner
+
+from experi.callables import (
+    PythonCommand,
+    call_function,
+    function_arguments,
+    parse_function,
+)
+from experi.commands import Job
+from experi.metrics import read_records
+from experi.pilot import create_queue, run_worker
+from experi.run import main, process_command, run_bash_job, run_scheduler_jobs
+from experi.scheduler import create_scheduler_file
+
+MODULE = "experi_test_functions"
+
+
+@pytest.fixture
+def module(tmp_dir):
+    (tmp_dir / f"{MODULE}.py").write_text(
+        textwrap.dedent(
+            """
+            import os
+            import sys
+
+            def write(value, suffix=""):
+                with open(f"out{value}{suffix}", "w") as dst:
+                    dst.write(str(value))
+
+            def pid(value):
+                with open(f"pid{value}", "w") as dst:
+                    dst.write(str(os.getpid()))
+
+            def fail(value):
+                raise RuntimeError(value)
+
+            def exit(value):
+                sys.exit(value)
+
+            def anything(**kwargs):
+                pass
+            """
+        )
+    )
+    return tmp_dir
+
+
+@pytest.mark.parametrize(
+    "function, expected",
+    [("module:function", ("module", "function")), (" a.b:c ", ("a.b", "c"))],
+)
+def test_parse_function(function, expected):
+    assert parse_function(function) == expected
+
+
+@pytest.mark.parametrize("function", ["module", "module:", ":function"])
+def test_parse_function_invalid(function):
+    with pytest.raises(ValueError):
+        parse_function(function)
+
+
+@pytest.mark.parametrize(
+    "function, expected",
+    [
+        ("write", {"value", "suffix"}),
+        ("fail", {"value"}),
+        ("anything", {"value", "suffix", "a"}),
+    ],
+)
+def test_function_arguments(module, function, expected):
+    variables = {"value", "suffix", "a"}
+    assert function_arguments(f"{MODULE}:{function}", variables, module) == expected
+
+
+def test_function_arguments_missing(module):
+    with pytest.raises(ValueError):
+        function_arguments(f"{MODULE}:missing", [], module)
+
+
+def test_python_command():
+    command = PythonCommand(
+        "mod:func", {"value": 1, "other": 2}, creates="{other}", arguments={"value"}
+    )
+    assert command.kwargs == {"value": 1}
+    assert command.creates == "2"
+    assert str(command) == """experi call mod:func '{"value": 1}'"""
+    assert command.template_digest() == PythonCommand("mod:func").template_digest()
+
+
+def test_process_command(module):
+    matrix = [{"value": v, "unused": u} for v in range(3) for u in range(4)]
+    commands = process_command({"python": f"{MODULE}:write"}, matrix, directory=module)
+    assert [command.kwargs for command in commands] == [{"value": v} for v in range(3)]
+
+
+@pytest.mark.parametrize(
+    "function, kwargs, exit_code",
+    [("write", {"value": 1}, 0), ("fail", {"value": 1}, 1), ("exit", {"value": 3}, 3)],
+)
+def test_call_function(module, monkeypatch, function, kwargs, exit_code):
+    monkeypatch.chdir(module)
+    usage = call_function(f"{MODULE}:{function}", kwargs, module)
+    assert usage["exit_code"] == exit_code
+    assert usage["wall_time"] >= 0
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_run_job(module, processes):
+    commands = [PythonCommand(f"{MODULE}:write", {"value": v}) for v in range(4)]
+    assert run_bash_job(Job(commands), module, "metrics.jsonl", processes)
+    for value in range(4):
+        assert (module / f"out{value}").read_text() == str(value)
+    records = list(read_records(module / "metrics.jsonl"))
+    assert len(records) == 4
+    assert all(record["exit_code"] == 0 for record in records)
+
+
+def test_run_job_failure(module):
+    commands = [PythonCommand(f"{MODULE}:fail", {"value": 1})]
+    assert not run_bash_job(Job(commands), module)
+
+
+def test_pilot_worker(module, monkeypatch):
+    monkeypatch.chdir(module)
+    commands = [PythonCommand(f"{MODULE}:write", {"value": v}) for v in range(4)]
+    create_queue(Job(commands), module / "queue", batch_size=2)
+    assert run_worker(module / "queue") == 0
+    assert (module / "out3").is_file()
+
+
+def test_call_cli(module, monkeypatch):
+    monkeypatch.chdir(module)
+    kwargs = json.dumps({"value": 5, "suffix": "cli"})
+    result = CliRunner().invoke(main, ["call", f"{MODULE}:write", kwargs])
+    assert result.exit_code == 0, result.output
+    assert (module / "out5cli").read_text() == "5"
+    result = CliRunner().invoke(main, ["call", f"{MODULE}:exit", '{"value": 2}'])
+    assert result.exit_code == 2
+
+
+def test_launch(module):
+    (module / "experiment.yml").write_text(
+        textwrap.dedent(
+            f"""
+            command:
+                python: {MODULE}:write
+                creates: out{{value}}
+            variables:
+                value: [1, 2, 3]
+                unused: [a, b]
+            """
+        )
+    )
+    result = CliRunner().invoke(main, ["-f", str(module / "experiment.yml")])
+    assert result.exit_code == 0, result.output
+    for value in [1, 2, 3]:
+        assert (module / f"out{value}").read_text() == str(value)
+
+
+@pytest.mark.skipif(shutil.which("experi") is None, reason="experi is not installed")
+@pytest.mark.parametrize(
+    "scheduler, index", [("pbs", "PBS_ARRAY_INDEX"), ("slurm", "SLURM_ARRAY_TASK_ID")]
+)
+def test_scheduler_file(module, scheduler, index):
+    """The quoted arguments of a function are passed through the array job."""
+    matrix = [{"value": v, "suffix": " '$x"} for v in range(3)]
+    job = Job(process_command({"python": f"{MODULE}:write"}, matrix, directory=module))
+    (module / "job.sh").write_text(create_scheduler_file(scheduler, job))
+    env = dict(os.environ, PBS_O_WORKDIR=str(module), SLURM_SUBMIT_DIR=str(module))
+    env[index] = "1"
+    subprocess.run(["bash", str(module / "job.sh")], env=env, check=True)
+    assert (module / "out1 '$x").read_text() == "1"
+    assert not (module / "out0 '$x").exists()
+
+
+@pytest.mark.skipif(shutil.which("experi") is None, reason="experi is not installed")
+def test_scheduler_bundle(module):
+    """Each element of the array calls a bundle of functions in a single process."""
+    matrix = [{"value": v} for v in range(3)]
+    commands = process_command({"python": f"{MODULE}:pid"}, matrix, directory=module)
+    job = Job(commands, {"walltime": "1:00:00"})
+    run_scheduler_jobs("pbs", iter([job]), module, python_bundle=2)
+    content = (module / "experi_00.pbs").read_text()
+    assert "#PBS -J 0-1\n" in content
+    assert "#PBS -l walltime=2:00:00\n" in content
+    for index in ["0", "1"]:
+        env = dict(os.environ, PBS_O_WORKDIR=str(module), PBS_ARRAY_INDEX=index)
+        subprocess.run(["bash", str(module / "experi_00.pbs")], env=env, check=True)
+    pids = [(module / f"pid{v}").read_text() for v in range(3)]
+    assert pids[0] == pids[1]
+    assert pids[2] != pids[0]
@@ -78,3 +78,96 @@ def test_dry_run(runner, test_file, scheduler):
         elif scheduler == "slurm":
             assert "sbatch" in result.output
             assert Path("experi_00.slurm").is_file()
+
+
+@pytest.fixture()
+def shard_file():
+    return textwrap.dedent(
+        """
+        command: echo {var1}
+
+        variables:
+            var1: [0, 1, 2, 3]
+    """
+    )
+
+
+@pytest.mark.parametrize(
+    "shard, expected", [("0/2", ["0", "1"]), ("1/2", ["2", "3"]), ("3/4", ["3"])]
+)
+def test_shard(runner, shard_file, shard, expected):
+    with runner.isolated_filesystem():
+        with open("experiment.yml", "w") as dst:
+            dst.write(shard_file)
+
+        result = runner.invoke(main, ["--dry-run", "--shard", shard])
+        assert result.exit_code == 0, result.exception
+        assert result.output.split("\n")[:-1] == [
+            f"bash -c 'echo {i}'" for i in expected
+        ]
+
+
+@pytest.mark.parametrize("shard", ["2/2", "1", "a/b", "-1/2"])
+def test_shard_invalid(runner, shard_file, shard):
+    with runner.isolated_filesystem():
+        with open("experiment.yml", "w") as dst:
+            dst.write(shard_file)
+
+        result = runner.invoke(main, ["--dry-run", "--shard", shard])
+        assert result.exit_code != 0
+
+
+@pytest.mark.parametrize("fuse, num_jobs", [(False, 2), (True, 1)])
+def test_fuse(runner, fuse, num_jobs):
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(
+            textwrap.dedent(
+                """
+                jobs:
+                    - command:
+                        cmd: echo {var} > {creates}
+                        creates: a-{var}.txt
+                    - command:
+                        cmd: cat {requires} > {creates}
+                        requires: a-{var}.txt
+                        creates: b-{var}.txt
+                variables:
+                    var: [0, 1, 2, 3]
+                """
+            )
+        )
+        result = runner.invoke(main, ["--plan-summary"] + (["--fuse"] if fuse else []))
+        assert result.exit_code == 0, result.output
+        assert f"Total: {num_jobs} jobs" in result.output
+
+
+def test_multiple_input_files(runner):
+    """The experiments are merged into the same jobs, removing duplicate commands."""
+    with runner.isolated_filesystem():
+        for name, values in [("a.yml", [0, 1]), ("b.yml", [1, 2])]:
+            Path(name).write_text(
+                f"command: echo {{var}}\nvariables:\n    var: {values}\n"
+                "pbs:\n    ncpus: 1\n"
+            )
+        result = runner.invoke(main, ["-f", "a.yml", "-f", "b.yml", "--dry-run"])
+        assert result.exit_code == 0, result.output
+        assert not Path("experi_01.pbs").exists()
+        content = Path("experi_00.pbs").read_text()
+        assert "#PBS -J 0-2" in content
+        for value in range(3):
+            assert content.count(f"echo {value}") == 1
+
+
+def test_multiple_input_files_scheduler(runner):
+    with runner.isolated_filesystem():
+        Path("a.yml").write_text("command: echo {var}\nvariables:\n    var: 1\n")
+        Path("b.yml").write_text(
+            "command: echo {var}\nvariables:\n    var: 2\npbs:\n    ncpus: 1\n"
+        )
+        result = runner.invoke(main, ["-f", "a.yml", "-f", "b.yml", "--plan-summary"])
+        assert isinstance(result.exception, ValueError)
+        result = runner.invoke(
+            main, ["-f", "a.yml", "-f", "b.yml", "--plan-summary", "-s", "shell"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Total: 1 jobs, 2 commands" in result.output
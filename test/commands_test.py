@@ -13,8 +13,16 @@ from tempfile import TemporaryDirectory
 
 import pytest
 
-from experi.commands import Command, Job
-from experi.run import uniqueify
+from experi.commands import (
+    Command,
+    FusedCommand,
+    Job,
+    fuse_jobs,
+    parse_walltime,
+    referenced_variables,
+    template_variables,
+)
+from experi.run import run_bash_jobs, uniqueify
 
 
 def test_command_simple():
@@ -134,3 +142,221 @@ def test_job_length_depends(tmp_dir):
         [Command("echo", creates="test.txt")], directory=tmp_dir, use_dependencies=True
     )
     assert len(job) == 0
+
+
+def test_command_digest():
+    assert Command("echo 1").digest() == Command("echo 1").digest()
+    assert Command("echo 1").digest() != Command("echo 2").digest()
+    command_list = Command(["echo 1", "echo 2"])
+    assert command_list.digest() != Command("echo 1 && echo 2").digest()
+
+
+@pytest.mark.parametrize("shard_by", ["block", "hash"])
+@pytest.mark.parametrize("num_shards", [1, 3, 20])
+def test_job_shard(shard_by, num_shards):
+    commands = [Command(f"echo {i}") for i in range(10)]
+    shards = [
+        list(Job(commands, shard=(i, num_shards), shard_by=shard_by))
+        for i in range(num_shards)
+    ]
+    # Every command is in exactly one shard retaining the order
+    assert sorted(sum(shards, []), key=commands.index) == commands
+    for shard in shards:
+        assert shard == sorted(shard, key=commands.index)
+    if shard_by == "block":
+        assert max(len(s) for s in shards) - min(len(s) for s in shards) <= 1
+
+
+def test_job_shard_invalid():
+    with pytest.raises(ValueError):
+        Job([Command("echo")], shard=(0, 2), shard_by="unknown")
+
+
+@pytest.mark.parametrize("options", [{"max_concurrent": 0}, {"jitter": -1}])
+def test_job_throttle_invalid(options):
+    with pytest.raises(ValueError):
+        Job([Command("echo")], **options)
+
+
+def test_job_with_commands():
+    job = Job([Command("echo 1")], {"name": "a"}, max_concurrent=2, jitter=1.5)
+    other = job.with_commands([Command("echo 2")])
+    assert other.commands == [Command("echo 2")]
+    assert other.scheduler_options == {"name": "a"}
+    assert (other.max_concurrent, other.jitter) == (2, 1.5)
+
+
+@pytest.mark.parametrize(
+    "template, variables",
+    [
+        ("echo {a} {b}", {"a", "b"}),
+        ("echo {a[0]} {b.real}", {"a", "b"}),
+        ("echo {a:.{precision}f}", {"a", "precision"}),
+        ("echo {{a}}", set()),
+    ],
+)
+def test_template_variables(template, variables):
+    assert template_variables(template) == variables
+
+
+def test_referenced_variables():
+    assert referenced_variables(
+        ["echo {a} > {creates}", "cat {requires}"], "{b}.txt", "{c}.txt"
+    ) == {"a", "b", "c"}
+
+
+def _stage(name, values, requires=None, idempotent=False):
+    return [
+        Command(
+            f"cat {{requires}} > {{creates}} && echo {name} >> {{creates}}"
+            if requires
+            else "echo {value} > {creates}",
+            {"value": value},
+            creates=f"{name}-{{value}}.txt",
+            requires="" if requires is None else f"{requires}-{{value}}.txt",
+            idempotent=idempotent,
+        )
+        for value in values
+    ]
+
+
+def test_fused_command():
+    first, second, third = (
+        _stage("a", [1])[0],
+        _stage("b", [1], "a", idempotent=True)[0],
+        _stage("c", [1], "b")[0],
+    )
+    fused = FusedCommand([FusedCommand([first, second]), third])
+    assert fused.stages == [first, second, third]
+    assert fused.cmd == first.cmd + second.cmd + third.cmd
+    assert fused.requires == ""
+    assert fused.creates == "c-1.txt"
+    assert fused.variables == {"value": 1}
+    assert not fused.idempotent
+    other = FusedCommand([_stage("a", [2])[0], _stage("b", [2], "a")[0]])
+    assert FusedCommand([first, second]).template_digest() == other.template_digest()
+
+
+def test_fuse_jobs():
+    values = [1, 2, 3]
+    jobs = [
+        Job(_stage("a", values), {"walltime": "1:00"}),
+        # The order of the commands doesn't need to match
+        Job(_stage("b", values[::-1], "a")),
+        Job(_stage("c", values, "b")),
+    ]
+    fused = list(fuse_jobs(jobs))
+    assert len(fused) == 1
+    # Each stage runs for up to the walltime
+    assert fused[0].scheduler_options == {"walltime": "0:03:00"}
+    assert [command.creates for command in fused[0]] == [
+        f"c-{value}.txt" for value in values
+    ]
+
+
+@pytest.mark.parametrize(
+    "walltimes, expected",
+    [
+        (["2:00:00", "30:00", "1-00:00:00"], "26:30:00"),
+        ([None, "10:00"], "0:11:00"),
+        (["1:30:00", "90"], None),
+    ],
+)
+def test_fuse_jobs_walltime(walltimes, expected):
+    stages = [_stage("a", [1]), _stage("b", [1], "a"), _stage("c", [1], "b")]
+    jobs = [
+        Job(commands, None if walltime is None else {"walltime": walltime})
+        for commands, walltime in zip(stages, walltimes)
+    ]
+    fused = list(fuse_jobs(jobs))
+    if expected is None:
+        # The ambiguous walltime of the last stage means it isn't fused
+        assert len(fused) == 2
+    else:
+        assert len(fused) == 1
+        assert fused[0].scheduler_options["walltime"] == expected
+
+
+@pytest.mark.parametrize(
+    "walltime, seconds",
+    [
+        ("1:00", 60),
+        ("45:10", 2710),
+        ("2:30:00", 9000),
+        ("1-2", 93600),
+        ("1-0:30", 88200),
+    ],
+)
+def test_parse_walltime(walltime, seconds):
+    assert parse_walltime(walltime) == seconds
+
+
+@pytest.mark.parametrize("walltime", ["60", "ten:00", 30])
+def test_parse_walltime_invalid(walltime):
+    with pytest.raises(ValueError):
+        parse_walltime(walltime)
+
+
+@pytest.mark.parametrize(
+    "second",
+    [
+        # Each command requires the same output
+        [Command("cat {requires}", requires="a-1.txt") for _ in range(3)],
+        # A command requires an output which isn't created
+        _stage("b", [1, 2, 4], "a"),
+        # A different number of commands
+        _stage("b", [1, 2], "a"),
+        # The commands have no requirements
+        _stage("b", [1, 2, 3]),
+    ],
+)
+def test_fuse_jobs_mismatch(second):
+    jobs = [Job(_stage("a", [1, 2, 3])), Job(second), Job(_stage("c", [1], "b"))]
+    assert len(list(fuse_jobs(jobs))) == 3
+
+
+@pytest.mark.parametrize(
+    "options, num_jobs",
+    [
+        ({"ncpus": 1, "walltime": "10:00"}, 1),
+        ({"ncpus": 4}, 2),
+        ({"ncpus": 1, "setup": "module load b"}, 2),
+        (None, 2),
+    ],
+)
+def test_fuse_jobs_options(options, num_jobs):
+    jobs = [
+        Job(_stage("a", [1, 2]), {"ncpus": 1}),
+        Job(_stage("b", [1, 2], "a"), options),
+    ]
+    fused = list(fuse_jobs(jobs))
+    assert len(fused) == num_jobs
+    if num_jobs == 1:
+        assert fused[0].scheduler_options == {"ncpus": 1, "walltime": "0:11:00"}
+    else:
+        # Each stage keeps its own options
+        assert fused[1].scheduler_options == options
+
+
+@pytest.mark.parametrize("stage, num_jobs", [(None, 2), ("$TMPDIR", 3)])
+def test_fuse_jobs_required_elsewhere(stage, num_jobs):
+    """The output of a staged stage isn't kept, so it can't be required later."""
+    options = {} if stage is None else {"stage": stage}
+    jobs = [
+        Job(_stage("a", [1, 2]), options),
+        Job(_stage("b", [1, 2], "a"), options),
+        Job(_stage("c", [1, 2], "a"), options),
+    ]
+    assert len(list(fuse_jobs(jobs))) == num_jobs
+
+
+def test_fused_jobs_run(tmp_dir):
+    values = [1, 2, 3]
+    jobs = [
+        Job(_stage("a", values)),
+        Job(_stage("b", values, "a")),
+        Job(_stage("c", values, "b")),
+    ]
+    run_bash_jobs(fuse_jobs(jobs), tmp_dir)
+    for value in values:
+        assert (tmp_dir / f"c-{value}.txt").read_text() == f"{value}\nb\nc\n"
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the conditions of the where key."""
+
+import numpy as np
+import pytest
+from hypothesis import given
+from hypothesis.strategies import integers, lists
+
+from experi.condition import Condition
+from experi.run import filtered_product, variable_matrix
+
+
+@pytest.mark.parametrize(
+    "expression, values, expected",
+    [
+        ("a > 1", {"a": 2}, True),
+        ("a > 1", {"a": 1}, False),
+        ("a * 2 + 1 == b", {"a": 1, "b": 3}, True),
+        ("1 < a <= 3", {"a": 3}, True),
+        ("1 < a <= 3", {"a": 4}, False),
+        ("a > 1 and b != 'x'", {"a": 2, "b": "x"}, False),
+        ("a > 1 or not b", {"a": 0, "b": False}, True),
+        ("a in [1, 2]", {"a": 2}, True),
+        ("a not in ('x', 'y')", {"a": "x"}, False),
+        ("abs(a - b) < 0.5", {"a": 1.0, "b": 1.2}, True),
+        ("max(a, b) % 2 == 0", {"a": 1, "b": 4}, True),
+        ("sqrt(a) ** 2 >= a - 1e-9", {"a": 2}, True),
+    ],
+)
+def test_condition(expression, values, expected):
+    condition = Condition(expression)
+    assert condition(values) == expected
+
+
+def test_condition_arrays():
+    condition = Condition("a > b and a in [2, 3]")
+    values = {"a": np.array([1, 2, 3, 4]), "b": np.array([0, 3, 2, 1])}
+    assert condition.evaluate(values).tolist() == [False, False, True, False]
+
+
+def test_condition_variables():
+    assert Condition("a * b > c").variables == {"a", "b", "c"}
+    assert Condition("abs(a) > 1").variables == {"a"}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "__import__('os').system('true')",
+        "a.__class__",
+        "open('file')",
+        "[x for x in a]",
+        "a if b else c",
+        "a is None",
+        "lambda: 1",
+        "a >",
+    ],
+)
+def test_unsupported(expression):
+    with pytest.raises(ValueError):
+        Condition(expression)
+
+
+def test_undefined_variable():
+    with pytest.raises(ValueError):
+        Condition("a > missing")({"a": 1})
+
+
+def test_where():
+    variables = {
+        "temperature": [1, 2, 3],
+        "pressure": [1, 2],
+        "where": "temperature > pressure",
+    }
+    assert list(variable_matrix(variables)) == [
+        {"temperature": 2, "pressure": 1},
+        {"temperature": 3, "pressure": 1},
+        {"temperature": 3, "pressure": 2},
+    ]
+
+
+def test_where_list():
+    variables = {
+        "a": {"arange": {"start": 1, "stop": 10}},
+        "where": ["a % 2 == 0", "a > 4"],
+    }
+    assert [row["a"] for row in variable_matrix(variables)] == [6, 8]
+
+
+def test_where_strings():
+    variables = {
+        "crystal": ["p2", "pg", "liquid"],
+        "temperature": [0.1, 1.0],
+        "where": "crystal != 'liquid' or temperature > 0.5",
+    }
+    assert len(list(variable_matrix(variables))) == 5
+
+
+def test_where_nested():
+    """A where key applies to the variables of the mapping it is in."""
+    variables = {
+        "zip": {"a": [1, 2, 3], "b": [3, 2, 1], "where": "a <= b"},
+        "c": [0, 1],
+        "where": "c < a",
+    }
+    assert list(variable_matrix(variables)) == [
+        {"a": 1, "b": 3, "c": 0},
+        {"a": 2, "b": 2, "c": 0},
+        {"a": 2, "b": 2, "c": 1},
+    ]
+
+
+def test_where_undefined():
+    with pytest.raises(ValueError):
+        list(variable_matrix({"a": [1, 2], "where": "b > 1"}))
+    with pytest.raises(ValueError):
+        list(variable_matrix({"zip": {"a": [1, 2]}, "where": "b > 1"}))
+
+
+def test_where_does_not_modify_input():
+    variables = {"a": [1, 2], "where": "a > 1"}
+    list(variable_matrix(variables))
+    assert variables == {"a": [1, 2], "where": "a > 1"}
+
+
+def test_filtered_product_prunes():
+    """No further combinations are generated from a failing partial combination."""
+    checked = []
+
+    class Recorder(Condition):
+        def evaluate(self, values):
+            checked.append(dict(values))
+            return super().evaluate(values)
+
+    key_vars = [[{"a": 1}, {"a": 2}], [{"b": i} for i in range(3)]]
+    rows = list(filtered_product(key_vars, [Recorder("a > 1"), Recorder("b < a")]))
+    assert rows == [{"a": 2, "b": 0}, {"a": 2, "b": 1}]
+    # The values of b are only checked for a == 2
+    assert all(values["a"] == 2 for values in checked if "b" in values)
+
+
+@given(
+    lists(integers(-5, 5), min_size=1, max_size=6, unique=True),
+    lists(integers(-5, 5), min_size=1, max_size=6, unique=True),
+    integers(-5, 5),
+)
+def test_where_columnar_matches_generic(a_values, b_values, offset):
+    """The vectorised conditions give the same result as the generic product."""
+    where = f"a + {offset} > b or a == b"
+    columnar = list(variable_matrix({"a": a_values, "b": b_values, "where": where}))
+    key_vars = [[{"a": a} for a in a_values], [{"b": b} for b in b_values]]
+    generic = list(filtered_product(key_vars, [Condition(where)]))
+    assert columnar == generic
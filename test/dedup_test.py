@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test removing duplicates with bounded memory."""
+
+from hypothesis import given
+from hypothesis.strategies import integers, lists
+
+from experi.commands import Command
+from experi.dedup import SeenSet, command_key, unique
+from experi.run import process_command, uniqueify, variable_matrix
+
+
+def test_seen_set_spill():
+    with SeenSet(max_keys=3) as seen:
+        assert [seen.add(str(i).encode()) for i in range(3)] == [True] * 3
+        assert not seen.on_disk
+        assert seen.add(b"3")
+        assert seen.on_disk
+        assert not seen.add(b"0")
+        assert not seen.add(b"3")
+        assert seen.add(b"4")
+        assert len(seen) == 5
+
+
+@given(lists(integers(0, 20)), integers(1, 5))
+def test_unique(values, max_keys):
+    """The first occurrence of each item is kept when spilling to disk."""
+    result = list(unique(values, lambda v: str(v).encode(), max_keys))
+    assert result == uniqueify(values)
+
+
+def test_command_key():
+    assert command_key(Command(["a", "b"])) == command_key(Command(["a", "b"]))
+    assert command_key(Command(["a && b"])) != command_key(Command(["a", "b"]))
+
+
+def test_process_command_on_disk():
+    matrix = list(variable_matrix({"a": [3, 1, 2] * 5, "b": [1, 2], "c": [0, 1]}))
+    commands = process_command("echo {a} {b}", matrix, max_keys=2)
+    assert [str(c) for c in commands] == [
+        str(c) for c in process_command("echo {a} {b}", matrix)
+    ]
+    assert len(commands) == 6
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test summarising the jobs of an experiment without running them."""
+
+import io
+import textwrap
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from experi.commands import Command, Job
+from experi.dryrun import (
+    JobSummary,
+    format_size,
+    format_summaries,
+    summarise_jobs,
+    write_lines,
+)
+from experi.run import main
+from experi.scheduler import create_command_store, create_scheduler_file
+
+
+@pytest.mark.parametrize(
+    "num_bytes, expected",
+    [(0, "0 B"), (1023, "1023 B"), (1536, "1.5 KB"), (2 ** 30, "1.0 GB")],
+)
+def test_format_size(num_bytes, expected):
+    assert format_size(num_bytes) == expected
+
+
+def test_summary_complete(tmp_dir):
+    (tmp_dir / "out1").touch()
+    job = Job(
+        [Command("echo {a}", creates="out{a}", variables={"a": a}) for a in range(5)],
+        directory=tmp_dir,
+        use_dependencies=True,
+    )
+    summary = JobSummary(job, 0, num_samples=2)
+    assert summary.num_commands == 4
+    assert summary.num_complete == 1
+    assert summary.samples == ["echo 0", "echo 2"]
+    assert "... and 2 more" in str(summary)
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_summary_script_size(scheduler):
+    job = Job([Command(f"echo {i}") for i in range(1000)])
+    summary = JobSummary(job, 0, scheduler)
+    actual = len(create_scheduler_file(scheduler, job).encode())
+    assert summary.script_size == pytest.approx(actual, rel=0.01)
+
+
+def test_summary_store_size(tmp_dir):
+    job = Job([Command(f"echo ünïcödé {i}") for i in range(100)])
+    summary = JobSummary(job, 0, "pbs", command_store=True)
+    create_command_store(job, tmp_dir / "store")
+    assert summary.store_size == (tmp_dir / "store").stat().st_size
+
+
+def test_format_summaries():
+    jobs = [Job([Command("echo 1"), Command("echo 2")]), Job([Command("echo 3")])]
+    output = format_summaries(summarise_jobs(jobs))
+    assert output.splitlines()[0] == "Job 0: 2 commands"
+    assert output.splitlines()[-1] == "Total: 2 jobs, 3 commands"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 100])
+def test_write_lines(chunk_size):
+    dst = io.StringIO()
+    lines = [f"line {i}" for i in range(10)]
+    assert write_lines(iter(lines), dst, chunk_size) == 10
+    assert dst.getvalue() == "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("scheduler", ["shell", "pbs"])
+def test_summary_cli(scheduler):
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("experiment.yml").write_text(
+            textwrap.dedent(
+                """
+                command: echo {var}
+                variables:
+                    var: [0, 1, 2, 3, 4]
+                """
+            )
+        )
+        result = runner.invoke(main, ["--plan-summary", "--scheduler", scheduler])
+        assert result.exit_code == 0, result.output
+        assert "Job 0: 5 commands" in result.output
+        assert "echo 0" in result.output
+        assert "echo 4" not in result.output
+        assert not Path("experi_00.pbs").exists()
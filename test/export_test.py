@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test exporting the variables and commands of an experiment."""
+
+import csv
+import json
+
+import numpy as np
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from experi.export import get_columns, infer_dtype, infer_format, write_rows
+from experi.run import main
+
+ROWS = [
+    {"temperature": 0.5, "pressure": 1, "crystal": "p2"},
+    {"temperature": 1.0, "pressure": 13, "crystal": "liquid"},
+    {"temperature": 1, "pressure": 2},
+]
+
+
+@pytest.mark.parametrize(
+    "filename, fmt", [("a.csv", "csv"), ("a.JSONL", "jsonl"), ("a.npy", "npy")]
+)
+def test_infer_format(filename, fmt):
+    assert infer_format(filename) == fmt
+
+
+def test_infer_format_unknown():
+    with pytest.raises(ValueError):
+        infer_format("a.txt")
+
+
+def test_get_columns():
+    rows = [{"a": 1}, {"a": 1, "b": 2}, {"c": 3, "a": 1}]
+    assert get_columns(iter(rows)) == ["a", "b", "c"]
+
+
+def test_infer_dtype():
+    dtype = infer_dtype(iter(ROWS), ["temperature", "pressure", "crystal"])
+    assert dtype["temperature"] == np.float64
+    assert dtype["pressure"] == np.int64
+    assert dtype["crystal"] == np.dtype("U6")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_write_csv(tmp_dir, chunk_size):
+    output = tmp_dir / "rows.csv"
+    assert write_rows(lambda: iter(ROWS), output, chunk_size=chunk_size) == 3
+    with output.open() as src:
+        rows = list(csv.DictReader(src))
+    assert [row["crystal"] for row in rows] == ["p2", "liquid", ""]
+    assert [row["pressure"] for row in rows] == ["1", "13", "2"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_write_jsonl(tmp_dir, chunk_size):
+    output = tmp_dir / "rows.jsonl"
+    write_rows(lambda: iter(ROWS), output, chunk_size=chunk_size)
+    rows = [json.loads(line) for line in output.read_text().splitlines()]
+    assert rows == ROWS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_write_npy(tmp_dir, chunk_size):
+    output = tmp_dir / "rows.npy"
+    write_rows(lambda: iter(ROWS), output, chunk_size=chunk_size)
+    array = np.load(str(output))
+    assert array.shape == (3,)
+    assert array["temperature"].tolist() == [0.5, 1.0, 1.0]
+    assert array["pressure"].tolist() == [1, 13, 2]
+    assert array["crystal"].tolist() == ["p2", "liquid", ""]
+
+
+def test_write_npy_missing_integer(tmp_dir):
+    output = tmp_dir / "rows.npy"
+    write_rows(lambda: iter([{"a": 1}, {"b": 2}]), output)
+    array = np.load(str(output))
+    assert array["a"][0] == 1
+    assert np.isnan(array["a"][1])
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl", "npy"])
+def test_write_rows_once(tmp_dir, fmt):
+    calls = []
+
+    def rows():
+        calls.append(None)
+        return iter(ROWS)
+
+    assert write_rows(rows, tmp_dir / f"rows.{fmt}", chunk_size=1) == 3
+    assert len(calls) == 1
+
+
+def test_write_late_column(tmp_dir):
+    rows = [{"a": 1}, {"a": 2}, {"a": 3, "b": 4}]
+    write_rows(lambda: iter(rows), tmp_dir / "rows.npy", chunk_size=2)
+    array = np.load(str(tmp_dir / "rows.npy"))
+    assert array["a"].tolist() == [1, 2, 3]
+    assert np.isnan(array["b"][:2]).all()
+    assert array["b"][2] == 4
+    write_rows(lambda: iter(rows), tmp_dir / "rows.csv", chunk_size=2)
+    with (tmp_dir / "rows.csv").open() as src:
+        assert [row["b"] for row in csv.DictReader(src)] == ["", "", "4"]
+
+
+@pytest.fixture
+def experiment(tmp_dir):
+    structure = {
+        "jobs": [{"command": "echo {a} {b}"}, {"command": "echo {a}"}],
+        "variables": {"a": [1, 2, 3], "b": ["x", "y"]},
+    }
+    with (tmp_dir / "experiment.yml").open("w") as dst:
+        yaml.safe_dump(structure, dst)
+    return tmp_dir / "experiment.yml"
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl", "npy"])
+def test_expand_variables(tmp_dir, experiment, fmt):
+    output = str(tmp_dir / f"variables.{fmt}")
+    result = CliRunner().invoke(main, ["expand", "-f", str(experiment), output])
+    assert result.exit_code == 0, result.output
+    assert "Wrote 6 rows" in result.output
+
+
+def test_expand_commands(tmp_dir, experiment):
+    output = tmp_dir / "commands.csv"
+    result = CliRunner().invoke(
+        main, ["expand", "-f", str(experiment), "--commands", str(output)]
+    )
+    assert result.exit_code == 0, result.output
+    with output.open() as src:
+        rows = list(csv.DictReader(src))
+    assert len(rows) == 9
+    assert list(rows[0].keys()) == ["job", "command", "a", "b"]
+    assert rows[0]["command"] == "echo 1 x"
+    assert [row["command"] for row in rows if row["job"] == "1"] == [
+        "echo 1",
+        "echo 2",
+        "echo 3",
+    ]
+
+
+@pytest.mark.parametrize("commands", [[], ["--commands"]])
+def test_expand_streams_variables(tmp_dir, experiment, monkeypatch, commands):
+    """The combinations of the variables are never all held in memory."""
+
+    def process_variables(structure):
+        raise AssertionError("The variables are expanded into a list")
+
+    monkeypatch.setattr("experi.run.process_variables", process_variables)
+    output = str(tmp_dir / "rows.jsonl")
+    result = CliRunner().invoke(
+        main, ["expand", "-f", str(experiment), output] + commands
+    )
+    assert result.exit_code == 0, result.output
+
+
+def test_expand_unknown_format(tmp_dir, experiment):
+    output = str(tmp_dir / "variables.txt")
+    result = CliRunner().invoke(main, ["expand", "-f", str(experiment), output])
+    assert result.exit_code != 0
+    result = CliRunner().invoke(
+        main, ["expand", "-f", str(experiment), "--format", "csv", output]
+    )
+    assert result.exit_code == 0, result.output
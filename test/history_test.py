@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test predicting the runtime of commands from previous runs."""
+
+import time
+
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from experi.commands import Command, Job
+from experi.history import RuntimeModel
+from experi.metrics import create_record, write_record
+from experi.run import main, run_bash_job, run_scheduler_jobs
+from experi.scheduler import format_memory, format_walltime, split_by_resources
+
+TEMPLATE = "simulate --temperature {temp} --pressure {pres}"
+
+
+def simulation(temp, pres):
+    return Command(TEMPLATE, {"temp": temp, "pres": pres})
+
+
+def history(wall_time, temps, pressures, exit_code=0):
+    """Records of runs of the simulation with a wall time from the variables."""
+    return [
+        create_record(
+            str(command),
+            command.variables,
+            {
+                "exit_code": exit_code,
+                "wall_time": wall_time(temp, pres),
+                "max_rss": 1024 * temp,
+            },
+            command.template_digest(),
+        )
+        for temp in temps
+        for pres in pressures
+        for command in [simulation(temp, pres)]
+    ]
+
+
+def test_template_digest():
+    assert simulation(1, 2).template_digest() == simulation(3, 4).template_digest()
+    assert simulation(1, 2).template_digest() != Command("echo 1").template_digest()
+
+
+def test_predict_previous_run():
+    records = history(lambda temp, pres: temp * pres, [1, 2], [1, 2])
+    model = RuntimeModel(records)
+    assert model.predict(simulation(2, 2)) == pytest.approx(4)
+    assert model.predict(Command("echo 1")) is None
+
+
+def test_predict_ignores_failures():
+    records = history(lambda temp, pres: 1, [1], [1])
+    records += history(lambda temp, pres: 100, [1], [1], exit_code=1)
+    assert RuntimeModel(records).predict(simulation(1, 1)) == pytest.approx(1)
+
+
+def test_predict_unseen_values():
+    """A separable runtime is predicted exactly for unseen combinations."""
+    records = history(lambda temp, pres: 10 / temp * pres, [1, 2, 4], [1, 2])
+    # Remove a combination which is predicted from the main effects
+    model = RuntimeModel(records[1:])
+    assert model.predict(simulation(1, 1)) == pytest.approx(10, rel=0.5)
+    # Values outside those which have run are from a linear fit of the effects
+    assert model.predict(simulation(0.5, 1)) > model.predict(simulation(1, 1))
+    assert model.predict(simulation(8, 1)) < model.predict(simulation(4, 1))
+    assert model.predict(simulation(1, 3)) > model.predict(simulation(1, 2))
+
+
+def test_sort_key():
+    records = history(lambda temp, pres: 1 / temp, [1, 2, 4], [1])
+    commands = [simulation(temp, 1) for temp in [4, 2, 8, 1]]
+    commands.append(Command("echo new"))
+    job = Job(commands, sort_key=RuntimeModel(records).sort_key)
+    assert [str(c) for c in job] == [
+        "echo new",
+        str(simulation(1, 1)),
+        str(simulation(2, 1)),
+        str(simulation(4, 1)),
+        str(simulation(8, 1)),
+    ]
+
+
+def test_sort_after_shard():
+    """Shards are the same regardless of the order of the commands."""
+    commands = [Command(f"echo {i}", {"i": i}) for i in range(10)]
+
+    def reverse(command):
+        return -command.variables["i"]
+
+    job = Job(commands, shard=(0, 2), sort_key=reverse)
+    assert [str(c) for c in job] == [f"echo {i}" for i in reversed(range(5))]
+
+
+def test_sort_once():
+    """The commands are only sorted once, however many times the job is iterated."""
+    commands = [Command(f"echo {i}", {"i": i}) for i in range(10)]
+    keys = []
+
+    def reverse(command):
+        keys.append(command)
+        return -command.variables["i"]
+
+    job = Job(commands, sort_key=reverse)
+    assert len(job) == 10
+    assert [str(c) for c in job] == [f"echo {i}" for i in reversed(range(10))]
+    job.as_bash_array()
+    assert len(keys) == 10
+    # Changing the commands orders them again
+    job.commands = commands[:5]
+    assert [str(c) for c in job] == [f"echo {i}" for i in reversed(range(5))]
+
+
+def test_missing_file(tmp_dir):
+    assert (
+        RuntimeModel.from_file(tmp_dir / "metrics.jsonl").predict(simulation(1, 1))
+        is None
+    )
+
+
+def test_makespan(tmp_dir):
+    """Starting the longest command first reduces the time to run all commands."""
+    commands = [Command("sleep {time}", {"time": 0.2, "i": i}) for i in range(4)]
+    commands.append(Command("sleep {time}", {"time": 0.8, "i": 4}))
+    records = [
+        create_record(str(c), c.variables, {"exit_code": 0, "wall_time": t})
+        for c, t in zip(commands, [0.2] * 4 + [0.8])
+    ]
+    model = RuntimeModel(records)
+
+    start = time.perf_counter()
+    run_bash_job(Job(commands), tmp_dir, processes=2)
+    in_order = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_bash_job(Job(commands, sort_key=model.sort_key), tmp_dir, processes=2)
+    longest_first = time.perf_counter() - start
+
+    assert longest_first < in_order - 0.2
+
+
+def test_longest_first_cli(tmp_dir):
+    experiment = {
+        "command": "echo {var} >> order.txt",
+        "variables": {"var": [1, 2, 3]},
+    }
+    with (tmp_dir / "experiment.yml").open("w") as dst:
+        yaml.safe_dump(experiment, dst)
+    for var, wall_time in [(1, 1.0), (2, 3.0), (3, 2.0)]:
+        command = Command(experiment["command"], {"var": var})
+        usage = {"exit_code": 0, "wall_time": wall_time}
+        write_record(
+            tmp_dir / "metrics.jsonl",
+            create_record(str(command), command.variables, usage),
+        )
+
+    runner = CliRunner()
+    input_file = str(tmp_dir / "experiment.yml")
+    for flag in ["--longest-first", "--predict-resources"]:
+        result = runner.invoke(main, ["-f", input_file, flag])
+        assert result.exit_code != 0
+
+    args = ["-f", input_file, "--longest-first", "--metrics", "metrics.jsonl"]
+    result = runner.invoke(main, args)
+    assert result.exit_code == 0, result.output
+    assert (tmp_dir / "order.txt").read_text().split() == ["2", "3", "1"]
+
+
+def test_predict_memory():
+    model = RuntimeModel(history(lambda temp, pres: 1, [1, 2], [1]))
+    assert model.predict(simulation(2, 1), "max_rss") == pytest.approx(2048)
+    with pytest.raises(ValueError):
+        model.predict(simulation(2, 1), "disk")
+
+
+@pytest.mark.parametrize(
+    "seconds, walltime", [(0, "0:01:00"), (61, "0:02:00"), (7200, "2:00:00")]
+)
+def test_format_walltime(seconds, walltime):
+    assert format_walltime(seconds) == walltime
+
+
+def test_format_memory():
+    assert format_memory("pbs", 2000) == "2mb"
+    assert format_memory("slurm", 2048) == "2M"
+
+
+def test_split_by_resources():
+    records = history(lambda temp, pres: 3600 / temp, [1, 10, 100], [1])
+    model = RuntimeModel(records)
+    commands = [simulation(temp, 1) for temp in [100, 10, 1]] + [Command("new")]
+    options = {"walltime": "10:00:00", "memory": "8gb", "ncpus": 2}
+    parts = split_by_resources("pbs", Job(commands, options), model, 2)
+
+    assert [[str(c) for c in part] for part in parts] == [
+        ["new"],
+        [str(simulation(1, 1))],
+        [str(simulation(10, 1))],
+        [str(simulation(100, 1))],
+    ]
+    # Commands without a prediction use the resources of the job
+    assert parts[0].scheduler_options == options
+    assert parts[1].scheduler_options == {
+        "walltime": "2:00:00",
+        "mem": "2mb",
+        "ncpus": 2,
+    }
+    assert parts[3].scheduler_options["walltime"] == "0:02:00"
+    assert parts[3].scheduler_options["mem"] == "200mb"
+
+
+def test_split_similar_runtimes():
+    model = RuntimeModel(history(lambda temp, pres: 100 + temp, [1, 2, 3], [1]))
+    job = Job([simulation(temp, 1) for temp in [1, 2, 3]])
+    parts = split_by_resources("slurm", job, model)
+    assert len(parts) == 1
+    assert len(parts[0]) == 3
+    assert parts[0].scheduler_options["walltime"] == "0:03:00"
+
+
+def test_split_sharded():
+    """The commands of a sharded job are only sharded once."""
+    model = RuntimeModel(history(lambda temp, pres: 100 + temp, [1, 2, 3], [1]))
+    commands = [simulation(temp, 1) for temp in range(1, 9)]
+    job = Job(commands, shard=(0, 2))
+    parts = split_by_resources("slurm", job, model)
+    assert [str(c) for part in parts for c in part] == [str(c) for c in commands[:4]]
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_scheduler_parts(tmp_dir, capsys, scheduler):
+    """The next job depends on all the parts of the previous job."""
+    model = RuntimeModel(history(lambda temp, pres: 3600 / temp, [1, 100], [1]))
+    jobs = [
+        Job([simulation(temp, 1) for temp in [1, 100]]),
+        Job([Command("echo done")]),
+    ]
+    run_scheduler_jobs(scheduler, jobs, tmp_dir, dry_run=True, runtime_model=model)
+    for name in ["experi_00-0", "experi_00-1", "experi_01"]:
+        assert (tmp_dir / f"{name}.{scheduler}").is_file()
+    content = (tmp_dir / f"experi_00-0.{scheduler}").read_text()
+    assert "1:30:00" in content
+
+    submitted = capsys.readouterr().out.strip().split("\n")
+    assert len(submitted) == 3
+    assert "afterok" not in submitted[1]
+    assert "afterok:dry_run:dry_run" in submitted[2]
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test merging the jobs of multiple experiments."""
+
+import pytest
+
+from experi.commands import Command, Job
+from experi.merge import merge_experiments, merge_key
+
+
+def _job(*values, **options):
+    return Job([Command(f"echo {value}") for value in values], options or None)
+
+
+def _commands(jobs):
+    return [[str(command) for command in job] for job in jobs]
+
+
+def test_merge_key():
+    assert merge_key(_job(1, name="a", mem="1gb")) == merge_key(_job(2, mem="1gb"))
+    assert merge_key(_job(1, mem="1gb")) != merge_key(_job(1, mem="2gb"))
+    assert merge_key(_job(1)) != merge_key(Job([Command("echo 1")], max_concurrent=2))
+
+
+def test_merge_experiments():
+    experiments = [[_job(1, 2), _job(3)], [_job(4), _job(5), _job(6)]]
+    merged = list(merge_experiments(experiments))
+    assert _commands(merged) == [
+        ["echo 1", "echo 2", "echo 4"],
+        ["echo 3", "echo 5"],
+        ["echo 6"],
+    ]
+
+
+def test_merge_incompatible():
+    """Jobs with different options at the same position are kept separate."""
+    experiments = [[_job(1, mem="1gb")], [_job(2, mem="2gb")], [_job(3, mem="1gb")]]
+    merged = list(merge_experiments(experiments))
+    assert _commands(merged) == [["echo 1", "echo 3"], ["echo 2"]]
+    assert [job.scheduler_options["mem"] for job in merged] == ["1gb", "2gb"]
+
+
+@pytest.mark.parametrize("max_keys", [1, 100])
+def test_merge_duplicates(max_keys):
+    """Duplicate commands keep their first occurrence, dropping any empty job."""
+    experiments = [[_job(1, 2), _job(3)], [_job(2), _job(1, 3)]]
+    merged = list(merge_experiments(experiments, max_keys))
+    assert _commands(merged) == [["echo 1", "echo 2"], ["echo 3"]]
+
+    experiments = [[_job(1), _job(2, mem="2gb")], [_job(1), _job(2)]]
+    merged = list(merge_experiments(experiments, max_keys))
+    assert _commands(merged) == [["echo 1"], ["echo 2"]]
+
+
+def test_merge_by_template():
+    """Jobs with commands from different templates are kept separate."""
+    first = Job([Command("echo a {x}", {"x": x}) for x in [1, 2]])
+    second = Job([Command("sleep {x}", {"x": x}) for x in [1, 2]])
+    third = Job([Command("echo a {x}", {"x": 3})])
+    experiments = [[first], [second], [third]]
+    assert len(list(merge_experiments(experiments))) == 1
+    merged = list(merge_experiments(experiments, by_template=True))
+    assert _commands(merged) == [
+        ["echo a 1", "echo a 2", "echo a 3"],
+        ["sleep 1", "sleep 2"],
+    ]
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the recording of the resources used by commands."""
+
+import json
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from experi.commands import Command, Job, digest
+from experi.metrics import read_records, run_command, summarise
+from experi.pilot import create_queue, run_worker
+from experi.run import main, run_bash_jobs, run_scheduler_jobs
+from experi.scheduler import create_scheduler_file
+
+
+@pytest.mark.parametrize(
+    "cmds, exit_code", [(["true"], 0), (["false"], 1), (["true", "exit 3"], 3)]
+)
+def test_run_command(cmds, exit_code):
+    usage = run_command(cmds)
+    assert usage["exit_code"] == exit_code
+    assert usage["wall_time"] > 0
+    assert usage["max_rss"] > 0
+    assert usage["host"]
+
+
+def test_run_command_signal():
+    assert run_command(["kill -9 $$"])["exit_code"] == -9
+
+
+def test_run_command_echo(capsys):
+    run_command(["true"])
+    assert capsys.readouterr().out == "bash -c 'true'\n"
+    run_command(["true"], echo=False)
+    assert capsys.readouterr().out == ""
+
+
+def test_bash_progress_echo(tmp_dir, capsys):
+    """The commands aren't printed over the progress."""
+    run_bash_jobs([Job([Command("true")])], tmp_dir, progress=True)
+    assert "bash -c" not in capsys.readouterr().out
+
+
+def test_bash_metrics(tmp_dir):
+    commands = [
+        Command("sleep {time}", variables={"time": t, "other": np.int64(1)})
+        for t in [0, 0.1]
+    ]
+    run_bash_jobs([Job(commands)], tmp_dir, metrics_file="metrics.jsonl")
+
+    records = list(read_records(tmp_dir / "metrics.jsonl"))
+    assert len(records) == 2
+    for command, record in zip(commands, records):
+        assert record["hash"] == digest(str(command))
+        assert record["template"] == command.template_digest()
+        assert record["command"] == str(command)
+        assert record["variables"] == {"time": command.variables["time"], "other": 1}
+        assert record["exit_code"] == 0
+    assert records[1]["wall_time"] >= 0.1
+
+
+def test_worker_metrics(tmp_dir):
+    commands = [Command("echo {var}", variables={"var": i}) for i in range(3)]
+    create_queue(Job(commands), tmp_dir / "queue")
+    run_worker(tmp_dir / "queue", metrics_file=tmp_dir / "metrics.jsonl")
+    records = list(read_records(tmp_dir / "metrics.jsonl"))
+    assert [r["hash"] for r in records] == [digest(str(c)) for c in commands]
+    assert [r["variables"] for r in records] == [{"var": i} for i in range(3)]
+
+
+def test_summarise():
+    records = [
+        {
+            "variables": {"var": var, "other": other},
+            "wall_time": float(var * other),
+            "user_time": 1.0,
+            "sys_time": 0.5,
+            "max_rss": other,
+            "exit_code": 0 if other else 1,
+        }
+        for var in [2, 1]
+        for other in [0, 1, 2]
+    ]
+    summary = summarise(iter(records), ["var"])
+    assert [row["var"] for row in summary] == [1, 2]
+    assert [row["count"] for row in summary] == [3, 3]
+    assert [row["failed"] for row in summary] == [1, 1]
+    assert [row["mean_wall_time"] for row in summary] == [1.0, 2.0]
+    assert [row["max_wall_time"] for row in summary] == [2.0, 4.0]
+    assert [row["mean_cpu_time"] for row in summary] == [1.5, 1.5]
+    assert [row["max_rss"] for row in summary] == [2, 2]
+
+    assert len(summarise(iter(records), [])) == 1
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_scheduler_metrics(scheduler):
+    job = Job([Command("echo {var}", variables={"var": i}) for i in range(2)])
+    content = create_scheduler_file(scheduler, job, "metrics.jsonl")
+    assert """VARIABLES=( \\\n'{"var": 0}' \\\n'{"var": 1}' \\\n)""" in content
+    assert 'experi record --variables "${VARIABLES[' in content
+    assert f'--template "{job.commands[0].template_digest()}"' in content
+    assert '"metrics.jsonl" "${COMMAND[' in content
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_pilot_metrics(tmp_dir, scheduler):
+    jobs = [Job([Command("echo 1")])]
+    run_scheduler_jobs(scheduler, jobs, tmp_dir, pilot_workers=1, metrics_file="m")
+    content = (tmp_dir / f"experi_00.{scheduler}").read_text()
+    assert 'experi worker --metrics "m" "experi_00.queue"' in content
+
+
+def test_record_cli(tmp_dir):
+    runner = CliRunner()
+    metrics = str(tmp_dir / "metrics.jsonl")
+    result = runner.invoke(
+        main, ["record", "--variables", '{"var": 1}', metrics, "echo 1 && echo 2"]
+    )
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(main, ["record", metrics, "exit 3"])
+    assert result.exit_code == 3
+
+    records = list(read_records(metrics))
+    assert records[0]["variables"] == {"var": 1}
+    assert records[0]["hash"] == digest("echo 1 && echo 2")
+    assert records[1]["exit_code"] == 3
+
+
+def test_summary_cli(tmp_dir):
+    metrics = tmp_dir / "metrics.jsonl"
+    with metrics.open("w") as dst:
+        for var in [1, 2]:
+            record = {
+                "variables": {"var": var},
+                "wall_time": 1.0,
+                "user_time": 1.0,
+                "sys_time": 0.0,
+                "max_rss": 1,
+                "exit_code": 0,
+            }
+            dst.write(json.dumps(record) + "\n")
+    result = CliRunner().invoke(main, ["summary", str(metrics), "--by", "var"])
+    assert result.exit_code == 0, result.output
+    lines = result.output.strip().split("\n")
+    assert lines[0].split()[:3] == ["var", "count", "failed"]
+    assert [line.split()[0] for line in lines[1:]] == ["1", "2"]
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test running commands from a queue with pilot workers."""
+
+import json
+import multiprocessing
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from experi.commands import Command, Job
+from experi.pilot import DONE, FAILED, PENDING, claim_batch, create_queue, run_worker
+from experi.run import main, run_scheduler_jobs
+
+
+@pytest.mark.parametrize("batch_size, num_batches", [(1, 10), (3, 4), (20, 1)])
+def test_create_queue(tmp_dir, batch_size, num_batches):
+    job = Job([Command(f"echo {i}") for i in range(10)])
+    assert create_queue(job, tmp_dir / "queue", batch_size) == num_batches
+    batches = sorted(os.listdir(str(tmp_dir / "queue" / PENDING)))
+    assert len(batches) == num_batches
+    commands = []
+    for batch in batches:
+        commands += json.loads((tmp_dir / "queue" / PENDING / batch).read_text())
+    assert [command["cmd"] for command in commands] == [
+        [f"echo {i}"] for i in range(10)
+    ]
+
+
+def test_claim_batch(tmp_dir):
+    create_queue(Job([Command("echo 1")]), tmp_dir / "queue")
+    assert claim_batch(tmp_dir / "queue", "first") is not None
+    assert claim_batch(tmp_dir / "queue", "second") is None
+
+
+def test_claim_batch_listing(tmp_dir, monkeypatch):
+    """The pending directory is only listed once all the names have been tried."""
+    create_queue(Job([Command(f"echo {i}") for i in range(10)]), tmp_dir / "queue")
+    listings = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+    pending = []
+    claimed = [claim_batch(tmp_dir / "queue", "first", pending) for _ in range(11)]
+    assert [path.name for path in claimed[:10]] == [
+        f"{i:06d}.first.json" for i in range(10)
+    ]
+    assert claimed[10] is None
+    # Listed once for the batches, and again to find the queue is empty
+    assert len(listings) == 2
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_workers(tmp_dir, num_workers):
+    """Each command is run by exactly one of the workers.
+
+    Creating a directory fails when it already exists, so a command running twice would
+    result in a failed batch.
+
+    """
+    queue = tmp_dir / "queue"
+    job = Job([Command(f"mkdir {tmp_dir}/out{i}") for i in range(40)])
+    create_queue(job, queue, batch_size=3)
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(queue, "bash", f"w{i}"))
+        for i in range(num_workers)
+    ]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    assert not os.listdir(str(queue / PENDING))
+    assert not os.listdir(str(queue / FAILED))
+    assert len(os.listdir(str(queue / DONE))) == 14
+    for i in range(40):
+        assert (tmp_dir / f"out{i}").is_dir()
+
+
+def test_worker_failure(tmp_dir):
+    queue = tmp_dir / "queue"
+    job = Job([Command("false"), Command(f"touch {tmp_dir}/passed")])
+    create_queue(job, queue)
+    assert run_worker(queue) == 1
+    assert len(os.listdir(str(queue / FAILED))) == 1
+    assert len(os.listdir(str(queue / DONE))) == 1
+    assert (tmp_dir / "passed").is_file()
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_pilot_scheduler_file(tmp_dir, scheduler):
+    jobs = [Job([Command(f"echo {i}") for i in range(10)])]
+    run_scheduler_jobs(scheduler, jobs, tmp_dir, pilot_workers=4, pilot_batch=2)
+    content = (tmp_dir / f"experi_00.{scheduler}").read_text()
+    assert 'experi worker "experi_00.queue"' in content
+    assert "0-3" in content
+    assert len(os.listdir(str(tmp_dir / "experi_00.queue" / PENDING))) == 5
+
+
+def test_worker_cli(tmp_dir):
+    queue = tmp_dir / "queue"
+    create_queue(Job([Command(f"touch {tmp_dir}/passed")]), queue)
+    result = CliRunner().invoke(main, ["worker", str(queue)])
+    assert result.exit_code == 0, result.output
+    assert (tmp_dir / "passed").is_file()
+
+    create_queue(Job([Command("false")]), queue)
+    result = CliRunner().invoke(main, ["worker", str(queue)])
+    assert result.exit_code != 0
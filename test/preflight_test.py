@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test checking the requires files of commands before running them."""
+
+import textwrap
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from experi.commands import Command, Job
+from experi.preflight import check_requires, find_existing
+from experi.run import main
+
+
+def test_find_existing(tmp_dir):
+    (tmp_dir / "a").mkdir()
+    (tmp_dir / "a" / "1.txt").touch()
+    (tmp_dir / "2.txt").touch()
+    paths = ["a/1.txt", "a/./3.txt", "2.txt", "./2.txt", "missing/1.txt", "2.txt/x"]
+    assert find_existing(paths, tmp_dir) == {"a/1.txt", "2.txt"}
+
+
+def _command(name, requires=""):
+    return Command(f"run {name}", creates=name, requires=requires)
+
+
+@pytest.fixture
+def jobs(tmp_dir):
+    (tmp_dir / "exists").touch()
+    return [
+        Job(
+            [
+                _command("a", "exists"),
+                _command("b", "missing"),
+                # Created by a later job
+                _command("c", "e"),
+                # Created by the same job
+                _command("d", "a"),
+            ]
+        ),
+        Job([_command("e"), _command("f", "a"), _command("g")]),
+    ]
+
+
+def _creates(jobs):
+    return [[command.creates for command in job] for job in jobs]
+
+
+def test_check_requires_skip(tmp_dir, jobs):
+    checked = list(check_requires(jobs, tmp_dir, "skip"))
+    assert _creates(checked) == [["a"], ["e", "f", "g"]]
+
+
+def test_check_requires_defer(tmp_dir, jobs):
+    checked = list(check_requires(jobs, tmp_dir, "defer"))
+    assert _creates(checked) == [["a"], ["d"], ["e", "f", "g"], ["c"]]
+
+
+def test_check_requires_defer_options(tmp_dir):
+    """A deferred command keeps the options of its own job."""
+    jobs = [
+        Job([_command("a", "b")], {"ncpus": 16}),
+        Job([_command("b")], {"ncpus": 1}),
+    ]
+    checked = list(check_requires(jobs, tmp_dir, "defer"))
+    assert _creates(checked) == [["b"], ["a"]]
+    assert [job.scheduler_options for job in checked] == [{"ncpus": 1}, {"ncpus": 16}]
+
+
+def test_check_requires_defer_transitive(tmp_dir):
+    jobs = [
+        Job([_command("a", "c")]),
+        # Requires the output of a command which is deferred
+        Job([_command("b", "a")]),
+        Job([_command("c"), _command("d", "b")]),
+    ]
+    checked = list(check_requires(jobs, tmp_dir, "defer"))
+    assert _creates(checked) == [["c"], ["a"], ["b"], ["d"]]
+
+
+def test_check_requires_cycle(tmp_dir):
+    jobs = [Job([_command("a", "b")]), Job([_command("b", "a"), _command("c")])]
+    for mode in ["skip", "defer"]:
+        assert _creates(check_requires(jobs, tmp_dir, mode)) == [["c"]]
+
+
+def test_check_requires_empty_job(tmp_dir):
+    jobs = [Job([_command("a", "missing")]), Job([_command("b")])]
+    assert _creates(check_requires(jobs, tmp_dir)) == [["b"]]
+
+
+def test_check_requires_invalid_mode(tmp_dir, jobs):
+    with pytest.raises(ValueError):
+        list(check_requires(jobs, tmp_dir, "unknown"))
+
+
+def test_check_requires_cli():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("input-1.txt").touch()
+        Path("experiment.yml").write_text(
+            textwrap.dedent(
+                """
+                command:
+                    cmd: cat {requires}
+                    requires: input-{var}.txt
+                variables:
+                    var: [1, 2]
+                """
+            )
+        )
+        result = runner.invoke(main, ["--dry-run", "--check-requires", "skip"])
+        assert result.exit_code == 0, result.output
+        assert "cat input-1.txt" in result.output
+        assert "cat input-2.txt" not in result.output
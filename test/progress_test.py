@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the display of the progress of a job."""
+
+from io import StringIO
+
+import pytest
+
+from experi.progress import Progress
+
+
+class TTYStream(StringIO):
+    def isatty(self):
+        return True
+
+
+def test_progress_counts():
+    progress = Progress("Job 0", 3, stream=StringIO(), interval=0)
+    assert progress.eta() is None
+    progress.start()
+    progress.start()
+    assert progress.running == 2
+    progress.finish(2.0)
+    progress.finish(4.0, failed=True)
+    assert (progress.done, progress.failed, progress.running) == (1, 1, 0)
+    # A single command remaining which takes the mean duration
+    assert progress.eta() == pytest.approx(3.0)
+    assert progress.rate() > 0
+    assert "Job 0: 2/3 (done 1, running 0, failed 1)" in progress.status()
+    assert "ETA 0:00:03" in progress.status()
+
+
+def test_progress_log_lines():
+    stream = StringIO()
+    progress = Progress("Job 0", 2, stream=stream, interval=0)
+    progress.start()
+    progress.finish(1.0)
+    progress.close()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    assert lines[-1].startswith("Job 0: 1/2")
+
+
+def test_progress_interval():
+    stream = StringIO()
+    progress = Progress("Job 0", 1000, stream=stream, interval=3600)
+    for _ in range(1000):
+        progress.start()
+        progress.finish(0.0)
+    # Only the first update is within the interval
+    assert len(stream.getvalue().splitlines()) == 1
+    progress.close()
+    assert stream.getvalue().splitlines()[-1].startswith("Job 0: 1000/1000")
+
+
+def test_progress_tty():
+    stream = TTYStream()
+    progress = Progress("Job 0", 1, stream=stream)
+    assert progress.interval < 1
+    progress.start()
+    progress.finish(1.0)
+    progress.close()
+    assert stream.getvalue().startswith("\r\033[K")
+    assert stream.getvalue().count("\n") == 1
@@ -8,13 +8,15 @@
 
 """Test the running of commands."""
 
+import random
+import time
 from pathlib import Path
 from typing import Iterator
 
 import pytest
 
 from experi.commands import Command, Job
-from experi.run import determine_scheduler, launch, run_bash_jobs
+from experi.run import determine_scheduler, launch, run_bash_job, run_bash_jobs
 
 
 @pytest.fixture
@@ -114,3 +116,96 @@ def test_dry_run(tmp_dir):
 @pytest.mark.parametrize("use_dependencies", [True, False])
 def test_launch(scheduler, dry_run, use_dependencies):
     launch("test/data/experiment.yml", use_dependencies, dry_run, scheduler)
+
+
+def test_parallel_job(tmp_dir):
+    commands = [Command(f"sleep 0.5 && touch {i}") for i in range(4)]
+    start = time.perf_counter()
+    assert run_bash_job(Job(commands), tmp_dir, processes=4)
+    assert time.perf_counter() - start < 1.5
+    for i in range(4):
+        assert (tmp_dir / str(i)).is_file()
+
+
+def test_parallel_job_max_concurrent(tmp_dir):
+    """No more than max_concurrent commands of a job run at the same time."""
+    commands = [Command(f"sleep 0.3 && touch {i}") for i in range(4)]
+    start = time.perf_counter()
+    assert run_bash_job(Job(commands, max_concurrent=2), tmp_dir, processes=4)
+    assert time.perf_counter() - start > 0.6
+    for i in range(4):
+        assert (tmp_dir / str(i)).is_file()
+
+
+def test_parallel_job_jitter(tmp_dir):
+    commands = [Command(f"touch {i}") for i in range(4)]
+    assert run_bash_job(Job(commands, jitter=0.2), tmp_dir, processes=4)
+    for i in range(4):
+        assert (tmp_dir / str(i)).is_file()
+
+
+def test_parallel_job_jitter_first(tmp_dir, monkeypatch):
+    """Only the first command on each process waits before starting."""
+    delays = []
+
+    def uniform(low, high):
+        delays.append(high)
+        return high
+
+    monkeypatch.setattr(random, "uniform", uniform)
+    commands = [Command(f"touch {i}") for i in range(8)]
+    start = time.perf_counter()
+    assert run_bash_job(Job(commands, jitter=0.5), tmp_dir, processes=2)
+    assert time.perf_counter() - start < 1.5
+    assert delays == [0.5, 0.5]
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_parallel_job_failure(tmp_dir, processes):
+    """All the commands run even when one of them fails."""
+    commands = [Command("false")] + [Command(f"touch {i}") for i in range(4)]
+    assert not run_bash_job(Job(commands), tmp_dir, processes=processes)
+    for i in range(4):
+        assert (tmp_dir / str(i)).is_file()
+
+
+def test_parallel_jobs_barrier(tmp_dir):
+    """The next job only starts once all the commands in a job are complete."""
+    jobs = [
+        Job([Command(f"sleep 0.2 && touch {i}") for i in range(3)]),
+        Job([Command("test -f 0 && test -f 1 && test -f 2 && touch passed")]),
+    ]
+    run_bash_jobs(jobs, tmp_dir, processes=3)
+    assert (tmp_dir / "passed").is_file()
+
+
+def test_progress(tmp_dir, capsys):
+    commands = [Command(f"echo {i}") for i in range(4)]
+    run_bash_jobs([Job(commands)], tmp_dir, processes=2, progress=True)
+    assert "Job 0: 4/4 (done 4, running 0, failed 0)" in capsys.readouterr().err
+
+
+STRAGGLER = (
+    "if [ -f marker ]; then touch copied; else touch marker && sleep {duration}; fi"
+)
+
+
+def test_speculation(tmp_dir):
+    """A straggling idempotent command is run again and the original killed."""
+    commands = [
+        Command("sleep 0.1 && echo {i}", {"i": i}, idempotent=True) for i in range(3)
+    ]
+    commands.append(Command(STRAGGLER.format(duration=30), idempotent=True))
+    start = time.perf_counter()
+    assert run_bash_job(Job(commands), tmp_dir, processes=4, metrics_file="m.jsonl")
+    assert time.perf_counter() - start < 10
+    assert (tmp_dir / "copied").is_file()
+    # Only the successful copy is recorded
+    assert len((tmp_dir / "m.jsonl").read_text().splitlines()) == 4
+
+
+def test_speculation_not_idempotent(tmp_dir):
+    commands = [Command("sleep 0.1 && echo {i}", {"i": i}) for i in range(3)]
+    commands.append(Command(STRAGGLER.format(duration=1)))
+    assert run_bash_job(Job(commands), tmp_dir, processes=4)
+    assert not (tmp_dir / "copied").exists()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the sampling of combinations of variables."""
+
+from textwrap import dedent
+
+import numpy as np
+import pytest
+import yaml
+
+from experi.run import variable_matrix
+
+
+def parse_string(string):
+    result = yaml.safe_load(dedent(string))
+    return list(variable_matrix(result))
+
+
+def create_string(method, num, seed=1):
+    return f"""
+    sample:
+        method: {method}
+        n: {num}
+        seed: {seed}
+        var1: [1, 2, 3, 4]
+        var2:
+            arange:
+                start: 10
+                stop: 100
+                step: 2
+        var3: constant
+    """
+
+
+@pytest.fixture(params=["random", "lhs", "sobol"])
+def method(request):
+    if request.param == "sobol":
+        pytest.importorskip("scipy")
+    return request.param
+
+
+def test_sample_values(method):
+    result = parse_string(create_string(method, 16))
+    assert len(result) == 16
+    for item in result:
+        assert item["var1"] in [1, 2, 3, 4]
+        assert item["var2"] in np.arange(10, 100, 2)
+        assert item["var3"] == "constant"
+
+
+def test_sample_seed(method):
+    assert parse_string(create_string(method, 16)) == parse_string(
+        create_string(method, 16)
+    )
+    assert parse_string(create_string(method, 16, seed=1)) != parse_string(
+        create_string(method, 16, seed=2)
+    )
+
+
+def test_sample_lhs_strata():
+    """Every stratum of a latin hypercube has a single value."""
+    result = parse_string(
+        """
+        sample:
+            method: lhs
+            n: 10
+            seed: 0
+            var: {arange: 10}
+        """
+    )
+    assert sorted(item["var"] for item in result) == list(range(10))
+
+
+def test_sample_product():
+    result = parse_string(
+        """
+        var1: [1, 2]
+        sample:
+            n: 3
+            seed: 0
+            var2: [1, 2, 3]
+        """
+    )
+    assert len(result) == 6
+    assert sorted(item["var1"] for item in result) == [1, 1, 1, 2, 2, 2]
+
+
+@pytest.mark.parametrize(
+    "string",
+    [
+        "sample: [1, 2, 3]",
+        "sample: {var1: [1, 2, 3]}",
+        "sample: {n: 2, method: unknown, var1: [1, 2, 3]}",
+        "sample: {n: 2, var1: {zip: {var2: [1, 2]}}}",
+        "sample: {n: 2, var1: []}",
+    ],
+    ids=["list", "missing_n", "method", "nested", "empty"],
+)
+def test_sample_errors(string):
+    with pytest.raises(ValueError):
+        parse_string(string)
@@ -10,15 +10,21 @@
 
 """Test the building of scheduler files."""
 
+import os
+import shutil
+import subprocess
+
 import pytest
 
 from experi.commands import Command, Job
-from experi.run import process_structure, read_file, run_jobs
+from experi.run import process_structure, read_file, run_jobs, run_scheduler_jobs
 from experi.scheduler import (
     PBSOptions,
     ShellOptions,
     SLURMOptions,
+    create_pilot_file,
     create_scheduler_file,
+    split_by_templates,
 )
 
 DEFAULT_PBS = """#!/bin/bash
@@ -31,11 +37,11 @@ cd "$PBS_O_WORKDIR"
 
 
 COMMAND=( \\
-"echo 1" \\
+'echo 1' \\
 )
 
 echo "${COMMAND[$PBS_ARRAY_INDEX]}"
-${COMMAND[$PBS_ARRAY_INDEX]}
+bash -c "${COMMAND[$PBS_ARRAY_INDEX]}"
 """
 
 DEFAULT_SLURM = """#!/bin/bash
@@ -48,21 +54,21 @@ cd "$SLURM_SUBMIT_DIR"
 
 
 COMMAND=( \\
-"echo 1" \\
+'echo 1' \\
 )
 
 echo "${COMMAND[$SLURM_ARRAY_TASK_ID]}"
-${COMMAND[$SLURM_ARRAY_TASK_ID]}
+bash -c "${COMMAND[$SLURM_ARRAY_TASK_ID]}"
 """
 
 
 @pytest.mark.parametrize(
     "job, result",
     [
-        (Job([Command("echo 1")]), '( \\\n"echo 1" \\\n)'),
+        (Job([Command("echo 1")]), "( \\\n'echo 1' \\\n)"),
         (
             Job([Command("echo 1"), Command("echo 2")]),
-            '( \\\n"echo 1" \\\n"echo 2" \\\n)',
+            "( \\\n'echo 1' \\\n'echo 2' \\\n)",
         ),
     ],
     ids=["single", "list"],
@@ -106,3 +112,246 @@ class TestHeader:
         email = "email@example.com"
         sched = scheduler(mail=email)
         assert email in sched.create_header()
+
+
+STAGE_SCRIPT = """
+# Only succeed when running in the stage directory with the input copied
+test "$PWD" != "$PBS_O_WORKDIR" || exit 2
+test -f "$1" || exit 3
+mkdir -p "$(dirname "$2")"
+cp "$1" "$2"
+exit $3
+"""
+
+
+@pytest.fixture
+def staged_job(tmp_dir):
+    (tmp_dir / "stage.sh").write_text(STAGE_SCRIPT)
+    (tmp_dir / "in").mkdir()
+    (tmp_dir / "scratch").mkdir()
+    commands = []
+    for i in range(3):
+        (tmp_dir / "in" / f"{i}.txt").write_text(f"input {i}")
+        commands.append(
+            Command(
+                f"bash {tmp_dir / 'stage.sh'} {{requires}} {{creates}} {{code}}",
+                {"i": i, "code": i % 2},
+                creates="out/{i}.txt",
+                requires="in/{i}.txt",
+            )
+        )
+    return Job(commands, {"stage": "$TMPDIR"})
+
+
+def _run_staged(tmp_dir, job, index, metrics_file=None):
+    """Run an element of an array job, returning the exit code."""
+    (tmp_dir / "job.pbs").write_text(create_scheduler_file("pbs", job, metrics_file))
+    env = dict(
+        os.environ,
+        PBS_O_WORKDIR=str(tmp_dir),
+        PBS_ARRAY_INDEX=str(index),
+        TMPDIR=str(tmp_dir / "scratch"),
+    )
+    return subprocess.run(["bash", str(tmp_dir / "job.pbs")], env=env).returncode
+
+
+def test_stage_header(staged_job):
+    content = create_scheduler_file("pbs", staged_job)
+    assert "#PBS --stage" not in content
+    assert 'mktemp -d "$TMPDIR/experi.XXXXXX"' in content
+
+
+def test_stage(tmp_dir, staged_job):
+    assert _run_staged(tmp_dir, staged_job, 2) == 0
+    assert (tmp_dir / "out" / "2.txt").read_text() == "input 2"
+    # Only the output is copied back, with the stage directory removed
+    assert os.listdir(str(tmp_dir / "out")) == ["2.txt"]
+    assert os.listdir(str(tmp_dir / "scratch")) == []
+
+
+def test_stage_failure(tmp_dir, staged_job):
+    assert _run_staged(tmp_dir, staged_job, 1) == 1
+    assert not (tmp_dir / "out" / "1.txt").exists()
+    assert os.listdir(str(tmp_dir / "scratch")) == []
+
+
+def test_stage_creates_directory(tmp_dir):
+    """The command doesn't need to create the directory of the output."""
+    (tmp_dir / "scratch").mkdir()
+    commands = [
+        Command("echo {i} > {creates}", {"i": i}, creates="out/{i}.txt")
+        for i in range(2)
+    ]
+    job = Job(commands, {"stage": "$TMPDIR"})
+    assert _run_staged(tmp_dir, job, 1) == 0
+    assert (tmp_dir / "out" / "1.txt").read_text() == "1\n"
+    assert os.listdir(str(tmp_dir / "scratch")) == []
+
+
+def test_stage_no_creates(tmp_dir):
+    (tmp_dir / "scratch").mkdir()
+    job = Job([Command("echo 1 > out.txt")], {"stage": "$TMPDIR"})
+    assert _run_staged(tmp_dir, job, 0) == 0
+    # The output stays in the stage directory, which is removed
+    assert sorted(os.listdir(str(tmp_dir))) == ["job.pbs", "scratch"]
+    assert os.listdir(str(tmp_dir / "scratch")) == []
+
+
+@pytest.mark.skipif(shutil.which("experi") is None, reason="experi is not installed")
+def test_stage_metrics(tmp_dir, staged_job):
+    assert _run_staged(tmp_dir, staged_job, 0, "metrics.jsonl") == 0
+    assert (tmp_dir / "out" / "0.txt").is_file()
+    assert (tmp_dir / "metrics.jsonl").is_file()
+
+
+@pytest.mark.skipif(shutil.which("experi") is None, reason="experi is not installed")
+def test_stage_command_store(tmp_dir, staged_job):
+    run_scheduler_jobs("pbs", iter([staged_job]), tmp_dir, command_store=True)
+    content = (tmp_dir / "experi_00.pbs").read_text()
+    assert "REQUIRES_LIST" not in content
+    assert "in/2.txt" not in content
+    env = dict(
+        os.environ,
+        PBS_O_WORKDIR=str(tmp_dir),
+        PBS_ARRAY_INDEX="2",
+        TMPDIR=str(tmp_dir / "scratch"),
+    )
+    subprocess.run(["bash", str(tmp_dir / "experi_00.pbs")], env=env, check=True)
+    assert (tmp_dir / "out" / "2.txt").read_text() == "input 2"
+    with pytest.raises(ValueError):
+        create_scheduler_file("pbs", staged_job, command_store="job.commands")
+
+
+@pytest.mark.parametrize("field", ["creates", "requires"])
+def test_stage_absolute(tmp_dir, field):
+    command = Command("echo 1", **{field: str(tmp_dir / "out")})
+    with pytest.raises(ValueError, match="absolute"):
+        create_scheduler_file("pbs", Job([command], {"stage": "$TMPDIR"}))
+    # Absolute paths are fine when the command isn't staged
+    create_scheduler_file("pbs", Job([command]))
+
+
+@pytest.mark.parametrize(
+    "scheduler, expected",
+    [("slurm", "#SBATCH --array=0-9%4\n"), ("pbs", "#PBS -W max_run_subjobs=4\n")],
+)
+def test_max_concurrent(scheduler, expected):
+    job = Job([Command(f"echo {i}") for i in range(10)], max_concurrent=4)
+    assert expected in create_scheduler_file(scheduler, job)
+    assert expected in create_pilot_file(scheduler, job, "job.queue", 10)
+
+
+@pytest.mark.parametrize("scheduler", ["slurm", "pbs"])
+def test_max_concurrent_unthrottled(scheduler):
+    """Only arrays with more elements than max_concurrent are throttled."""
+    job = Job([Command(f"echo {i}") for i in range(4)], max_concurrent=4)
+    content = create_scheduler_file(scheduler, job)
+    assert "%4" not in content
+    assert "max_run_subjobs" not in content
+
+
+def test_jitter(tmp_dir):
+    job = Job([Command(f"touch {i}") for i in range(2)], jitter=0.5)
+    content = create_scheduler_file("pbs", job)
+    assert "sleep $((RANDOM % (1 + 1)))\n" in content
+    assert "sleep $((RANDOM % (1 + 1)))\n" in create_pilot_file("pbs", job, "q", 2)
+    (tmp_dir / "job.pbs").write_text(content)
+    env = dict(os.environ, PBS_O_WORKDIR=str(tmp_dir), PBS_ARRAY_INDEX="1")
+    subprocess.run(["bash", str(tmp_dir / "job.pbs")], env=env, check=True)
+    assert (tmp_dir / "1").is_file()
+
+
+def test_throttle_options():
+    """The throttle can be set with the options of the scheduler."""
+    structure = {
+        "command": "echo {i}",
+        "variables": {"i": list(range(10))},
+        "slurm": {"max_concurrent": 3, "jitter": 2},
+    }
+    job = next(process_structure(structure, scheduler="slurm"))
+    assert (job.max_concurrent, job.jitter) == (3, 2)
+    content = create_scheduler_file("slurm", job)
+    assert "#SBATCH --array=0-9%3\n" in content
+    assert "max_concurrent" not in content
+
+
+def _sized_job(options):
+    commands = [
+        Command("run {size}", {"size": size, "mem": mem})
+        for size, mem in [(1, 2), (2, 8), (3, 2), (4, 8)]
+    ]
+    return Job(commands, options)
+
+
+def test_split_by_templates():
+    job = _sized_job({"mem": "{mem}gb", "ncpus": "{mem}", "walltime": "2:00"})
+    parts = split_by_templates(job)
+    assert [[str(c) for c in part] for part in parts] == [
+        ["run 1", "run 3"],
+        ["run 2", "run 4"],
+    ]
+    assert parts[0].scheduler_options == dict(mem="2gb", ncpus="2", walltime="2:00")
+    assert parts[1].scheduler_options["mem"] == "8gb"
+    # The original options are unchanged
+    assert job.scheduler_options["mem"] == "{mem}gb"
+
+
+@pytest.mark.parametrize(
+    "options", [{"mem": "4gb"}, {"setup": "export PATH=${HOME}/bin:$PATH"}, None]
+)
+def test_split_by_templates_none(options):
+    job = _sized_job(options)
+    assert split_by_templates(job) == [job]
+
+
+def test_split_by_templates_sharded():
+    """The commands of a sharded job are only sharded once."""
+    commands = [Command(f"echo {i}", {"m": i % 2}) for i in range(8)]
+    parts = split_by_templates(Job(commands, {"mem": "{m}gb"}, shard=(0, 2)))
+    assert [[str(c) for c in part] for part in parts] == [
+        ["echo 0", "echo 2"],
+        ["echo 1", "echo 3"],
+    ]
+    assert [part.scheduler_options["mem"] for part in parts] == ["0gb", "1gb"]
+
+
+def test_split_by_templates_missing():
+    job = Job([Command("run", {"a": 1}), Command("run {b}", {"b": 1})], {"mem": "{a}"})
+    with pytest.raises(ValueError):
+        split_by_templates(job)
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_template_parts(tmp_dir, capsys, scheduler):
+    """Each group of resources is a separate part, with the dependencies kept."""
+    jobs = [_sized_job({"mem": "{mem}gb"}), Job([Command("echo done")])]
+    run_scheduler_jobs(scheduler, jobs, tmp_dir, dry_run=True)
+    for name, mem in [("experi_00-0", "2gb"), ("experi_00-1", "8gb")]:
+        content = (tmp_dir / f"{name}.{scheduler}").read_text()
+        assert mem in content
+        assert "{mem}" not in content
+    submitted = capsys.readouterr().out.strip().split("\n")
+    assert len(submitted) == 3
+    assert "afterok:dry_run:dry_run" in submitted[2]
+
+
+def test_template_options_variables():
+    """The variables of the options are kept, although the command doesn't use them."""
+    structure = {
+        "command": "echo {n}",
+        "variables": {"zip": {"n": [1, 2], "mem_gb": [2, 16]}},
+        "pbs": {"mem": "{mem_gb}gb"},
+    }
+    job = next(process_structure(structure, scheduler="pbs"))
+    parts = split_by_templates(job)
+    assert [part.scheduler_options["mem"] for part in parts] == ["2gb", "16gb"]
+
+
+def test_metrics_template():
+    job = Job([Command("echo {x}", {"x": x}) for x in range(3)])
+    content = create_scheduler_file("pbs", job, "metrics.jsonl")
+    assert f'--template "{job.commands[0].template_digest()}"' in content
+    # The commands are never recorded with the template of another command
+    job = Job([Command("echo {x}", {"x": 1}), Command("sleep {x}", {"x": 1})])
+    content = create_scheduler_file("pbs", job, "metrics.jsonl")
+    assert '--template ""' in content
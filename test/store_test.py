@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test reading commands from a binary command store."""
+
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+from hypothesis import given, settings, strategies as st
+
+from experi.commands import Command, Job
+from experi.run import main, run_scheduler_jobs
+from experi.scheduler import create_command_store, create_scheduler_file
+from experi.store import CommandStore, read_command, write_store
+
+COMMANDS = ["echo 1", "echo ünïcödé && echo 2", "", "echo 'quoted \"string\"'"]
+
+
+def test_store_roundtrip(tmp_dir):
+    assert write_store(tmp_dir / "store", COMMANDS) == len(COMMANDS)
+    with CommandStore(tmp_dir / "store") as store:
+        assert len(store) == len(COMMANDS)
+        assert [store[i] for i in range(len(store))] == COMMANDS
+        assert store[-1] == COMMANDS[-1]
+
+
+@settings(deadline=None, max_examples=50)
+@given(st.lists(st.text()))
+def test_store_hypothesis(tmp_path_factory, commands):
+    fname = tmp_path_factory.mktemp("store") / "store"
+    write_store(fname, commands)
+    with CommandStore(fname) as store:
+        assert [store[i] for i in range(len(store))] == commands
+
+
+@pytest.mark.parametrize("index", [4, -5])
+def test_store_out_of_range(tmp_dir, index):
+    write_store(tmp_dir / "store", COMMANDS)
+    with pytest.raises(IndexError):
+        read_command(tmp_dir / "store", index)
+
+
+def test_store_invalid(tmp_dir):
+    (tmp_dir / "store").write_text("echo 1\n")
+    with pytest.raises(ValueError):
+        CommandStore(tmp_dir / "store")
+
+
+def test_get_command_cli(tmp_dir):
+    write_store(tmp_dir / "store", COMMANDS)
+    result = CliRunner().invoke(main, ["get-command", str(tmp_dir / "store"), "1"])
+    assert result.exit_code == 0, result.output
+    assert result.output == COMMANDS[1] + "\n"
+    result = CliRunner().invoke(main, ["get-command", str(tmp_dir / "store"), "10"])
+    assert result.exit_code != 0
+
+
+def test_create_command_store(tmp_dir):
+    job = Job([Command("echo {a}", variables={"a": a}) for a in range(3)])
+    num = create_command_store(job, tmp_dir / "commands", tmp_dir / "variables")
+    assert num == 3
+    assert read_command(tmp_dir / "commands", 2) == "echo 2"
+    assert json.loads(read_command(tmp_dir / "variables", 2)) == {"a": 2}
+
+
+@pytest.mark.parametrize("scheduler", ["pbs", "slurm"])
+def test_scheduler_file(scheduler):
+    job = Job([Command("echo 1")])
+    content = create_scheduler_file(scheduler, job, command_store="job.commands")
+    assert 'experi get-command "job.commands"' in content
+    assert "echo 1" not in content
+    with pytest.raises(ValueError):
+        create_scheduler_file(scheduler, job, "metrics.jsonl", "job.commands")
+
+
+@pytest.mark.skipif(shutil.which("experi") is None, reason="experi is not installed")
+@pytest.mark.parametrize("metrics", [None, "metrics.jsonl"])
+def test_run_array_element(tmp_dir, metrics):
+    """An element of the array job runs the command at its index."""
+    job = Job([Command(f"echo {i} > out{i}") for i in range(5)])
+    run_scheduler_jobs(
+        "pbs", iter([job]), tmp_dir, metrics_file=metrics, command_store=True
+    )
+    assert (tmp_dir / "experi_00.commands").is_file()
+    assert (tmp_dir / "experi_00.variables").is_file() == (metrics is not None)
+
+    env = dict(os.environ, PBS_O_WORKDIR=str(tmp_dir), PBS_ARRAY_INDEX="3")
+    subprocess.run(["bash", str(tmp_dir / "experi_00.pbs")], env=env, check=True)
+    assert (tmp_dir / "out3").read_text() == "3\n"
+    assert not (tmp_dir / "out2").exists()
+    if metrics is not None:
+        assert json.loads((tmp_dir / metrics).read_text())["command"] == "echo 3 > out3"
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Malcolm Ramsay <malramsay64@gmail.com>
+#
+# Distributed under terms of the MIT license.
+
+"""Test the timeline of an experiment in the Chrome Trace Event format."""
+
+import json
+import textwrap
+
+import pytest
+
+from experi.run import launch
+from experi.trace import add_span, span, start_trace, stop_trace
+
+
+def test_no_trace():
+    stop_trace()
+    with span("phase"):
+        pass
+    add_span("phase", 0, 1)
+    assert stop_trace() is None
+
+
+def test_span():
+    start_trace()
+    with span("phase", args={"key": "value"}):
+        pass
+    add_span("command", 1.0, 3.0, lane=2, category="command")
+    trace = stop_trace()
+    events = [event for event in trace.events if event["ph"] == "X"]
+    assert [event["name"] for event in events] == ["phase", "command"]
+    assert events[0]["args"] == {"key": "value"}
+    assert events[1]["dur"] == pytest.approx(2e6)
+    assert events[1]["tid"] == 2
+
+    lanes = {
+        event["tid"]: event["args"]["name"]
+        for event in trace.to_dict()["traceEvents"]
+        if event["ph"] == "M"
+    }
+    assert lanes == {0: "experi", 2: "worker 2"}
+
+
+@pytest.mark.parametrize("scheduler", ["shell", "pbs"])
+def test_launch_trace(tmp_dir, scheduler):
+    experiment = tmp_dir / "experiment.yml"
+    experiment.write_text(
+        textwrap.dedent(
+            """
+            jobs:
+              - command: sleep 0.1 && echo {var}
+              - command: echo done
+            variables:
+              var: [1, 2, 3, 4]
+            """
+        )
+    )
+    launch(
+        experiment,
+        scheduler=scheduler,
+        dry_run=True,
+        processes=2,
+        trace_file=tmp_dir / "trace.json",
+    )
+    trace_file = tmp_dir / "run.json"
+    launch(experiment, scheduler=scheduler, processes=2, trace_file=trace_file)
+    with trace_file.open() as src:
+        events = json.load(src)["traceEvents"]
+    names = [event["name"] for event in events if event["ph"] == "X"]
+    assert "expand variables" in names
+    assert "render job 0" in names
+    assert "render job 1" in names
+    if scheduler == "shell":
+        assert "run job 0" in names
+        commands = [event for event in events if event.get("cat") == "command"]
+        assert len(commands) == 5
+        # The commands of the first job are split between two worker lanes
+        assert {event["tid"] for event in commands[:4]} == {1, 2}
+        assert commands[0]["args"]["variables"] in [{"var": i} for i in range(1, 5)]
+    else:
+        assert "create scheduler file 0" in names
@@ -6,11 +6,30 @@
 #
 # Distributed under terms of the MIT license.
 
+from itertools import product
 
+import pytest
 from hypothesis import given, settings
-from hypothesis.strategies import characters, text
+from hypothesis.strategies import (
+    characters,
+    dictionaries,
+    floats,
+    integers,
+    lists,
+    one_of,
+    text,
+)
 
-from experi.run import process_command, variable_matrix
+from experi.commands import Command
+from experi.run import (
+    _SPECIAL_KEYS,
+    columnar_product,
+    combine_dictionaries,
+    process_command,
+    project_matrix,
+    uniqueify,
+    variable_matrix,
+)
 
 
 @given(
@@ -25,3 +44,97 @@ def test_variable_generality(variable_start, variable_end):
         str(cmd) for cmd in process_command("echo {" + variable_name + "}", variables)
     ]
     assert cmd_list == ["echo 1", "echo 2", "echo 3", "echo 4", "echo 5"]
+
+
+def reference_product(variables):
+    """The product of variables generated using the recursive generators."""
+    key_vars = [list(variable_matrix(value, key)) for key, value in variables.items()]
+    return [combine_dictionaries(i) for i in product(*key_vars)]
+
+
+scalars = one_of(integers(), floats(allow_nan=False), text(max_size=5))
+
+
+@given(
+    dictionaries(
+        text(alphabet=characters(whitelist_categories=("L")), min_size=1).filter(
+            lambda key: key not in _SPECIAL_KEYS
+        ),
+        one_of(scalars, lists(scalars, max_size=5)),
+        min_size=1,
+        max_size=4,
+    )
+)
+def test_columnar_product(variables):
+    assert columnar_product(variables) is not None
+    assert list(variable_matrix(variables)) == reference_product(variables)
+
+
+@given(integers(1, 20), integers(1, 20), integers(1, 5))
+def test_columnar_product_range(stop, length, step):
+    variables = {
+        "var1": list(range(length)),
+        "var2": {"arange": {"start": 0, "stop": stop, "step": step}},
+    }
+    assert list(variable_matrix(variables)) == reference_product(variables)
+
+
+@pytest.mark.parametrize(
+    "variables",
+    [{"var1": [1, 2], "zip": {"var2": [1, 2]}}, {"var1": [{"var2": 1}]}, {}],
+    ids=["special_key", "nested", "empty"],
+)
+def test_columnar_product_fallback(variables):
+    assert columnar_product(variables) is None
+
+
+def test_project_matrix():
+    matrix = [{"a": a, "b": b, "c": 0} for a in [2, 1] for b in [1, 2]]
+    assert project_matrix(matrix, {"a", "c"}) == [{"a": 2, "c": 0}, {"a": 1, "c": 0}]
+    assert project_matrix(matrix, set()) == [{}]
+
+
+def test_project_matrix_unhashable():
+    matrix = [{"a": [1]}, {"a": [1]}, {"a": [2]}]
+    assert project_matrix(matrix, {"a"}) == [{"a": [1]}, {"a": [2]}]
+
+
+@given(
+    lists(integers(0, 3), min_size=1, max_size=4),
+    lists(integers(0, 3), min_size=1, max_size=4),
+)
+def test_process_command_projection(a_values, b_values):
+    """Only expanding the referenced variables gives the same commands."""
+    matrix = list(variable_matrix({"a": a_values, "b": b_values, "c": [1, 2]}))
+    command = {"cmd": "echo {a}", "creates": "{b}.txt"}
+    commands = process_command(command, matrix)
+    expected = uniqueify(
+        [Command("echo {a}", variables, creates="{b}.txt") for variables in matrix]
+    )
+    assert [c.cmd for c in commands] == [c.cmd for c in expected]
+    assert [c.creates for c in commands] == [c.creates for c in expected]
+    assert all(set(c.variables) == {"a", "b"} for c in commands)
+
+
+def test_process_command_missing_variable():
+    with pytest.raises(ValueError):
+        process_command("echo {missing}", [{"a": 1}])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_process_command_parallel(chunk_size):
+    """Rendering in multiple processes gives the same commands in the same order."""
+    matrix = list(variable_matrix({"a": list(range(20)), "b": [3, 1, 2, 1]}))
+    command = {"cmd": "echo {a} {b}", "creates": "{b}.txt"}
+    serial = process_command(command, matrix)
+    parallel = process_command(command, matrix, processes=2, chunk_size=chunk_size)
+    assert [c.cmd for c in parallel] == [c.cmd for c in serial]
+    assert [c.variables for c in parallel] == [c.variables for c in serial]
+
+
+def test_process_command_parallel_duplicates():
+    """The first of the commands rendered the same in different chunks is kept."""
+    matrix = [{"a": a} for a in [1, "1", 2, "2", 3, "3"]]
+    commands = process_command("echo {a}", matrix, processes=2, chunk_size=1)
+    assert [c.cmd for c in commands] == [["echo 1"], ["echo 2"], ["echo 3"]]
+    assert [c.variables for c in commands] == [{"a": 1}, {"a": 2}, {"a": 3}]